@@ -14,7 +14,7 @@ def main():
 
     st.title('Database Admin')
 
-    OPTIONS = ['SQLITE', 'AIRTABLE']
+    OPTIONS = ['SQLITE', 'SQLITE_SHARDED', 'MEMORY', 'SQLALCHEMY', 'AIRTABLE', 'REMOTE']
     idx = OPTIONS.index(osenv.get('STORAGE', 'SQLITE'))
     provider = st.sidebar.selectbox('Choose storage provider', OPTIONS, index=idx)
 
@@ -44,8 +44,13 @@ def main():
             | `username` | Single line text | Primary key; stores email |
             | `password` | Single line text | AES256-CBC encrypted |
             | `su` | Number | 0 or 1 (superuser flag) |
+            | `roles` | Single line text | Comma-separated role names (see Roles and permissions) |
             | `auth_token` | Single line text | Session token (empty if not logged in) |
             | `expires_at` | Single line text | ISO format datetime |
+            | `logins_count` | Number | Logins so far (written in batches) |
+            | `last_login` | Single line text | ISO format datetime of the latest login |
+            | `created_at` | Single line text | ISO format datetime |
+            | `updated_at` | Single line text | ISO format datetime of the last admin/sign-up change |
 
             ### PENDING_USERS table *(Optional - only if email signup is enabled)*
 
@@ -56,6 +61,7 @@ def main():
             | `validation_pin` | Single line text | 6-digit PIN |
             | `is_validated` | Number | 0 (pending) or 1 (verified) |
             | `expires_at` | Single line text | PIN expiry time (ISO format) |
+            | `pin_attempts` | Number | Incorrect PIN entries (0 when created) |
 
             ## Finding your Airtable credentials
 
@@ -2,6 +2,13 @@ __version__ = "1.0.2"
 
 from .common import const, trace_activity, AppError, DatabaseError # NOQA
 from .common.dt_helpers import tnow_iso , tnow_iso_str, dt_from_str, dt_from_ts, dt_to_str # NOQA
-from .common.crypto import aes256cbcExtended # NOQA
-from .common.session_token_manager import SessionTokenManager # NOQA
-from .common.cookie_manager import CookieManager # NOQA (deprecated, use SessionTokenManager)
+
+# aes256cbcExtended, SessionTokenManager and CookieManager (deprecated, use SessionTokenManager)
+# are resolved lazily from authlib.common on first access
+def __getattr__(name):
+    from . import common
+    if name in common._LAZY_IMPORTS:
+        value = getattr(common, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
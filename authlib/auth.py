@@ -1,15 +1,25 @@
 # see: https://discuss.streamlit.io/t/authentication-script/14111
 from os import environ as osenv
+from contextlib import contextmanager
 from functools import wraps
+import datetime
 import logging
+import threading
 from typing import Callable, Literal, TypedDict
 
 import streamlit as st
 
-from . import const, aes256cbcExtended, SessionTokenManager
+from . import const
 from .auth_session import AuthSession
-from .auth_signup import SignupManager
-from .common.email_service import EmailService
+from .common.session_token_manager import SessionTokenManager
+from .common.cookie_ops import CookieOps
+from .common.metrics import METRICS, provider_label
+from .common.rate_limiter import LoginThrottle
+from .common.audit import audit
+from .common.user_record import LOGIN_FIELDS, principal
+from .common.permissions import MODEL as PERMISSIONS, Access, define_roles  # noqa: F401 (re-exported)
+from .repo.provider.conds import is_literal
+from .repo.provider.connection import CircuitBreaker
 
 # ------------------------------------------------------------------------------
 # Globals
@@ -19,17 +29,50 @@ ENC_NONCE = osenv.get('ENC_NONCE')
 STORAGE = osenv.get('STORAGE', 'SQLITE')
 SESSION_TOKEN_NAME = osenv.get('SESSION_TOKEN_NAME', 'st-auth-simple')
 ALLOW_USER_SIGN_UP = osenv.get('ALLOW_USER_SIGN_UP', 'False').lower() == 'true'
-store = None
+AUTH_FRAGMENTS = osenv.get('AUTH_FRAGMENTS', 'True').lower() == 'true'
+AUTH_COMPLETION = osenv.get('AUTH_COMPLETION', 'inline').lower()  # 'inline' or 'rerun'
+AUTH_PROFILE = osenv.get('AUTH_PROFILE', 'off').lower()  # 'off', 'cprofile' or 'sample' (see common/profiling.py)
+if AUTH_PROFILE not in ('off', 'cprofile', 'sample'):
+    logging.warning(f'Unknown AUTH_PROFILE `{AUTH_PROFILE}` (use off, cprofile or sample); profiling is off')
+    AUTH_PROFILE = 'off'
+TRUSTED_PROXY_COUNT = int(osenv.get('TRUSTED_PROXY_COUNT', '0'))  # reverse proxies in front of the app
+store = None  # default (single-tenant) store; tenant stores come from the provider registry
+_TENANT_LEASE_KEY = '_auth_tenant_lease'
+_PROFILE_KEY = '_auth_profile'  # this session's profiling mode, set from the superuser Profiling panel
+_FRAGMENTS_KEY = '_auth_fragments'  # this session's auth(fragments=...), else AUTH_FRAGMENTS
+_COMPLETION_KEY = '_auth_completion'  # this session's auth(completion=...), else AUTH_COMPLETION
+_store_init_breaker = CircuitBreaker(failure_threshold=1, label='auth.store_init')
 session_token_manager = SessionTokenManager()
+login_throttle = LoginThrottle()
+
+_signup_budget_instance = None
+def _signup_budget():
+    """Sign-up budgets, created on first use (sign-up code is only loaded when enabled)."""
+    global _signup_budget_instance
+    if _signup_budget_instance is None:
+        from .auth_signup import SignupBudget
+        _signup_budget_instance = SignupBudget()
+    return _signup_budget_instance
+
+_cipher_instance = None
+def _cipher():
+    """Password cipher, created on first use (defers the pycryptodome import)."""
+    global _cipher_instance
+    if _cipher_instance is None:
+        from .common.crypto import aes256cbcExtended
+        _cipher_instance = aes256cbcExtended(ENC_PASSWORD, ENC_NONCE)
+    return _cipher_instance
 
 # ------------------------------------------------------------------------------
 # Auth State Definition and Initialization
 
 class AuthState(TypedDict):
     """Type definition for authentication state stored in st.session_state['auth_state']."""
-    user: dict | None                # user dict (database row) with keys like 'username', 'su', etc. or None if not authenticated
+    user: dict | None                # principal dict ('username', 'su', 'roles', 'auth_token', 'expires_at'; no password) or None if not authenticated
+    access: Access | None            # user's role and permission bitsets, resolved on the first check (see `has_permission`)
     skip_cookie_login: bool          # Flag to skip auto-login on next run after logout
     signup_email: str | None         # Store email during signup flow
+    tenant: str | None               # Tenant whose store this session uses (None: the default store)
 
 
 class _AuthStateProxy:
@@ -56,7 +99,9 @@ def init_auth_state() -> None:
         st.session_state['auth_state'] = {
             'user': None,
             'skip_cookie_login': False,
-            'signup_email': None
+            'signup_email': None,
+            'tenant': None,
+            'access': None
         }
 
 
@@ -65,7 +110,9 @@ def reset_auth_state() -> None:
     st.session_state['auth_state'] = {
         'user': None,
         'skip_cookie_login': False,
-        'signup_email': None
+        'signup_email': None,
+        'tenant': None,
+        'access': None
     }
 
 
@@ -93,6 +140,75 @@ def show_auth_message(msg: str, type: int = const.INFO) -> None:
         else: # default type == const.INFO:
             print(f"[AUTH] INFO: {msg}")
 
+@contextmanager
+def _profiled(label: str):
+    """Profile the enclosed auth work if AUTH_PROFILE (or this session's setting) asks for it."""
+    mode = st.session_state.get(_PROFILE_KEY) or AUTH_PROFILE
+    if mode == 'off':
+        yield
+        return
+    from .common.profiling import profiled
+    with profiled(label, mode) as capture:
+        try:
+            yield
+        finally:
+            if capture is not None and auth_state.user is not None:
+                capture.username = auth_state.user[const.USERNAME]
+
+# Auth widgets run in st.fragment regions, so interacting with them reruns only the
+# fragment and not the host app around auth(). Set AUTH_FRAGMENTS='False' (or pass
+# auth(fragments=False)) to fall back to full-app reruns.
+def _fragments_enabled() -> bool:
+    return st.session_state.get(_FRAGMENTS_KEY, AUTH_FRAGMENTS)
+
+def _fragment(fn):
+    @wraps(fn)
+    def queued(*args, **kwargs):
+        with _profiled(f'fragment:{fn.__name__}'), CookieOps.batch(flush=False):  # fragment runs skip auth(); the next app run flushes
+            return fn(*args, **kwargs)
+    fragment = st.fragment(queued)
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        return fragment(*args, **kwargs) if _fragments_enabled() else fn(*args, **kwargs)
+    return wrapper
+
+# With AUTH_COMPLETION='inline' (default), form submits and Logout are handled in widget
+# callbacks. Callbacks run before the script, so the run that follows already renders the
+# new state and auth() returns the user in that same run; nothing reruns a second time.
+# AUTH_COMPLETION='rerun' handles submits in the script body and reruns afterwards.
+_callback = threading.local()
+
+def _inline_completion() -> bool:
+    return st.session_state.get(_COMPLETION_KEY, AUTH_COMPLETION) == 'inline'
+
+def _on_submit(handler: Callable[[], None]):
+    """Wrap `handler` as a widget callback (inline mode) or return None (rerun mode)."""
+    if not _inline_completion():
+        return None
+    def callback():
+        _callback.active = True
+        try:
+            with _profiled(f'callback:{handler.__name__}'), CookieOps.batch(flush=False):  # written when auth() flushes in the run that follows
+                handler()
+        finally:
+            _callback.active = False
+    return callback
+
+def _rerun_app():
+    """
+    Rerun the host app after login/logout. In a callback this only widens the run that
+    follows to the whole app (so a login from inside the forms fragment reaches the host).
+    """
+    st.rerun()
+
+def _rerun_auth_ui():
+    """Redraw the auth UI after a change only it displays: the enclosing fragment on a fragment run, else the app."""
+    if getattr(_callback, 'active', False):
+        return  # the run after the callback redraws it anyway
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx()
+    st.rerun(scope='fragment' if ctx is not None and ctx.fragment_ids_this_run else 'app')
+
 # Easy inteceptor for auth
 def requires_auth(fn):
     @wraps(fn)
@@ -103,24 +219,93 @@ def requires_auth(fn):
             show_auth_message(f'{fn.__name__} requires authentication!', type=const.WARNING)
     return wrapper
 
+def _set_user(user: dict | None) -> None:
+    """Log the session in as `user` (a principal) or out (None), resolving its roles once."""
+    auth_state.user = user
+    auth_state.access = None if user is None else \
+        PERMISSIONS.resolve(user[const.USERNAME], user.get(const.ROLES), user.get(const.SU))
+
+def _access() -> Access | None:
+    """
+    The session user's role and permission bitsets. They are reused until the role
+    definitions change (re-resolved from the session principal) or an admin edits the
+    user (see `permissions.invalidate`; the user's roles are read from storage again).
+    """
+    user = auth_state.user
+    if user is None:
+        return None
+    username = user[const.USERNAME]
+    access = auth_state.access
+    if access is not None and access.username == username and PERMISSIONS.is_current(access):
+        return access
+
+    store = current_store()
+    if access is not None and access.username == username and access.epoch != PERMISSIONS.epoch(username) and store is not None:
+        ctx = {'fields': f"{const.ROLES}, {const.SU}", 'conds': f"{const.USERNAME}=\"{username}\""}
+        data = store.query(context=ctx)
+        roles, su = (data[0].get(const.ROLES), data[0].get(const.SU) or 0) if data else (None, 0)
+        user = {**user, const.ROLES: roles, const.SU: su}
+    _set_user(user)
+    return auth_state.access
+
+def has_role(*roles: str) -> bool:
+    """True if the session user has any of `roles` (superusers have every role)."""
+    access = _access()
+    return access is not None and access.roles & PERMISSIONS.role_mask(*roles) != 0
+
+def has_permission(*permissions: str) -> bool:
+    """True if the session user's roles grant all of `permissions`."""
+    required = PERMISSIONS.permission_mask(*permissions)
+    access = _access()
+    return access is not None and access.permissions & required == required
+
+def requires_role(*roles: str):
+    """Like `requires_auth`, but the user must also have one of `roles`."""
+    required = PERMISSIONS.role_mask(*roles)  # bits are fixed, so the mask is computed once
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            access = _access()
+            if access is not None and access.roles & required:
+                return fn(*args, **kwargs)
+            show_auth_message(f'{fn.__name__} requires role {" or ".join(roles)}!', type=const.WARNING)
+        return wrapper
+    return decorator
+
+def requires_permission(*permissions: str):
+    """Like `requires_auth`, but the user's roles must grant all of `permissions`."""
+    required = PERMISSIONS.permission_mask(*permissions)
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            access = _access()
+            if access is not None and access.permissions & required == required:
+                return fn(*args, **kwargs)
+            show_auth_message(f'{fn.__name__} requires permission {" and ".join(permissions)}!', type=const.WARNING)
+        return wrapper
+    return decorator
+
 @requires_auth
 def logout():
     # Clear server-side token from database FIRST (before browser cookie)
     # If DB clear fails, token remains in DB but is orphaned (security concern, but better than leaving token + cookie)
     show_auth_message('Logging out...', type=const.INFO)
     
+    store = current_store()
     db_cleared = False
     if auth_state.user and const.USERNAME in auth_state.user:
         db_cleared = AuthSession.clear_session(store, auth_state.user[const.USERNAME])
         if not db_cleared:
             logging.warning(f"Failed to clear session token for {auth_state.user[const.USERNAME]} during logout")
+        audit('logout', outcome='ok' if db_cleared else 'token_not_cleared', username=auth_state.user[const.USERNAME],
+              client=_client_address())
 
     # Clear session state
-    auth_state.user = None
+    _set_user(None)
     auth_state.skip_cookie_login = True  # Skip auto-login on this rerun only
 
     # Clear browser cookie
-    session_token_manager.delete(SESSION_TOKEN_NAME)
+    session_token_manager.delete(_token_name())
 
     # Warn user if token wasn't cleared from DB
     if not db_cleared:
@@ -128,11 +313,51 @@ def logout():
                         type=const.WARNING)
 
     show_auth_message('Logged out', type=const.SUCCESS)
-    st.rerun()
+    _rerun_app()
 
 def authenticated():
     return auth_state.user is not None
 
+def current_store():
+    """The storage provider for this session: its tenant's store, or the default store."""
+    if auth_state.tenant is None:
+        return store
+    lease = st.session_state.get(_TENANT_LEASE_KEY)
+    return lease.provider if lease is not None else None
+
+def _token_name() -> str:
+    """Session cookie name; each tenant gets its own so a browser can stay logged in to several."""
+    return SESSION_TOKEN_NAME if auth_state.tenant is None else f'{SESSION_TOKEN_NAME}-{auth_state.tenant}'
+
+def _use_tenant(tenant: str | None) -> bool:
+    """
+    Point this session at `tenant`'s store (held through a registry lease, released when
+    the tenant changes or the session ends). Switching tenants logs the session out.
+    Returns False if the tenant's store can't be opened.
+    """
+    lease = st.session_state.get(_TENANT_LEASE_KEY)
+    if tenant == auth_state.tenant and (tenant is None or lease is not None):
+        return True
+
+    if tenant != auth_state.tenant:
+        _set_user(None)
+        auth_state.signup_email = None
+        auth_state.tenant = tenant
+    if lease is not None:
+        del st.session_state[_TENANT_LEASE_KEY]
+        lease.release()
+    if tenant is None:
+        return True
+
+    from authlib.repo.registry import REGISTRY
+    try:
+        st.session_state[_TENANT_LEASE_KEY] = REGISTRY.lease(tenant, STORAGE)
+        return True
+    except Exception as ex:
+        logging.warning(f">>> Storage exception (tenant `{tenant}`) <<<\n`{str(ex)}`")
+        show_auth_message(f"Auth DB for `{tenant}` is not available.", type=const.WARNING)
+        return False
+
 # ------------------------------------------------------------------------------
 # Main auth service
 
@@ -147,23 +372,48 @@ def _try_cookie_login():
         return False
 
     # Get token from browser cookie
-    token = session_token_manager.get(token=SESSION_TOKEN_NAME)
+    token = session_token_manager.get(token=_token_name())
     if not token:
         return False
 
     # Validate token against database (token is looked up in DB, user data returned)
+    store = current_store()
     user = AuthSession.validate_session(store, token)
+    METRICS.inc('auth.cookie_login', provider=provider_label(store), outcome='ok' if user else 'invalid')
+    audit('cookie_login', outcome='ok' if user else 'invalid', username=user[const.USERNAME] if user else None,
+          client=_client_address())
     if user:
-        auth_state.user = user
+        _set_user(user)
+        AuthSession.record_login(store, user)
         show_auth_message('Auto-logged in', type=const.INFO)
-        st.rerun()
         return True
     else:
         # Invalid/expired token
-        session_token_manager.delete(SESSION_TOKEN_NAME)
+        session_token_manager.delete(_token_name())
         return False
 
 
+def _expiry(user: dict):
+    """The user's session expiry as a datetime (for the cookie)."""
+    return datetime.datetime.fromisoformat(user[const.EXPIRES_AT])
+
+
+def _renew_session():
+    """
+    Sliding expiration for remembered sessions. Renewal writes are buffered and
+    the cookie is only rewritten when the expiry actually moved.
+    """
+    user = auth_state.user
+    store = current_store()
+    if store is None or not AuthSession.renewal_due(user):
+        return
+    if session_token_manager.get(token=_token_name()) != user[const.AUTH_TOKEN]:
+        return  # not the session remembered by this browser
+    expires_at = AuthSession.renew_session(store, user)
+    if expires_at is not None:
+        session_token_manager.set(_token_name(), user[const.AUTH_TOKEN], expires_at=expires_at)
+
+
 def _validate_email(email: str) -> bool:
     """Simple email format validation."""
     import re
@@ -175,19 +425,31 @@ def _show_signup_form():
     """Display signup form."""
 
     with st.form("signup_form", border=True):
-        email = st.text_input("Email (will be your username)", value='')
-        password = st.text_input("Password", type="password")
-        confirm_password = st.text_input("Confirm password", type="password")
-        submit_button = st.form_submit_button("Sign Up", type="primary", use_container_width=False)
+        st.text_input("Email (will be your username)", value='', key='_auth_signup_email')
+        st.text_input("Password", type="password", key='_auth_signup_password')
+        st.text_input("Confirm password", type="password", key='_auth_signup_confirm')
+        submit_button = st.form_submit_button("Sign Up", type="primary", use_container_width=False,
+                                              on_click=_on_submit(_submit_signup))
+
+    if submit_button and not _inline_completion():
+        _submit_signup()
+
 
-    if submit_button:
-        _handle_signup_submission(email, password, confirm_password)
+def _submit_signup():
+    state = st.session_state
+    _handle_signup_submission(state.get('_auth_signup_email'), state.get('_auth_signup_password'),
+                              state.get('_auth_signup_confirm'))
 
 
 def _handle_signup_submission(email: str, password: str, confirm_password: str):
     """Validate signup form and create pending user."""
+    from .auth_signup import SignupManager
+    from .common.email_service import EmailService
+
+    store = current_store()
+
     # Validate email format
-    if not email or not _validate_email(email):
+    if not email or not _validate_email(email) or not is_literal(email):
         show_auth_message('Please enter a valid email address', type=const.ERROR)
         return
 
@@ -200,15 +462,22 @@ def _handle_signup_submission(email: str, password: str, confirm_password: str):
         show_auth_message('Passwords do not match', type=const.ERROR)
         return
 
-    # Check if email already exists in users table
-    ctx = {'fields': '*', 'conds': f'username="{email}"'}
+    # Check if email already exists in users table (before spending budget on a sign-up that can't proceed)
+    ctx = {'fields': const.USERNAME, 'conds': f'username="{email}"', 'modifier': "LIMIT 1"}
     existing_user = store.query(context=ctx)
     if existing_user:
         show_auth_message('This email is already registered', type=const.ERROR)
         return
 
+    # Spend pending-row and email budgets before the pending row is written and the PIN is sent
+    retry_after = _signup_budget().consume('pending', 'email', email=email, client=_client_address())
+    if retry_after:
+        METRICS.inc('signup.budget', outcome='pending_denied')
+        show_auth_message(f'Too many sign-up attempts. Try again in {int(retry_after) + 1} seconds.', type=const.ERROR)
+        return
+
     # Encrypt password
-    encrypted_password = aes256cbcExtended(ENC_PASSWORD, ENC_NONCE).encrypt(password)
+    encrypted_password = _cipher().encrypt(password)
 
     # Create pending user and get PIN
     try:
@@ -220,77 +489,90 @@ def _handle_signup_submission(email: str, password: str, confirm_password: str):
         # Store email in session state for PIN verification
         auth_state.signup_email = email
         show_auth_message(f'Verification code sent to {email}', type=const.INFO)
-        st.rerun()
+        _rerun_auth_ui()
     except Exception as ex:
         logging.error(f'Signup error: {str(ex)}')
         show_auth_message('An error occurred during signup. Please try again.', type=const.ERROR)
 
 def _show_pin_verification_form():
     """Display PIN verification form."""
+    from .auth_signup import SignupManager
+    from .common.email_service import EmailService
+
+    store = current_store()
+
     signup_email = auth_state.signup_email
     show_auth_message(f'Enter the verification code sent to {signup_email}', type=const.INFO)
 
     with st.form("pin_form", border=True):
-        pin = st.text_input("Verification Code (6 digits)", value='', max_chars=6)
-        verify_button = st.form_submit_button("Verify", type="primary", use_container_width=False)
+        st.text_input("Verification Code (6 digits)", value='', max_chars=6, key='_auth_signup_pin')
+        verify_button = st.form_submit_button("Verify", type="primary", use_container_width=False,
+                                              on_click=_on_submit(_submit_pin))
 
     # Resend button outside form
     if st.button("Resend Code", use_container_width=False):
-        user = SignupManager.get_pending_user(store, auth_state.signup_email)
-        if user:
-            # Regenerate PIN and send
-            new_pin = SignupManager.generate_pin()
-            store.upsert({
-                'table': SignupManager.PENDING_USERS_TABLE,
-                'data': {
-                    'username': auth_state.signup_email,
-                    'password': user['password'],
-                    'validation_pin': new_pin,
-                    'is_validated': 0,
-                    'expires_at': user['expires_at'],
-                }
-            })
-            EmailService.send_signup_pin(auth_state.signup_email, new_pin)
+        retry_after = _signup_budget().consume('email', email=signup_email, client=_client_address())
+        if retry_after:
+            METRICS.inc('signup.budget', outcome='email_denied')
+            show_auth_message(f'Too many codes sent. Try again in {int(retry_after) + 1} seconds.', type=const.ERROR)
+            return
+        # Regenerate PIN (keeps expiry and attempt count) and send
+        new_pin = SignupManager.regenerate_pin(store, signup_email)
+        if new_pin:
+            EmailService.send_signup_pin(signup_email, new_pin)
             show_auth_message('New code sent', type=const.INFO)
         else:
             show_auth_message('Signup session expired. Please sign up again.', type=const.INFO)
             auth_state.signup_email = None
-            st.rerun()
+            _rerun_auth_ui()
+
+    if verify_button and not _inline_completion():
+        _submit_pin()
+
 
-    if verify_button and pin:
+def _submit_pin():
+    pin = st.session_state.get('_auth_signup_pin')
+    if pin and auth_state.signup_email:
         _handle_pin_verification(auth_state.signup_email, pin)
 
 
 def _handle_pin_verification(email: str, pin: str):
     """Validate PIN and complete signup."""
-    success, error_msg = SignupManager.validate_pin(store, email, pin)
+    from .auth_signup import SignupManager
 
-    if not success:
-        show_auth_message(error_msg, type=const.ERROR)
+    store = current_store()
+
+    # Spend a PIN attempt before touching storage
+    retry_after = _signup_budget().consume('pin', email=email, client=_client_address())
+    if retry_after:
+        METRICS.inc('signup.budget', outcome='pin_denied')
+        show_auth_message(f'Too many verification attempts. Try again in {int(retry_after) + 1} seconds.', type=const.ERROR)
         return
 
-    # PIN is valid, move user to users table
-    user = SignupManager.complete_signup(store, email)
+    # Verify the PIN and move the user to the users table in one storage operation
+    user, error_msg = SignupManager.complete_signup(store, email, pin)
     if not user:
-        show_auth_message('Failed to complete signup. Please try again.', type=const.ERROR)
+        show_auth_message(error_msg, type=const.ERROR)
         return
 
     # Auto-login
-    auth_state.user = user
+    user = principal(user)
+    _set_user(user)
     auth_state.signup_email = None
+    AuthSession.record_login(store, user)
 
     # Create session token for auto-login (remember me)
-    token = AuthSession.create_session(store, user, expires_in_days=30)
+    token = AuthSession.create_session(store, user)
     if token:
         # Token created successfully, set browser cookie
-        session_token_manager.set(SESSION_TOKEN_NAME, token)
+        session_token_manager.set(_token_name(), token, expires_at=_expiry(user))
         show_auth_message('Email verified! You are now logged in.', type=const.SUCCESS)
     else:
         # Token creation failed - user is logged in but won't auto-login next time
         show_auth_message('Email verified! You are logged in, but "Remember me" could not be enabled. Please log in again next time.',
                         type=const.WARNING)
 
-    st.rerun()
+    _rerun_app()
 
 
 def _show_login_form():
@@ -298,66 +580,146 @@ def _show_login_form():
     show_auth_message('Logged out', type=const.SUCCESS)
 
     with st.form("login_form", border=True):
-        username = st.text_input("Username", value='')
-        password = st.text_input("Password", type="password")
-        remember_me = st.checkbox("Remember me", value=False)
-        submit_button = st.form_submit_button("Login", type="primary", use_container_width=False)
+        st.text_input("Username", value='', key='_auth_login_username')
+        st.text_input("Password", type="password", key='_auth_login_password')
+        st.checkbox("Remember me", value=False, key='_auth_login_remember')
+        submit_button = st.form_submit_button("Login", type="primary", use_container_width=False,
+                                              on_click=_on_submit(_submit_login))
+
+    # Handle form submission (rerun mode; inline mode already handled it in the callback)
+    if submit_button and not _inline_completion():
+        _submit_login()
+
 
-    # Handle form submission
-    if submit_button and username and password:
-        _handle_login_submission(username, password, remember_me)
+def _submit_login():
+    state = st.session_state
+    username, password = state.get('_auth_login_username'), state.get('_auth_login_password')
+    if username and password:
+        _handle_login_submission(username, password, state.get('_auth_login_remember'))
+
+
+def _client_address() -> str:
+    """
+    Client address for the current session, the key of per-client throttles and budgets.
+
+    Forwarded headers are set by whoever sends the request, so they are only read behind
+    TRUSTED_PROXY_COUNT reverse proxies: the client is the X-Forwarded-For entry that many hops
+    from the right (each proxy appends the address it received from). Otherwise, and when the
+    header is shorter than that, the socket address is used.
+    """
+    try:
+        if TRUSTED_PROXY_COUNT > 0:
+            headers = st.context.headers
+            forwarded = [hop.strip() for hop in (headers.get('X-Forwarded-For') or '').split(',') if hop.strip()]
+            if len(forwarded) >= TRUSTED_PROXY_COUNT:
+                return forwarded[-TRUSTED_PROXY_COUNT]
+            real_ip = headers.get('X-Real-Ip')
+            if not forwarded and real_ip and TRUSTED_PROXY_COUNT == 1:
+                return real_ip.strip()  # set (overwritten) by the single proxy
+        ip_address = st.context.ip_address
+        return ip_address if isinstance(ip_address, str) and ip_address else 'unknown'
+    except Exception:
+        return 'unknown'
 
 
 def _handle_login_submission(username, password, remember_me):
     """Validate credentials and log user in."""
-    # Look up user
-    ctx = {'fields': "*", 'conds': f"username=\"{username}\""}
-    data = store.query(context=ctx)
+    store = current_store()
+    # Refuse throttled attempts before any storage I/O or crypto
+    client = _client_address()
+    retry_after = login_throttle.check(username, client)
+    if retry_after:
+        METRICS.inc('auth.login', provider=provider_label(store), outcome='throttled')
+        audit('login', outcome='throttled', username=username, client=client, retry_after=round(retry_after, 1))
+        show_auth_message(f'Too many failed login attempts. Try again in {int(retry_after) + 1} seconds.', type=const.ERROR)
+        return
+
+    # Look up user (a name that can't be quoted into conds matches nobody)
+    ctx = {'fields': LOGIN_FIELDS, 'conds': f"username=\"{username}\""}
+    data = store.query(context=ctx) if is_literal(username) else []
     user = data[0] if data else None
 
     if not user:
+        METRICS.inc('auth.login', provider=provider_label(store), outcome='unknown_user')
+        audit('login', outcome='unknown_user', username=username, client=client)
+        login_throttle.record_failure(username, client)
         show_auth_message('User not found', type=const.ERROR)
         return
 
     # Verify password
-    decrypted_password = aes256cbcExtended(ENC_PASSWORD, ENC_NONCE).decrypt(user[const.PASSWORD])
+    decrypted_password = _cipher().decrypt(user[const.PASSWORD])
     if password != decrypted_password:
+        METRICS.inc('auth.login', provider=provider_label(store), outcome='bad_password')
+        audit('login', outcome='bad_password', username=username, client=client)
+        login_throttle.record_failure(username, client)
         show_auth_message('Invalid password', type=const.ERROR)
         return
 
     # Login successful
-    auth_state.user = user
+    METRICS.inc('auth.login', provider=provider_label(store), outcome='ok')
+    audit('login', username=username, client=client, remember_me=bool(remember_me))
+    login_throttle.record_success(username, client)
+    user = principal(user)  # the session keeps no password
+    _set_user(user)
+    AuthSession.record_login(store, user)
 
     # If "Remember me" checked, create server-side session token
     if remember_me:
-        token = AuthSession.create_session(store, user, expires_in_days=30)
+        token = AuthSession.create_session(store, user)
         if token:
             # Token created successfully, set browser cookie
-            session_token_manager.set(SESSION_TOKEN_NAME, token)  # Store only the token, not user data
+            session_token_manager.set(_token_name(), token, expires_at=_expiry(user))  # Store only the token, not user data
         else:
             # Token creation failed - user is logged in but won't auto-login next time
             logging.warning(f"Failed to create session token for {username} on login")
 
     show_auth_message('Logging in...', type=const.INFO)
-    st.rerun()
+    _rerun_app()
 
 
 def _show_logged_in_ui(sidebar):
     """Display UI for authenticated users."""
     show_auth_message('Logged in', type=const.SUCCESS)
 
-    su_widget = st.sidebar.checkbox if sidebar else st.checkbox
-    logout_widget = st.sidebar.button if sidebar else st.button
+    # Logout and the superuser toggle change the page layout, so they rerun the app
+    with _auth_container(sidebar):
+        if st.button('Logout', on_click=_on_submit(logout)) and not _inline_completion():
+            logout()  # logout() calls st.rerun() internally
+        show_su = auth_state.user[const.SU] == 1 and st.checkbox("Super users can edit user DB")
+
+    if show_su:
+        from .auth_admin import _superuser_mode
+        _superuser_mode()  # runs as its own fragment
 
-    if logout_widget('Logout'):
-        logout()  # logout() calls st.rerun() internally
 
-    if auth_state.user[const.SU] == 1:
-        if su_widget("Super users can edit user DB"):
-            _superuser_mode()
+@_fragment
+def _show_auth_forms():
+    """Login and sign-up forms; failed attempts and sign-up steps only rerun this fragment."""
+    if ALLOW_USER_SIGN_UP:
+        # Show tabs for login and signup
+        login_tab, signup_tab = st.tabs(['Login', 'Sign Up'])
 
+        with login_tab:
+            _show_login_form()
 
-def auth(sidebar=True, on_message_cb: Callable[[str, int], None] | Literal["default"] | None = "default"):
+        with signup_tab:
+            # Check if in middle of signup flow (waiting for PIN)
+            if auth_state.signup_email:
+                _show_pin_verification_form()
+            else:
+                _show_signup_form()
+    else:
+        # Only show login form (no signup)
+        _show_login_form()
+
+
+def _auth_container(sidebar):
+    return st.sidebar if sidebar else st.container()
+
+
+def auth(sidebar=True, on_message_cb: Callable[[str, int], None] | Literal["default"] | None = "default",
+         fragments: bool | None = None, completion: Literal["inline", "rerun"] | None = None,
+         tenant: str | None = None):
     """
     Main authentication function.
     Flow: Check if authenticated -> Try cookie login -> Show login/signup forms
@@ -365,151 +727,81 @@ def auth(sidebar=True, on_message_cb: Callable[[str, int], None] | Literal["defa
     Args:
     - sidebar (bool): Whether to display authentication UI in the sidebar or main area.
     - on_message_cb (callable or "default" or None): Optional callback for displaying messages. If "default", uses built-in print statements. If None, no messages are shown.
+    - fragments (bool or None): Run the auth forms and superuser panel as st.fragment regions so their widgets don't rerun the host app. Defaults to AUTH_FRAGMENTS.
+    - completion ("inline", "rerun" or None): "inline" handles login, sign-up and logout in widget callbacks so the user is returned in the same run; "rerun" handles them in the script body and reruns. Defaults to AUTH_COMPLETION.
+    - tenant (str or None): Authenticate against this tenant's store (its own database file or Airtable base, see TENANT_* settings). None uses the default store.
     """
+    # Cookie writes made anywhere in this run (or in the callbacks before it) go out as one script at the end
+    with _profiled('auth'), CookieOps.batch():
+        return _auth(sidebar, on_message_cb, fragments, completion, tenant)
+
+
+def _auth(sidebar, on_message_cb, fragments, completion, tenant):
     global auth_message_cb
     auth_message_cb = on_message_cb
 
+    # Per session: the fragments and callbacks of later runs read these, not the process-wide settings
+    st.session_state[_FRAGMENTS_KEY] = AUTH_FRAGMENTS if fragments is None else fragments
+    st.session_state[_COMPLETION_KEY] = AUTH_COMPLETION if completion is None else completion.lower()
+
     global store
 
-    # Initialize storage provider
-    if store is None:
+    # Tenant stores are opened (and shared between sessions) by the provider registry
+    if not _use_tenant(tenant):
+        return None
+
+    # Initialize storage provider (after a failure, retried on a backoff rather than on every rerun)
+    if tenant is None and store is None and _store_init_breaker.allow():
         try:
             from authlib.repo.storage_factory import StorageFactory
 
             store = StorageFactory().get_provider(STORAGE, allow_db_create=False, if_table_exists='ignore')
-            ctx = {'fields': "*", 'modifier': "LIMIT 1"}
+            ctx = {'fields': const.USERNAME, 'modifier': "LIMIT 1"}
             store.query(context=ctx)
+            _store_init_breaker.success()
         except Exception as ex:
             logging.warning(f">>> Storage exception <<<\n`{str(ex)}`")
             store = None
-            show_auth_message(
-                "Auth DB Not Found. Consider running admin script in standalone mode to generate it."
-                "\n\nFor Airtable, ensure the `USERS` and `PENDING_USERS` tables exist and access settings are correct." if STORAGE == 'AIRTABLE' else "",
-                type=const.WARNING
-            )
+            _store_init_breaker.failure()
+
+    # Without a store (the probe failed, or is waiting out its backoff) neither the cookie login
+    # nor the forms can run, so stop here as the tenant path does
+    if tenant is None and store is None:
+        show_auth_message(
+            "Auth DB Not Found. Consider running admin script in standalone mode to generate it." +
+            ("\n\nFor Airtable, ensure the `USERS` and `PENDING_USERS` tables exist and access settings are correct." if STORAGE == 'AIRTABLE' else ""),
+            type=const.WARNING
+        )
+        return None
 
     # Show authentication header
-    with st.sidebar if sidebar else st:
+    with _auth_container(sidebar):
         st.subheader('Authentication')
 
-    # Check if already authenticated
+    # Try to auto-login from cookie before any forms are drawn, so it completes in this run
+    if auth_state.user is None:
+        _try_cookie_login()
+
+    # Check if authenticated
     if auth_state.user is not None:
+        _renew_session()
         _show_logged_in_ui(sidebar)
         return auth_state.user[const.USERNAME]
 
-    # Try to auto-login from cookie
-    if _try_cookie_login():
-        return auth_state.user[const.USERNAME]
-
-    forms_location = st.sidebar if sidebar else st
-    with forms_location:
-        # Show login and/or signup forms
-        if ALLOW_USER_SIGN_UP:
-            # Show tabs for login and signup
-            login_tab, signup_tab = st.tabs(['Login', 'Sign Up'])
-
-            with login_tab:
-                _show_login_form()
-
-            with signup_tab:
-                # Check if in middle of signup flow (waiting for PIN)
-                if auth_state.signup_email:
-                    _show_pin_verification_form()
-                else:
-                    _show_signup_form()
-        else:
-            # Only show login form (no signup)
-            _show_login_form()
+    # Fragments can't write to st.sidebar themselves, so they are called inside it
+    with _auth_container(sidebar):
+        _show_auth_forms()
 
     return auth_state.user[const.USERNAME] if auth_state.user is not None else None
 
 
-# ------------------------------------------------------------------------------
-# Helpers
-
-@requires_auth
-def _list_users():
-    st.subheader('List users')
-    ctx = {'fields': f"{const.USERNAME}, {const.PASSWORD}, {const.SU}"}
-    data = store.query(context=ctx)
-    if data:
-        display_data = [{const.USERNAME: row[const.USERNAME], const.PASSWORD: row[const.PASSWORD], const.SU: row[const.SU]} for row in data]
-        st.table(display_data)
-    else:
-        st.write("`No entries in authentication database`")
-
-@requires_auth
-def _create_user(name=const.BLANK, pwd=const.BLANK, is_su=False, mode='create'):
-    st.subheader('Create user')
-    username = st.text_input("Enter Username (required)", value=name)
-    if mode == 'create':
-        password = st.text_input("Enter Password (required)", value=pwd, type='password')
-    elif mode == 'edit':
-        # Do not display password as DB stores them encrypted
-        # Passwords will always be created anew in edit mode
-        password = st.text_input("Enter Replacement Password (required)", value=const.BLANK)
-    su = 1 if st.checkbox("Is this a superuser?", value=is_su) else 0
-    if st.button("Update Database") and username:
-        if password: # new password given
-            encrypted_password = aes256cbcExtended(ENC_PASSWORD, ENC_NONCE).encrypt(password)
-        elif mode == 'edit': # reuse old one
-            encrypted_password = pwd
-        elif mode == 'create': # Must have a password
-            st.write("`Database NOT Updated` (enter a password)")
-            return
-        # TODO: user_id, password, logged_in, expires_at, logins_count, last_login, created_at, updated_at, su
-        ctx = {'data': {const.USERNAME: f"{username}", const.PASSWORD: f"{encrypted_password}", const.SU: su}}
-        store.upsert(context=ctx)
-        st.write("`Database Updated`")
-
-@requires_auth
-def _edit_user():
-    st.subheader('Edit user')
-    ctx = {'fields': const.USERNAME}
-    userlist = [row[const.USERNAME] for row in store.query(context=ctx)]
-    userlist.insert(0, "")
-    username = st.selectbox("Select user", options=userlist)
-    if username:
-        ctx = {'fields': f"{const.USERNAME}, {const.PASSWORD}, {const.SU}", 'conds': f"{const.USERNAME}=\"{username}\""}
-        user_data = store.query(context=ctx)
-        _create_user(
-            name=user_data[0][const.USERNAME],
-            pwd=user_data[0][const.PASSWORD],
-            is_su=user_data[0][const.SU],
-            mode='edit'
-        )
-
-@requires_auth
-def _delete_user():
-    st.subheader('Delete user')
-    ctx = {'fields': const.USERNAME}
-    userlist = [row[const.USERNAME] for row in store.query(context=ctx)]
-    userlist.insert(0, "")
-    username = st.selectbox("Select user", options=userlist)
-    if username:
-        if st.button(f"Remove {username}"):
-            ctx = {'conds': f"{const.USERNAME}=\"{username}\""}
-            store.delete(context=ctx)
-            st.write(f"`User {username} deleted`")
-
-@requires_auth
-def _superuser_mode():
-    st.header(f'Super user mode (store = {STORAGE})')
-    modes =  {
-        "View": _list_users,
-        "Create": _create_user,
-        "Edit": _edit_user,
-        "Delete": _delete_user,
-    }
-    mode = st.radio("Select mode", modes.keys(), horizontal=True)
-    modes[mode]()
-
 # ------------------------------------------------------------------------------
 # Allows storage provider to be overriden programmatically 
 
 def override_env_storage_provider(provider):
+    from authlib.repo.storage_factory import STORAGE_PROVIDERS
     try:
-        assert(provider in ['SQLITE', 'AIRTABLE'])
+        assert(provider in STORAGE_PROVIDERS)
         global STORAGE
         STORAGE = provider
     except Exception:
@@ -527,5 +819,6 @@ def admin():
         store = StorageFactory().get_provider(STORAGE, allow_db_create=True, if_table_exists='ignore')
 
         # Fake the admin user token to enable superuser mode (password field isn't required)
-        auth_state.user = {const.USERNAME: 'admin', const.SU: 1}
+        _set_user({const.USERNAME: 'admin', const.SU: 1})
+        from .auth_admin import _superuser_mode
         _superuser_mode()
@@ -0,0 +1,238 @@
+"""
+Superuser UI: list, create, edit and delete users, view metrics, the audit log and profiles, and take backups.
+
+Imported on demand by `authlib.auth` when superuser mode is opened, so regular
+app sessions never load it.
+"""
+
+import datetime
+
+import streamlit as st
+
+from . import const
+from . import auth as _auth
+from .auth import requires_auth, _fragment, _rerun_auth_ui
+from .common.audit import audit, get_audit_log
+from .common.metrics import METRICS, format_ms
+from .common.permissions import MODEL as PERMISSIONS, invalidate, join_roles, split_roles
+from .common.write_behind import buffer_for
+
+
+def _actor() -> str:
+    return _auth.auth_state.user[const.USERNAME]
+
+@requires_auth
+def _list_users():
+    st.subheader('List users')
+    # Write out buffered login counts first so the listing is current
+    buffer_for(_auth.current_store()).flush()
+    cols = [const.USERNAME, const.PASSWORD, const.SU, const.ROLES, const.LOGINS_COUNT, const.LAST_LOGIN, const.CREATED_AT, const.UPDATED_AT]
+    # Rows are streamed (page by page on Airtable) straight into the display list
+    ctx = {'fields': ', '.join(cols), 'sort': [const.USERNAME]}
+    display_data = [{col: row.get(col) for col in cols} for row in _auth.current_store().iterate(context=ctx)]
+    if display_data:
+        st.caption(f'{len(display_data)} users')
+        st.table(display_data)
+    else:
+        st.write("`No entries in authentication database`")
+
+@requires_auth
+def _create_user(name=const.BLANK, pwd=const.BLANK, is_su=False, roles=None, mode='create'):
+    st.subheader('Create user')
+    username = st.text_input("Enter Username (required)", value=name)
+    if mode == 'create':
+        password = st.text_input("Enter Password (required)", value=pwd, type='password')
+    elif mode == 'edit':
+        # Do not display password as DB stores them encrypted
+        # Passwords will always be created anew in edit mode
+        password = st.text_input("Enter Replacement Password (required)", value=const.BLANK)
+    su = 1 if st.checkbox("Is this a superuser?", value=is_su) else 0
+    current_roles = split_roles(roles)
+    roles = join_roles(st.multiselect(
+        "Roles", options=sorted(set(PERMISSIONS.roles()) | set(current_roles)), default=current_roles,
+        accept_new_options=True, help="Defined by AUTH_ROLES (or `define_roles()`); type a name to add another role"
+    ))
+    if st.button("Update Database") and username:
+        if password: # new password given
+            encrypted_password = _auth._cipher().encrypt(password)
+        elif mode == 'edit': # reuse old one
+            encrypted_password = pwd
+        elif mode == 'create': # Must have a password
+            st.write("`Database NOT Updated` (enter a password)")
+            return
+        now = datetime.datetime.now().isoformat()
+        data = {const.USERNAME: f"{username}", const.PASSWORD: f"{encrypted_password}", const.SU: su, const.ROLES: roles,
+                const.UPDATED_AT: now}
+        if mode == 'edit' and username == name:
+            # Keep session and login tracking columns
+            _auth.current_store().update(context={'data': data})
+            audit('admin.edit_user', username=username, actor=_actor(), su=su, roles=roles, password_changed=bool(password))
+        else:
+            data.update({const.CREATED_AT: now, const.LOGINS_COUNT: 0})
+            _auth.current_store().upsert(context={'data': data})
+            audit('admin.create_user', username=username, actor=_actor(), su=su, roles=roles)
+        invalidate(username)  # live sessions of this user pick up the new roles on their next check
+        st.write("`Database Updated`")
+
+@requires_auth
+def _edit_user():
+    st.subheader('Edit user')
+    ctx = {'fields': const.USERNAME}
+    userlist = [row[const.USERNAME] for row in _auth.current_store().iterate(context=ctx)]
+    userlist.insert(0, "")
+    username = st.selectbox("Select user", options=userlist)
+    if username:
+        ctx = {'fields': f"{const.USERNAME}, {const.PASSWORD}, {const.SU}, {const.ROLES}", 'conds': f"{const.USERNAME}=\"{username}\""}
+        user_data = _auth.current_store().query(context=ctx)
+        _create_user(
+            name=user_data[0][const.USERNAME],
+            pwd=user_data[0][const.PASSWORD],
+            is_su=user_data[0][const.SU],
+            roles=user_data[0].get(const.ROLES),
+            mode='edit'
+        )
+
+@requires_auth
+def _delete_user():
+    st.subheader('Delete user')
+    ctx = {'fields': const.USERNAME}
+    userlist = [row[const.USERNAME] for row in _auth.current_store().iterate(context=ctx)]
+    userlist.insert(0, "")
+    username = st.selectbox("Select user", options=userlist)
+    if username:
+        if st.button(f"Remove {username}"):
+            ctx = {'conds': f"{const.USERNAME}=\"{username}\""}
+            _auth.current_store().delete(context=ctx)
+            audit('admin.delete_user', username=username, actor=_actor())
+            invalidate(username)
+            st.write(f"`User {username} deleted`")
+
+@requires_auth
+def _show_metrics():
+    st.subheader('Metrics')
+    rows = METRICS.snapshot()
+    if rows:
+        # Quantiles past the largest bucket are inf; show them as "> max bucket"
+        quantiles = ('p50_ms', 'p95_ms', 'p99_ms')
+        st.dataframe([{col: format_ms(value) if col in quantiles else value for col, value in row.items()} for row in rows],
+                     hide_index=True)
+    else:
+        st.write("`No metrics recorded yet`")
+    store = _auth.current_store()
+    if hasattr(store, 'pool_stats'):
+        st.caption('Connection pool')
+        st.dataframe([store.pool_stats()], hide_index=True)
+    from .repo.registry import REGISTRY
+    if len(REGISTRY):
+        st.caption(f'Tenant stores ({REGISTRY.open_connections()} connections open)')
+        st.dataframe(REGISTRY.stats(), hide_index=True)
+    exposition = METRICS.render_prometheus()
+    c1, c2 = st.columns(2)
+    c1.download_button("Download Prometheus metrics", data=exposition, file_name='authlib_metrics.prom', mime='text/plain')
+    if c2.button("Reset metrics"):
+        METRICS.reset()
+        _rerun_auth_ui()
+    with st.expander('Prometheus text exposition'):
+        st.code(exposition, language='text')
+
+@requires_auth
+def _show_audit_log():
+    st.subheader('Audit log')
+    log = get_audit_log()
+    if log is None:
+        st.write("`Audit log disabled` (set AUDIT_LOG to 'sqlite' or 'jsonl')")
+        return
+    log.flush(timeout=1.0)
+    limit = st.number_input("Latest events", min_value=10, max_value=5000, value=100, step=10)
+    events = log.sink.recent(int(limit))
+    if events:
+        st.dataframe(events, hide_index=True)
+    else:
+        st.write("`No audit events yet`")
+
+@requires_auth
+def _show_profiles():
+    from .common.profiling import PROFILES, PROFILE_MODES, AUTH_PROFILE_TRACEMALLOC
+    st.subheader('Profiling')
+    current = st.session_state.get(_auth._PROFILE_KEY) or _auth.AUTH_PROFILE
+    if current not in PROFILE_MODES:
+        current = 'off'
+    mode = st.selectbox("Profile auth runs in this session", PROFILE_MODES, index=PROFILE_MODES.index(current),
+                        help="'cprofile' records every call; 'sample' samples stacks (less overhead). AUTH_PROFILE sets it for all sessions.")
+    if mode != current:
+        st.session_state[_auth._PROFILE_KEY] = mode
+        audit('admin.profile', actor=_actor(), mode=mode)
+    st.caption(f'Slowest {PROFILES.keep} captures in this process (AUTH_PROFILE = {_auth.AUTH_PROFILE}, '
+               f'tracemalloc {"on" if AUTH_PROFILE_TRACEMALLOC else "off"})')
+
+    captures = PROFILES.slowest()
+    if not captures:
+        st.write("`No profiles captured yet`")
+        return
+    st.dataframe([capture.summary() for capture in captures], hide_index=True)
+    capture = st.selectbox("Capture", captures, format_func=lambda c: f"#{c.id} {c.label} ({c.summary()['ms']} ms)")
+    c1, c2 = st.columns(2)
+    if capture.stats is not None:
+        c1.download_button("Download pstats", data=capture.pstats_bytes(), file_name=f'auth_profile_{capture.id}.pstats',
+                           mime='application/octet-stream')
+    else:
+        c1.download_button("Download collapsed stacks", data=capture.collapsed(), file_name=f'auth_profile_{capture.id}.folded',
+                           mime='text/plain')
+    if c2.button("Clear profiles"):
+        PROFILES.clear()
+        _rerun_auth_ui()
+    st.code(capture.top_functions(), language='text')
+    if capture.allocations:
+        st.caption(f'Top allocations (peak traced memory {capture.summary()["peak_kb"]} KB)')
+        st.dataframe(capture.allocations, hide_index=True)
+
+@requires_auth
+def _show_backups():
+    from .repo.provider.sqlite.backup import snapshot, prune, list_backups, BACKUP_PATH, BACKUP_KEEP
+    st.subheader('Backups')
+    store = _auth.current_store()
+    st.caption(f'Snapshots are taken online and kept in `{BACKUP_PATH}` (newest {BACKUP_KEEP} per database)')
+    c1, c2, c3 = st.columns(3)
+    action = None
+    if c1.button("Snapshot now"):
+        action = dict(mode='backup')
+    if c2.button("Compacted snapshot (VACUUM INTO)"):
+        action = dict(mode='vacuum')
+    if c3.button("Refresh master copy"):
+        action = dict(mode='vacuum', master=True)
+    if action is not None:
+        try:
+            written = snapshot(store, **action)
+        except Exception as ex:
+            st.error(str(ex))
+        else:
+            removed = [] if action.get('master') else prune(store)
+            audit('admin.backup', actor=_actor(), mode=action['mode'], master=action.get('master', False))
+            st.dataframe(written, hide_index=True)
+            if removed:
+                st.write(f"`Pruned {len(removed)} old snapshot(s)`")
+    backups = list_backups(store)
+    if backups:
+        st.dataframe(backups, hide_index=True)
+    else:
+        st.write("`No snapshots yet`")
+
+@_fragment
+@requires_auth
+def _superuser_mode():
+    tenant = f', tenant = {_auth.auth_state.tenant}' if _auth.auth_state.tenant else ''
+    st.header(f'Super user mode (store = {_auth.STORAGE}{tenant})')
+    modes =  {
+        "View": _list_users,
+        "Create": _create_user,
+        "Edit": _edit_user,
+        "Delete": _delete_user,
+        "Metrics": _show_metrics,
+        "Audit": _show_audit_log,
+        "Profiling": _show_profiles,
+    }
+    from .repo.provider.sqlite.backup import supports_backup
+    if supports_backup(_auth.current_store()):
+        modes["Backups"] = _show_backups
+    mode = st.radio("Select mode", modes.keys(), horizontal=True)
+    modes[mode]()
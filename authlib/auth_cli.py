@@ -0,0 +1,461 @@
+"""
+Headless admin command line over the storage providers.
+
+Does what the superuser UI in `admin.py` does (and a few bulk jobs it can't) without
+importing Streamlit, so it starts in milliseconds and can run from cron and scripts:
+
+    python -m st_auth_simple.admin [--storage SQLITE] [--tenant acme] <command> ...
+
+    list          [--search TEXT] [--format text|csv|jsonl]
+    create        USERNAME [--su] [--roles a,b] [--password-stdin]
+    edit          USERNAME [--su | --no-su] [--roles a,b] [--password | --password-stdin]
+    delete        USERNAME ...
+    export        [FILE] [--format jsonl|csv]
+    import        FILE [--format jsonl|csv] [--encrypted]
+    purge-expired [--dry-run]
+    rotate-keys   (re-encrypts passwords with NEW_ENC_PASSWORD/NEW_ENC_NONCE)
+    stats         [--format text|json]
+
+Rows are streamed with `iterate` and written in bulk (`upsert_many`, `update_many`,
+`delete_many`). Changes are audited with actor `cli:<os user>`. Role changes reach
+sessions in running apps at their next login (role epochs are per process).
+"""
+
+import argparse
+import csv
+import datetime
+import getpass
+import json
+import logging
+import os
+import sys
+from collections import Counter
+from os import environ as osenv
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from . import const
+from .common import AppError
+from .common.audit import audit
+from .common.permissions import join_roles, split_roles
+from .repo.provider.conds import is_literal
+
+ENC_PASSWORD = osenv.get('ENC_PASSWORD')
+ENC_NONCE = osenv.get('ENC_NONCE')
+NEW_ENC_PASSWORD = osenv.get('NEW_ENC_PASSWORD')
+NEW_ENC_NONCE = osenv.get('NEW_ENC_NONCE')
+STORAGE = osenv.get('STORAGE', 'SQLITE')
+PENDING_USERS_TABLE = osenv.get('PENDING_USERS_TABLE', 'PENDING_USERS').upper()
+
+# The columns `list` and `export` write (no session tokens)
+USER_COLUMNS = (const.USERNAME, const.PASSWORD, const.SU, const.ROLES, const.LOGINS_COUNT,
+                const.LAST_LOGIN, const.CREATED_AT, const.UPDATED_AT)
+LIST_COLUMNS = tuple(col for col in USER_COLUMNS if col != const.PASSWORD)
+CHUNK_SIZE = 5000
+
+
+class CommandError(Exception):
+    """A command failed in a way the user can fix; printed without a traceback."""
+
+
+def _actor() -> str:
+    return f'cli:{getpass.getuser()}'
+
+
+def _cipher():
+    from .common.crypto import aes256cbcExtended
+    if not ENC_PASSWORD:
+        raise CommandError('ENC_PASSWORD must be set (passwords are encrypted with the app cipher)')
+    return aes256cbcExtended(ENC_PASSWORD, ENC_NONCE)
+
+
+def _chunked(rows: Iterable[dict], size: int = CHUNK_SIZE) -> Iterator[List[dict]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _expired(expires_at, now: datetime.datetime) -> bool:
+    """True if an ISO `expires_at` has passed (values that don't parse count as expired)."""
+    try:
+        return now > datetime.datetime.fromisoformat(expires_at)
+    except (TypeError, ValueError):
+        return True
+
+
+def _read_password(args, prompt: str = 'Password: ') -> Optional[str]:
+    if getattr(args, 'password_stdin', False):
+        password = sys.stdin.readline().rstrip('\n')
+    elif getattr(args, 'password', True):
+        password = getpass.getpass(prompt)
+        if password != getpass.getpass('Repeat password: '):
+            raise CommandError('Passwords do not match')
+    else:
+        return None
+    if not password:
+        raise CommandError('The password must not be empty')
+    return password
+
+
+def _user(store, username: str, fields: str = '*') -> Optional[dict]:
+    rows = store.query({'fields': fields, 'conds': f'{const.USERNAME}="{username}"', 'modifier': 'LIMIT 1'})
+    return rows[0] if rows else None
+
+
+# ------------------------------------------------------------------------------
+# Row writers and readers
+
+def _row_writer(fmt: str, out, columns) -> Callable[[dict], None]:
+    """A function writing one row to `out` as a tab-separated line (text), CSV or a JSON line."""
+    if fmt == 'jsonl':
+        return lambda row: out.write(json.dumps({col: row.get(col) for col in columns}) + '\n')
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        return writer.writerow
+    out.write('\t'.join(columns) + '\n')
+    return lambda row: out.write('\t'.join('' if row.get(col) is None else str(row.get(col)) for col in columns) + '\n')
+
+
+def _read_rows(path: str, fmt: Optional[str]) -> Iterator[dict]:
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+    try:
+        if fmt == 'csv':
+            yield from csv.DictReader(stream)
+        else:
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+# ------------------------------------------------------------------------------
+# Commands
+
+def cmd_list(store, args) -> int:
+    search = (args.search or '').lower()
+    write = _row_writer(args.format, sys.stdout, LIST_COLUMNS)
+    count = 0
+    for row in store.iterate({'fields': ', '.join(LIST_COLUMNS), 'sort': [const.USERNAME]}):
+        if search and search not in row[const.USERNAME].lower():
+            continue
+        write(row)
+        count += 1
+    if args.format == 'text':
+        print(f'{count} users', file=sys.stderr)
+    return 0
+
+
+def cmd_create(store, args) -> int:
+    if _user(store, args.username, const.USERNAME):
+        raise CommandError(f'User `{args.username}` already exists (use `edit`)')
+    password = _read_password(args)
+    now = datetime.datetime.now().isoformat()
+    roles = join_roles(split_roles(args.roles))
+    su = 1 if args.su else 0
+    store.upsert({'data': {
+        const.USERNAME: args.username, const.PASSWORD: _cipher().encrypt(password), const.SU: su,
+        const.ROLES: roles, const.LOGINS_COUNT: 0, const.CREATED_AT: now, const.UPDATED_AT: now,
+    }})
+    audit('admin.create_user', username=args.username, actor=_actor(), su=su, roles=roles)
+    print(f'Created {args.username}')
+    return 0
+
+
+def cmd_edit(store, args) -> int:
+    data = {const.USERNAME: args.username}
+    password = _read_password(args, 'New password: ')
+    if password:
+        data[const.PASSWORD] = _cipher().encrypt(password)
+    if args.su is not None:
+        data[const.SU] = 1 if args.su else 0
+    if args.roles is not None:
+        data[const.ROLES] = join_roles(split_roles(args.roles))
+    if len(data) == 1:
+        raise CommandError('Nothing to change (give --password, --su/--no-su or --roles)')
+    data[const.UPDATED_AT] = datetime.datetime.now().isoformat()
+    # Only the given columns change; session and login tracking columns are kept
+    if not store.update({'data': data}):
+        raise CommandError(f'No user `{args.username}`')
+    audit('admin.edit_user', username=args.username, actor=_actor(), su=data.get(const.SU),
+          roles=data.get(const.ROLES), password_changed=bool(password))
+    print(f'Updated {args.username}')
+    return 0
+
+
+def cmd_delete(store, args) -> int:
+    # Only users that exist are deleted, counted and audited; the rest are named on stderr
+    requested = list(dict.fromkeys(args.usernames))
+    found = [username for username in requested if is_literal(username) and _user(store, username, const.USERNAME)]
+    deleted = store.delete_many({'usernames': found}) if found else 0
+    for username in found:
+        audit('admin.delete_user', username=username, actor=_actor())
+    missing = [username for username in requested if username not in found]
+    if missing:
+        print(f'No user {", ".join(f"`{username}`" for username in missing)}', file=sys.stderr)
+    print(f'Deleted {deleted} user(s)')
+    return 1 if missing else 0
+
+
+def cmd_export(store, args) -> int:
+    out = sys.stdout if args.file in (None, '-') else open(args.file, 'w', newline='', encoding='utf-8')
+    try:
+        write = _row_writer(args.format, out, USER_COLUMNS)
+        count = 0
+        for row in store.iterate({'fields': ', '.join(USER_COLUMNS), 'sort': [const.USERNAME]}):
+            write(row)
+            count += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    audit('admin.export_users', actor=_actor(), count=count)
+    print(f'Exported {count} users', file=sys.stderr)
+    return 0
+
+
+def _import_rows(rows: List[dict], encrypted: bool, now: str) -> List[dict]:
+    from .repo.synthetic import encrypt_passwords
+    for row in rows:
+        if not row.get(const.USERNAME) or not row.get(const.PASSWORD):
+            raise CommandError(f'Every row needs a username and a password: {row.get(const.USERNAME)!r}')
+    if not encrypted:
+        # Each distinct password is encrypted once, on one process per CPU for large files
+        plain = sorted({row[const.PASSWORD] for row in rows})
+        ciphertexts = dict(zip(plain, encrypt_passwords(plain, enc_password=ENC_PASSWORD, enc_nonce=ENC_NONCE)))
+    imported = []
+    for row in rows:
+        imported.append({
+            const.USERNAME: row[const.USERNAME],
+            const.PASSWORD: row[const.PASSWORD] if encrypted else ciphertexts[row[const.PASSWORD]],
+            const.SU: int(row.get(const.SU) or 0),
+            const.ROLES: join_roles(split_roles(row.get(const.ROLES))),
+            const.LOGINS_COUNT: int(row.get(const.LOGINS_COUNT) or 0),
+            const.LAST_LOGIN: row.get(const.LAST_LOGIN) or None,
+            const.CREATED_AT: row.get(const.CREATED_AT) or now,
+            const.UPDATED_AT: now,
+        })
+    return imported
+
+
+def cmd_import(store, args) -> int:
+    now = datetime.datetime.now().isoformat()
+    count = 0
+    for chunk in _chunked(_read_rows(args.file, args.format), args.chunk_size):
+        store.upsert_many({'rows': _import_rows(chunk, args.encrypted, now)})
+        count += len(chunk)
+    audit('admin.import_users', actor=_actor(), count=count, encrypted=args.encrypted)
+    print(f'Imported {count} users')
+    return 0
+
+
+def cmd_purge_expired(store, args) -> int:
+    now = datetime.datetime.now()
+    sessions = [
+        {const.USERNAME: row[const.USERNAME], const.AUTH_TOKEN: None, const.EXPIRES_AT: None}
+        for row in store.iterate({'fields': f'{const.USERNAME}, {const.AUTH_TOKEN}, {const.EXPIRES_AT}'})
+        if row.get(const.AUTH_TOKEN) and _expired(row.get(const.EXPIRES_AT), now)
+    ]
+    pending = [
+        row[const.USERNAME]
+        for row in _optional_table(store, {'table': PENDING_USERS_TABLE, 'fields': f'{const.USERNAME}, {const.EXPIRES_AT}'})
+        if _expired(row.get(const.EXPIRES_AT), now)
+    ]
+    purged_pending = len(pending)
+    if not args.dry_run:
+        for chunk in _chunked(sessions, args.chunk_size):
+            store.update_many({'rows': chunk})
+        purged_pending = sum(
+            store.delete_many({'table': PENDING_USERS_TABLE, 'usernames': chunk}) for chunk in _chunked(pending, args.chunk_size)
+        )
+        audit('admin.purge_expired', actor=_actor(), sessions=len(sessions), pending=purged_pending)
+    print(f'{"Would purge" if args.dry_run else "Purged"} {len(sessions)} expired session(s) '
+          f'and {purged_pending} expired pending sign-up(s)')
+    return 0
+
+
+def _optional_table(store, context: dict) -> Iterator[dict]:
+    """Rows of a table that may not exist (PENDING_USERS is only created when sign-up is enabled)."""
+    try:
+        yield from store.iterate(context)
+    except Exception as ex:
+        logging.info(f'Skipping table `{context["table"]}`: {ex}')
+
+
+def _round_trips(cipher, ciphertext: str) -> bool:
+    """True if `ciphertext` was encrypted with `cipher`'s key (the cipher is deterministic)."""
+    try:
+        return cipher.encrypt(cipher.decrypt(ciphertext)) == ciphertext
+    except (ValueError, TypeError):
+        return False
+
+
+def _reencrypt(rows: Iterable[dict], old, new, new_password: str, new_nonce: str) -> Tuple[List[dict], int]:
+    """
+    Rows of {username, password} re-encrypted under the new key, and the count of rows
+    already under it (left as they are, so a rerun finishes an interrupted rotation).
+    """
+    from .repo.synthetic import encrypt_passwords
+    plain, rotated = {}, 0
+    for row in rows:
+        if _round_trips(old, row[const.PASSWORD]):
+            plain[row[const.USERNAME]] = old.decrypt(row[const.PASSWORD])
+        elif _round_trips(new, row[const.PASSWORD]):
+            rotated += 1
+        else:
+            raise CommandError(f'Password of `{row[const.USERNAME]}` decrypts with neither ENC_PASSWORD/ENC_NONCE '
+                               'nor NEW_ENC_PASSWORD/NEW_ENC_NONCE; nothing was changed')
+    distinct = sorted(set(plain.values()))
+    ciphertexts = dict(zip(distinct, encrypt_passwords(distinct, enc_password=new_password, enc_nonce=new_nonce)))
+    return [{const.USERNAME: username, const.PASSWORD: ciphertexts[password]} for username, password in plain.items()], rotated
+
+
+def cmd_rotate_keys(store, args) -> int:
+    from .common.crypto import aes256cbcExtended
+    if not NEW_ENC_PASSWORD:
+        raise CommandError('Set NEW_ENC_PASSWORD (and NEW_ENC_NONCE) to the new password key')
+    old, new = _cipher(), aes256cbcExtended(NEW_ENC_PASSWORD, NEW_ENC_NONCE)
+    fields = f'{const.USERNAME}, {const.PASSWORD}'
+    # Everything is decrypted and re-encrypted before the first write
+    users, users_rotated = _reencrypt(store.iterate({'fields': fields}), old, new, NEW_ENC_PASSWORD, NEW_ENC_NONCE)
+    pending, pending_rotated = _reencrypt(_optional_table(store, {'table': PENDING_USERS_TABLE, 'fields': fields}),
+                                          old, new, NEW_ENC_PASSWORD, NEW_ENC_NONCE)
+    # One update_many per table: a single transaction on the SQL providers. A failure part-way
+    # (between the tables, or on Airtable) leaves rows under either key; rerunning finishes them.
+    for table, rows in (('USERS', users), (PENDING_USERS_TABLE, pending)):
+        if rows:
+            store.update_many({'table': table, 'rows': rows})
+    audit('admin.rotate_keys', actor=_actor(), users=len(users), pending=len(pending),
+          already_rotated=users_rotated + pending_rotated)
+    print(f'Re-encrypted {len(users)} user and {len(pending)} pending passwords'
+          f'{f" ({users_rotated + pending_rotated} already under the new key)" if users_rotated + pending_rotated else ""}. '
+          'Set ENC_PASSWORD/ENC_NONCE to the new values and restart the apps.')
+    return 0
+
+
+def cmd_stats(store, args) -> int:
+    now = datetime.datetime.now()
+    stats = Counter(users=0, superusers=0, live_sessions=0, expired_sessions=0, logins=0)
+    roles = Counter()
+    fields = f'{const.USERNAME}, {const.SU}, {const.ROLES}, {const.AUTH_TOKEN}, {const.EXPIRES_AT}, {const.LOGINS_COUNT}'
+    for row in store.iterate({'fields': fields}):
+        stats['users'] += 1
+        stats['superusers'] += row.get(const.SU) == 1
+        stats['logins'] += int(row.get(const.LOGINS_COUNT) or 0)
+        if row.get(const.AUTH_TOKEN):
+            stats['expired_sessions' if _expired(row.get(const.EXPIRES_AT), now) else 'live_sessions'] += 1
+        roles.update(split_roles(row.get(const.ROLES)))
+    stats['pending_signups'] = stats['expired_pending_signups'] = 0
+    for row in _optional_table(store, {'table': PENDING_USERS_TABLE, 'fields': f'{const.USERNAME}, {const.EXPIRES_AT}'}):
+        stats['pending_signups'] += 1
+        stats['expired_pending_signups'] += _expired(row.get(const.EXPIRES_AT), now)
+
+    result = {**stats, **{f'role.{role}': count for role, count in sorted(roles.items())}}
+    if hasattr(store, 'pool_stats'):
+        result.update({f'pool.{key}': value for key, value in store.pool_stats().items()})
+    if args.format == 'json':
+        print(json.dumps(result, indent=2))
+    else:
+        print('\n'.join(f'{key}={value}' for key, value in result.items()))
+    return 0
+
+
+# ------------------------------------------------------------------------------
+# Entry point
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m st_auth_simple.admin', description='Headless st-auth-simple admin')
+    parser.add_argument('--storage', default=STORAGE)
+    parser.add_argument('--tenant', default=None, help='manage a tenant store (see the TENANT_* settings)')
+    parser.add_argument('--allow-db-create', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('list', help='list users')
+    cmd.add_argument('--search', help='case-insensitive username substring')
+    cmd.add_argument('--format', choices=('text', 'csv', 'jsonl'), default='text')
+    cmd.set_defaults(run=cmd_list)
+
+    cmd = commands.add_parser('create', help='create a user (prompts for the password)')
+    cmd.add_argument('username')
+    cmd.add_argument('--su', action='store_true', help='make a superuser')
+    cmd.add_argument('--roles', default='', help='comma-separated role names')
+    cmd.add_argument('--password-stdin', action='store_true', help='read the password from stdin')
+    cmd.set_defaults(run=cmd_create)
+
+    cmd = commands.add_parser('edit', help="change a user's password, superuser flag or roles")
+    cmd.add_argument('username')
+    cmd.add_argument('--su', dest='su', action='store_true', default=None)
+    cmd.add_argument('--no-su', dest='su', action='store_false')
+    cmd.add_argument('--roles', default=None, help="comma-separated role names ('' clears them)")
+    password = cmd.add_mutually_exclusive_group()
+    password.add_argument('--password', action='store_true', help='prompt for a new password')
+    password.add_argument('--password-stdin', action='store_true', help='read the new password from stdin')
+    cmd.set_defaults(run=cmd_edit)
+
+    cmd = commands.add_parser('delete', help='delete users')
+    cmd.add_argument('usernames', nargs='+')
+    cmd.set_defaults(run=cmd_delete)
+
+    cmd = commands.add_parser('export', help='write users (encrypted passwords, no session tokens) to a file')
+    cmd.add_argument('file', nargs='?', help="output file (default: stdout)")
+    cmd.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl')
+    cmd.set_defaults(run=cmd_export)
+
+    cmd = commands.add_parser('import', help='create or replace users from a JSONL or CSV file')
+    cmd.add_argument('file', help="input file ('-': stdin)")
+    cmd.add_argument('--format', choices=('jsonl', 'csv'), default=None, help='default: from the file extension')
+    cmd.add_argument('--encrypted', action='store_true', help='passwords are already encrypted (an `export` file)')
+    cmd.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    cmd.set_defaults(run=cmd_import)
+
+    cmd = commands.add_parser('purge-expired', help='clear expired session tokens and delete expired pending sign-ups')
+    cmd.add_argument('--dry-run', action='store_true')
+    cmd.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    cmd.set_defaults(run=cmd_purge_expired)
+
+    cmd = commands.add_parser('rotate-keys', help='re-encrypt passwords from ENC_PASSWORD/ENC_NONCE to NEW_ENC_PASSWORD/NEW_ENC_NONCE '
+                                                   '(one update per table; rows already under the new key are skipped, '
+                                                   'so rerun it to finish an interrupted rotation)')
+    cmd.set_defaults(run=cmd_rotate_keys)
+
+    cmd = commands.add_parser('stats', help='user, session, role and pending sign-up counts')
+    cmd.add_argument('--format', choices=('text', 'json'), default='text')
+    cmd.set_defaults(run=cmd_stats)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = _parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    store = None
+    try:
+        if args.tenant:
+            from .repo.registry import tenant_provider
+            store = tenant_provider(args.tenant, args.storage)
+        else:
+            from .repo.registry import default_provider
+            store = default_provider(args.storage, allow_db_create=args.allow_db_create)
+        return args.run(store, args)
+    except CommandError as ex:
+        print(f'error: {ex}', file=sys.stderr)
+        return 1
+    except AppError as ex:
+        print(f'error: {ex.error.get("code")}: {ex.error.get("message") or ex.error.get("description")}', file=sys.stderr)
+        return 2
+    except BrokenPipeError:
+        # Output piped into `head` and friends; stop quietly
+        sys.stdout = open(os.devnull, 'w')
+        return 0
+    finally:
+        if store is not None:
+            store.close_database()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,346 @@
+"""
+Standalone auth service shared by several Streamlit apps.
+
+Runs one storage provider (with its write-behind buffers, caches and connection pools)
+behind a small JSON-over-HTTP API, so apps using `STORAGE='REMOTE'` share it instead of
+each opening the store themselves. Streamlit-free; start it with
+
+    python -m authlib.auth_service [--host 127.0.0.1] [--port 8765] [--storage SQLITE]
+
+Every request is a POST with a JSON body (GET for /healthz and /metrics). Connections
+are kept alive (HTTP/1.1). If AUTH_SERVICE_KEY is set, requests must carry
+`Authorization: Bearer <AUTH_SERVICE_KEY>`; without a key the service only listens on
+loopback. The storage endpoints accept raw provider contexts, so only expose the service
+to trusted apps. Usernames, emails and tokens containing quotes, backslashes or control
+characters are rejected (400) before they reach a query.
+
+    /v1/login            {username, password, remember_me, client} -> {user, token}
+    /v1/session/validate {token, renew}                            -> {user}
+    /v1/logout           {token}                                   -> {cleared}
+    /v1/signup           {email, password, client}                 -> {sent}
+    /v1/signup/verify    {email, pin, client}                      -> {user, token}
+    /v1/storage/<op>     {context} (query, upsert, update, ...)    -> {result}
+
+Each body may name a `tenant`, whose store is then taken from the provider registry.
+"""
+
+import argparse
+import ipaddress
+import json
+import logging
+import re
+import time
+from collections.abc import Mapping
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ as osenv
+from typing import Optional
+
+from . import const
+from .auth_session import AuthSession
+from .common import AppError
+from .common.audit import audit
+from .common.metrics import METRICS, provider_label
+from .common.rate_limiter import LoginThrottle
+from .common.user_record import LOGIN_FIELDS, principal
+from .repo.provider.conds import is_literal
+from .repo.registry import REGISTRY, default_provider
+
+AUTH_SERVICE_HOST = osenv.get('AUTH_SERVICE_HOST', '127.0.0.1')
+AUTH_SERVICE_PORT = int(osenv.get('AUTH_SERVICE_PORT', '8765'))
+AUTH_SERVICE_KEY = osenv.get('AUTH_SERVICE_KEY')
+STORAGE = osenv.get('STORAGE', 'SQLITE')
+
+# Provider calls a client may make through /v1/storage/<op>
+STORAGE_OPS = ('query', 'upsert', 'delete', 'upsert_many', 'delete_many', 'update', 'update_many', 'complete_signup',
+               'tag_session_token')
+
+_EMAIL = re.compile(r'^[^@]+@[^@]+\.[^@]+$')
+
+
+def _checked(value, what: str) -> str:
+    """`value` if it can be quoted into a conds string; request values never reach a query otherwise."""
+    if not is_literal(value):
+        raise _error(f'Invalid {what}', f'The {what} is empty or contains quotes, backslashes or control characters', 400)
+    return value
+
+
+def _is_loopback(host: str) -> bool:
+    """True for localhost and loopback addresses ('' and 0.0.0.0 listen on every interface)."""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _error(code: str, description: str, status: int) -> AppError:
+    return AppError({"code": code, "description": description, "message": description}, status)
+
+
+class AuthService:
+    """
+    The service's operations, independent of HTTP.
+
+    Args:
+        store: Default storage provider. Defaults to a new `STORAGE` provider.
+        registry: Provider registry used for requests that name a tenant.
+    """
+
+    def __init__(self, store=None, storage: str = STORAGE, registry=REGISTRY):
+        self.storage = storage
+        self.store = store if store is not None else default_provider(storage)
+        self.registry = registry
+        self.login_throttle = LoginThrottle()
+        self._signup_budget = None
+        self._cipher = None
+
+    @contextmanager
+    def _tenant_store(self, tenant: Optional[str]):
+        if tenant is None:
+            yield self.store
+            return
+        store = self.registry.acquire(tenant, self.storage)
+        try:
+            yield store
+        finally:
+            self.registry.release(tenant, self.storage)
+
+    def _crypto(self):
+        if self._cipher is None:
+            from .common.crypto import aes256cbcExtended
+            self._cipher = aes256cbcExtended(osenv.get('ENC_PASSWORD'), osenv.get('ENC_NONCE'))
+        return self._cipher
+
+    def _budget(self):
+        if self._signup_budget is None:
+            from .auth_signup import SignupBudget
+            self._signup_budget = SignupBudget()
+        return self._signup_budget
+
+    # --------------------------------------------------------------------------
+    # Sessions
+
+    def login(self, username: str, password: str, remember_me: bool = False, client: str = 'unknown',
+              tenant: Optional[str] = None) -> dict:
+        username = _checked(username, 'username')
+        retry_after = self.login_throttle.check(username, client)
+        if retry_after:
+            audit('login', outcome='throttled', username=username, client=client, retry_after=round(retry_after, 1))
+            raise _error('Throttled', f'Too many failed login attempts. Try again in {int(retry_after) + 1} seconds.', 429)
+
+        with self._tenant_store(tenant) as store:
+            data = store.query({'fields': LOGIN_FIELDS, 'conds': f'username="{username}"'})
+            user = data[0] if data else None
+            if not user or self._crypto().decrypt(user[const.PASSWORD]) != password:
+                outcome = 'bad_password' if user else 'unknown_user'
+                METRICS.inc('auth.login', provider=provider_label(store), outcome=outcome)
+                audit('login', outcome=outcome, username=username, client=client)
+                self.login_throttle.record_failure(username, client)
+                raise _error('Invalid credentials', 'Invalid username or password', 401)
+
+            METRICS.inc('auth.login', provider=provider_label(store), outcome='ok')
+            audit('login', username=username, client=client, remember_me=bool(remember_me))
+            self.login_throttle.record_success(username, client)
+            user = principal(user)
+            AuthSession.record_login(store, user)
+            token = AuthSession.create_session(store, user) if remember_me else None
+            return {'user': user, 'token': token}
+
+    def validate_session(self, token: str, renew: bool = False, tenant: Optional[str] = None) -> dict:
+        token = _checked(token, 'token')
+        with self._tenant_store(tenant) as store:
+            user = AuthSession.validate_session(store, token)
+            if user is None:
+                raise _error('Invalid session', 'Session token is invalid or expired', 401)
+            if renew:
+                AuthSession.renew_session(store, user)
+            return {'user': user}
+
+    def logout(self, token: str, tenant: Optional[str] = None) -> dict:
+        token = _checked(token, 'token')
+        with self._tenant_store(tenant) as store:
+            user = AuthSession.validate_session(store, token)
+            cleared = bool(user) and AuthSession.clear_session(store, user[const.USERNAME])
+            if user:
+                audit('logout', outcome='ok' if cleared else 'token_not_cleared', username=user[const.USERNAME])
+            return {'cleared': cleared}
+
+    # --------------------------------------------------------------------------
+    # Sign-up
+
+    def signup(self, email: str, password: str, client: str = 'unknown', tenant: Optional[str] = None) -> dict:
+        from .auth_signup import SignupManager
+        from .common.email_service import EmailService
+
+        if not email or not _EMAIL.match(email) or not password:
+            raise _error('Invalid sign-up', 'A valid email address and a password are required', 400)
+        email = _checked(email, 'email')
+
+        with self._tenant_store(tenant) as store:
+            # Registered emails are refused before they spend the pending-row and email budgets
+            if store.query({'fields': const.USERNAME, 'conds': f'username="{email}"', 'modifier': 'LIMIT 1'}):
+                raise _error('Already registered', 'This email is already registered', 409)
+            retry_after = self._budget().consume('pending', 'email', email=email, client=client)
+            if retry_after:
+                METRICS.inc('signup.budget', outcome='pending_denied')
+                raise _error('Throttled', f'Too many sign-up attempts. Try again in {int(retry_after) + 1} seconds.', 429)
+            pin = SignupManager.create_pending_user(store, email, self._crypto().encrypt(password))
+        return {'sent': EmailService.send_signup_pin(email, pin)}
+
+    def verify_signup(self, email: str, pin: str, client: str = 'unknown', tenant: Optional[str] = None) -> dict:
+        from .auth_signup import SignupManager
+
+        email = _checked(email, 'email')
+        retry_after = self._budget().consume('pin', email=email, client=client)
+        if retry_after:
+            METRICS.inc('signup.budget', outcome='pin_denied')
+            raise _error('Throttled', f'Too many verification attempts. Try again in {int(retry_after) + 1} seconds.', 429)
+
+        with self._tenant_store(tenant) as store:
+            user, error_msg = SignupManager.complete_signup(store, email, pin)
+            if not user:
+                if error_msg == SignupManager.ERRORS['error']:
+                    raise _error('Sign-up failed', error_msg, 500)
+                raise _error('Invalid PIN', error_msg, 400)
+            user = principal(user)
+            AuthSession.record_login(store, user)
+            return {'user': user, 'token': AuthSession.create_session(store, user) or None}
+
+    # --------------------------------------------------------------------------
+    # Storage passthrough (used by RemoteProvider)
+
+    def call_provider(self, op: str, context: dict = None, tenant: Optional[str] = None) -> dict:
+        if op not in STORAGE_OPS:
+            raise _error('Unknown operation', f'Unknown storage operation `{op}`', 404)
+        with self._tenant_store(tenant) as store:
+            if op == 'tag_session_token':
+                return {'result': store.tag_session_token(context['username'], context['token'])}
+            result = getattr(store, op)(context=context)
+            if op == 'query':
+                # Column names once, then value lists (rows of one query share their columns)
+                columns = list(result[0].keys()) if result else []
+                return {'columns': columns, 'rows': [[row.get(col) for col in columns] for row in result]}
+            return {'result': result}
+
+    def dispatch(self, path: str, body: dict) -> dict:
+        tenant = body.pop('tenant', None)
+        if path.startswith('/v1/storage/'):
+            return self.call_provider(path[len('/v1/storage/'):], body.get('context'), tenant=tenant)
+        handler = {
+            '/v1/login': self.login,
+            '/v1/session/validate': self.validate_session,
+            '/v1/logout': self.logout,
+            '/v1/signup': self.signup,
+            '/v1/signup/verify': self.verify_signup,
+        }.get(path)
+        if handler is None:
+            raise _error('Not found', f'No endpoint `{path}`', 404)
+        return handler(tenant=tenant, **body)
+
+
+def _json_default(obj):
+    return dict(obj) if isinstance(obj, Mapping) else str(obj)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+    service: AuthService = None
+    key: Optional[str] = None
+
+    def log_message(self, format, *args):
+        logging.debug(f'auth service: {format % args}')
+
+    def _send(self, status: int, payload, content_type: str = 'application/json') -> None:
+        body = payload.encode('utf-8') if isinstance(payload, str) else \
+            json.dumps(payload, default=_json_default).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self) -> bool:
+        if not self.key or self.headers.get('Authorization') == f'Bearer {self.key}':
+            return True
+        self._send(401, {'error': {'code': 'Unauthorized', 'description': 'Missing or wrong service key'}})
+        return False
+
+    def do_GET(self):
+        if self.path == '/healthz':
+            self._send(200, {'status': 'ok', 'storage': self.service.storage})
+        elif self.path == '/metrics' and self._authorized():
+            self._send(200, METRICS.render_prometheus(), content_type='text/plain; version=0.0.4')
+        elif self.path != '/metrics':
+            self._send(404, {'error': {'code': 'Not found', 'description': self.path}})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self._authorized():
+            return
+        route = '/v1/storage' if self.path.startswith('/v1/storage/') else self.path
+        try:
+            status, payload = 200, self.service.dispatch(self.path, json.loads(body or b'{}'))
+        except AppError as ex:
+            status, payload = ex.status_code, {'error': ex.error}
+        except (TypeError, ValueError, KeyError, AssertionError) as ex:
+            status, payload = 400, {'error': {'code': 'Bad request', 'description': str(ex)}}
+        except Exception as ex:
+            logging.exception(f'auth service: {self.path} failed')
+            status, payload = 500, {'error': {'code': type(ex).__name__, 'description': str(ex)}}
+        METRICS.observe('service.request', time.perf_counter() - start, provider=route,
+                        outcome='ok' if status == 200 else str(status))
+        self._send(status, payload)
+
+
+def serve(host: str = AUTH_SERVICE_HOST, port: int = AUTH_SERVICE_PORT, service: AuthService = None,
+          key: Optional[str] = AUTH_SERVICE_KEY) -> ThreadingHTTPServer:
+    """
+    Create the HTTP server (call `serve_forever()` on it). Port 0 picks a free port.
+
+    The storage endpoints run raw queries, updates and deletes, so a server reachable from
+    other hosts needs a key: without one, only a loopback `host` is accepted.
+    """
+    if not key and not _is_loopback(host):
+        raise ValueError(f'Set AUTH_SERVICE_KEY to serve on `{host}`; without a key the service only listens on loopback')
+    service = service or AuthService()
+    handler = type('AuthServiceHandler', (_Handler,), {'service': service, 'key': key})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    if not key:
+        logging.warning('AUTH_SERVICE_KEY is not set: any local process can call the auth service')
+    return server
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Shared auth service for st-auth-simple apps')
+    parser.add_argument('--host', default=AUTH_SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=AUTH_SERVICE_PORT)
+    parser.add_argument('--storage', default=STORAGE)
+    parser.add_argument('--allow-db-create', action='store_true')
+    args = parser.parse_args(argv)
+    if args.storage == 'REMOTE':
+        parser.error('the service needs a real store, not REMOTE')
+    if not AUTH_SERVICE_KEY and not _is_loopback(args.host):
+        parser.error(f'set AUTH_SERVICE_KEY to listen on {args.host} (without a key only loopback is allowed)')
+
+    logging.basicConfig(level=logging.INFO)
+    service = AuthService(store=default_provider(args.storage, allow_db_create=args.allow_db_create), storage=args.storage)
+    server = serve(args.host, args.port, service)
+    logging.info(f'Auth service ({args.storage}) listening on http://{args.host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        from .common.write_behind import flush_all
+        flush_all()
+        service.store.close_database()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,11 +6,31 @@ No browser cookies, no JavaScript complexity - just clean DB-stored tokens.
 import secrets
 import logging
 import datetime
+from os import environ as osenv
+from typing import Optional
 from . import const
+from .common.metrics import metered
+from .common.write_behind import buffer_for
+from .common.user_record import SESSION_FIELDS, principal
+from .repo.provider.conds import is_literal
+
+
+def _ok_or(failure: str):
+    return lambda result: 'ok' if result else failure
 
 
 class AuthSession:
-    """Manages persistent authentication via server-side tokens stored in DB."""
+    """
+    Manages persistent authentication via server-side tokens stored in DB.
+
+    Sessions slide: once SESSION_RENEW_FRACTION of SESSION_LIFETIME_DAYS has passed,
+    `renew_session` pushes the expiry out to a full lifetime again. Renewals go through
+    the store's write-behind buffer, so many sessions are renewed in one bulk update.
+    """
+
+    LIFETIME_DAYS = float(osenv.get('SESSION_LIFETIME_DAYS', '30'))
+    SLIDING = osenv.get('SESSION_SLIDING', 'True').lower() == 'true'
+    RENEW_FRACTION = float(osenv.get('SESSION_RENEW_FRACTION', '0.5'))
 
     @staticmethod
     def generate_token() -> str:
@@ -18,41 +38,47 @@ class AuthSession:
         return secrets.token_urlsafe(32)
 
     @staticmethod
-    def create_session(store, user: dict, expires_in_days: int = 30) -> str:
+    @metered('session.create', outcome=_ok_or('fail'))
+    def create_session(store, user: dict, expires_in_days: float = None) -> str:
         """
         Create a persistent session for a user.
 
         Args:
             store: Storage provider (SQLite or Airtable)
-            user: User dict from database
-            expires_in_days: Token expiration in days
+            user: User row or principal dict (a dict is updated in place with the new token and expiry)
+            expires_in_days: Token expiration in days (default: SESSION_LIFETIME_DAYS)
 
         Returns:
             Auth token string, or empty string if creation failed
 
         Note: Caller should check for empty string return to detect failure.
         """
-        token = AuthSession.generate_token()
-        expires_at = (datetime.datetime.now() + datetime.timedelta(days=expires_in_days)).isoformat()
+        days = AuthSession.LIFETIME_DAYS if expires_in_days is None else expires_in_days
+        expires_at = (datetime.datetime.now() + datetime.timedelta(days=days)).isoformat()
 
         try:
-            # Update user record with token in DB
+            token = store.tag_session_token(user[const.USERNAME], AuthSession.generate_token())
+            buffer_for(store).discard(user[const.USERNAME], [const.EXPIRES_AT])
+            # Set token columns only; the rest of the user record is left as is
             ctx = {
                 'data': {
                     const.USERNAME: user[const.USERNAME],
-                    const.PASSWORD: user[const.PASSWORD],
-                    const.SU: user[const.SU],
                     const.AUTH_TOKEN: token,
                     const.EXPIRES_AT: expires_at,
                 }
             }
-            store.upsert(context=ctx)
+            if not store.update(context=ctx):
+                raise LookupError('user record not found')
+            if isinstance(user, dict):  # store rows (UserRecord) are read-only
+                user[const.AUTH_TOKEN] = token
+                user[const.EXPIRES_AT] = expires_at
             return token
         except Exception as ex:
             logging.error(f'Failed to create session token for {user.get(const.USERNAME)}: {str(ex)}')
             return ''
 
     @staticmethod
+    @metered('session.validate', outcome=_ok_or('miss'))
     def validate_session(store, token: str):
         """
         Validate a session token and return the user if valid.
@@ -62,19 +88,25 @@ class AuthSession:
             token: Auth token to validate
 
         Returns:
-            User dict if valid, None if invalid/expired
+            Principal dict (see `principal`) if valid, None if invalid/expired
         """
-        if not token:
+        # Tokens come from cookies and requests; one that can't be quoted into conds matches nobody
+        if not is_literal(token):
             return None
 
-        # Query for user with this token
-        ctx = {'fields': "*", 'conds': f"{const.AUTH_TOKEN}=\"{token}\""}
+        # Query for user with this token (session columns only)
+        ctx = {'fields': SESSION_FIELDS, 'conds': f"{const.AUTH_TOKEN}=\"{token}\""}
         data = store.query(context=ctx)
 
         if not data:
             return None
 
-        user = data[0]
+        user = principal(data[0])
+
+        # Overlay a renewal that is still waiting in the write-behind buffer
+        pending = buffer_for(store).pending(user[const.USERNAME])
+        if pending and const.EXPIRES_AT in pending:
+            user[const.EXPIRES_AT] = pending[const.EXPIRES_AT]
 
         # Check if token has expired
         if const.EXPIRES_AT in user and user[const.EXPIRES_AT]:
@@ -90,6 +122,7 @@ class AuthSession:
         return user
 
     @staticmethod
+    @metered('session.clear', outcome=_ok_or('fail'))
     def clear_session(store, username: str) -> bool:
         """
         Clear the session token for a user (on logout).
@@ -104,23 +137,16 @@ class AuthSession:
         Note: Called during logout. Failure means token remains in DB (security concern).
         """
         try:
-            # Query for user to get their data
-            ctx = {'fields': "*", 'conds': f"{const.USERNAME}=\"{username}\""}
-            data = store.query(context=ctx)
-
-            if data:
-                user = data[0]
-                # Update user record, clearing the token
-                ctx = {
-                    'data': {
-                        const.USERNAME: user[const.USERNAME],
-                        const.PASSWORD: user[const.PASSWORD],
-                        const.SU: user[const.SU],
-                        const.AUTH_TOKEN: None,
-                        const.EXPIRES_AT: None,
-                    }
+            # A buffered renewal must not resurrect the expiry after logout
+            buffer_for(store).discard(username, [const.EXPIRES_AT])
+            ctx = {
+                'data': {
+                    const.USERNAME: username,
+                    const.AUTH_TOKEN: None,
+                    const.EXPIRES_AT: None,
                 }
-                store.upsert(context=ctx)
+            }
+            if store.update(context=ctx):
                 return True
             else:
                 logging.warning(f'User {username} not found when clearing session')
@@ -128,3 +154,52 @@ class AuthSession:
         except Exception as ex:
             logging.error(f'Failed to clear session token for {username}: {str(ex)}')
             return False
+
+    @staticmethod
+    def renewal_due(user: dict, now: datetime.datetime = None) -> bool:
+        """True if the user's session is live and past the renewal point of its lifetime."""
+        if not AuthSession.SLIDING or not user.get(const.AUTH_TOKEN) or not user.get(const.EXPIRES_AT):
+            return False
+        try:
+            expires_at = datetime.datetime.fromisoformat(user[const.EXPIRES_AT])
+        except (ValueError, TypeError):
+            return False
+        now = now or datetime.datetime.now()
+        lifetime = datetime.timedelta(days=AuthSession.LIFETIME_DAYS)
+        return now < expires_at <= now + lifetime * (1 - AuthSession.RENEW_FRACTION)
+
+    @staticmethod
+    @metered('session.renew', outcome=_ok_or('skip'))
+    def renew_session(store, user: dict, now: datetime.datetime = None) -> Optional[datetime.datetime]:
+        """
+        Slide the session expiry forward if renewal is due.
+
+        The new expiry is queued in the store's write-behind buffer (coalesced with other
+        sessions' renewals) and set on `user` in place.
+
+        Returns:
+            The new expiry if the session was renewed, else None (nothing changed)
+        """
+        now = now or datetime.datetime.now()
+        if not AuthSession.renewal_due(user, now):
+            return None
+        expires_at = now + datetime.timedelta(days=AuthSession.LIFETIME_DAYS)
+        buffer_for(store).put(user[const.USERNAME], {const.EXPIRES_AT: expires_at.isoformat()})
+        if isinstance(user, dict):
+            user[const.EXPIRES_AT] = expires_at.isoformat()
+        return expires_at
+
+    @staticmethod
+    def record_login(store, user: dict) -> None:
+        """
+        Count a login (form, auto-login or sign-up) without a synchronous write.
+
+        `logins_count` and `last_login` are coalesced per user in the store's
+        write-behind buffer. A `user` dict that carries those columns is updated in
+        place so the UI sees them at once (a session principal doesn't carry them).
+        """
+        now = datetime.datetime.now().isoformat()
+        buffer_for(store).put(user[const.USERNAME], {const.LAST_LOGIN: now}, increments={const.LOGINS_COUNT: 1})
+        if isinstance(user, dict) and const.LAST_LOGIN in user:
+            user[const.LAST_LOGIN] = now
+            user[const.LOGINS_COUNT] = (user.get(const.LOGINS_COUNT) or 0) + 1
@@ -9,6 +9,59 @@ from datetime import datetime, timedelta
 from typing import Optional, Tuple
 
 from authlib.common.dt_helpers import dt_from_str
+from authlib.common.audit import audited
+from authlib.common.metrics import metered
+from authlib.common.rate_limiter import make_limiter
+
+
+class SignupBudget:
+    """
+    Per-email, per-client and global budgets for pending-row creation, verification
+    email sends and PIN attempts.
+
+    Budgets are cheap in-memory sliding-window counters (or a shared SQLite file if
+    RATE_LIMIT_DB is set), checked before any storage or network call.
+    """
+
+    WINDOW_SECONDS = float(osenv.get('SIGNUP_BUDGET_WINDOW_SECONDS', '3600'))
+    LIMITS = {
+        # kind: (per email, per client, global) events per window
+        'pending': (int(osenv.get('SIGNUP_PENDING_PER_EMAIL', '3')),
+                    int(osenv.get('SIGNUP_PENDING_PER_CLIENT', '10')),
+                    int(osenv.get('SIGNUP_PENDING_GLOBAL', '500'))),
+        'email': (int(osenv.get('SIGNUP_EMAILS_PER_EMAIL', '5')),
+                  int(osenv.get('SIGNUP_EMAILS_PER_CLIENT', '10')),
+                  int(osenv.get('SIGNUP_EMAILS_GLOBAL', '500'))),
+        'pin': (int(osenv.get('SIGNUP_PIN_ATTEMPTS_PER_EMAIL', '10')),
+                int(osenv.get('SIGNUP_PIN_ATTEMPTS_PER_CLIENT', '20')),
+                int(osenv.get('SIGNUP_PIN_ATTEMPTS_GLOBAL', '5000'))),
+    }
+    GLOBAL_KEY = '*'
+
+    def __init__(self):
+        self._limiters = {
+            kind: tuple(
+                make_limiter(f'signup_{kind}_{scope}', limit, self.WINDOW_SECONDS, backoff_seconds=0.0)
+                for scope, limit in zip(('email', 'client', 'global'), limits)
+            )
+            for kind, limits in self.LIMITS.items()
+        }
+
+    def consume(self, *kinds: str, email: str, client: str) -> float:
+        """
+        Spend one unit of each budget in `kinds` for this email and client.
+
+        Nothing is spent unless every budget has room. Returns 0.0 on success, or
+        the seconds until the tightest budget frees up.
+        """
+        keys = ((email or '').strip().lower(), client, SignupBudget.GLOBAL_KEY)
+        checks = [(limiter, key) for kind in kinds for limiter, key in zip(self._limiters[kind], keys)]
+        retry_after = max(limiter.retry_after(key) for limiter, key in checks)
+        if retry_after:
+            return retry_after
+        for limiter, key in checks:
+            limiter.hit(key)
+        return 0.0
 
 
 class SignupManager:
@@ -16,6 +69,7 @@ class SignupManager:
 
     PENDING_USERS_TABLE = osenv.get('PENDING_USERS_TABLE', 'PENDING_USERS').upper()
     PIN_EXPIRY_MINUTES = int(osenv.get('SIGNUP_PIN_EXPIRY_MINUTES', '30'))
+    PIN_MAX_ATTEMPTS = int(osenv.get('SIGNUP_PIN_MAX_ATTEMPTS', '5'))
     ENC_PASSWORD = osenv.get('ENC_PASSWORD')
     ENC_NONCE = osenv.get('ENC_NONCE')
 
@@ -26,6 +80,8 @@ class SignupManager:
         return str(pin_number).zfill(6)
 
     @staticmethod
+    @metered('signup.create_pending')
+    @audited('signup.create_pending')
     def create_pending_user(store, email: str, encrypted_password: str) -> str:
         """
         Create a pending user entry with a validation PIN.
@@ -56,12 +112,46 @@ class SignupManager:
                 'validation_pin': pin,
                 'is_validated': 0,
                 'expires_at': expires_at,
+                'pin_attempts': 0,
+            }
+        })
+
+        return pin
+
+    @staticmethod
+    def _save_pending_user(store, user: dict, **changes) -> None:
+        """Rewrite a pending user row with `changes` applied (upsert replaces the whole row)."""
+        store.upsert({
+            'table': SignupManager.PENDING_USERS_TABLE,
+            'data': {
+                'username': user['username'],
+                'password': user['password'],
+                'validation_pin': changes.get('validation_pin', user.get('validation_pin')),
+                'is_validated': changes.get('is_validated', user.get('is_validated') or 0),
+                'expires_at': changes.get('expires_at', user.get('expires_at')),
+                'pin_attempts': changes.get('pin_attempts', user.get('pin_attempts') or 0),
             }
         })
 
+    @staticmethod
+    @metered('signup.regenerate_pin', outcome=lambda pin: 'ok' if pin else 'miss')
+    @audited('signup.regenerate_pin', outcome=lambda pin: 'ok' if pin else 'miss')
+    def regenerate_pin(store, email: str) -> Optional[str]:
+        """
+        Issue a new PIN for an existing pending signup, keeping its expiry and attempt count.
+
+        Returns:
+            New PIN string, or None if no pending signup exists
+        """
+        user = SignupManager.get_pending_user(store, email)
+        if not user:
+            return None
+        pin = SignupManager.generate_pin()
+        SignupManager._save_pending_user(store, user, validation_pin=pin)
         return pin
 
     @staticmethod
+    @metered('signup.get_pending', outcome=lambda user: 'ok' if user else 'miss')
     def get_pending_user(store, email: str) -> Optional[dict]:
         """
         Retrieve a pending user by email.
@@ -76,122 +166,93 @@ class SignupManager:
         })
         return result[0] if result else None
 
+    # Messages for the outcomes of StorageProvider.complete_signup
+    ERRORS = {
+        'missing': 'No pending sign-up found for this email.',
+        'expired': 'PIN has expired. Please sign up again.',
+        'validated': 'This sign-up has already been completed.',
+        'attempts': 'Too many incorrect codes. Please sign up again.',
+        'mismatch': 'Invalid PIN. Please try again.',
+        'registered': 'This email is already registered.',
+        'error': 'Failed to complete signup. Please try again.',
+    }
+
     @staticmethod
+    @metered('signup.validate_pin', outcome=lambda result: 'ok' if result[0] else 'rejected')
+    @audited('signup.validate_pin', outcome=lambda result: 'ok' if result[0] else 'rejected')
     def validate_pin(store, email: str, pin: str) -> Tuple[bool, str]:
         """
-        Validate a PIN for a pending user.
-
-        Args:
-            store: Storage provider instance
-            email: User's email
-            pin: PIN to validate
+        Check a PIN for a pending user without completing the sign-up (a wrong PIN still
+        counts an attempt). `complete_signup` checks the PIN itself.
 
         Returns:
             (success: bool, error_message: str)
         """
-        # First clean up any expired rows
-        SignupManager.cleanup_expired(store)
-
         user = SignupManager.get_pending_user(store, email)
-        if not user:
-            return False, 'No pending sign-up found for this email.'
-
-        # Check if already validated (should not happen, but safeguard)
-        if user.get('is_validated', 0):
-            return False, 'This sign-up has already been completed.'
-
-        # Check PIN matches
-        if user.get('validation_pin') != pin:
-            return False, 'Invalid PIN. Please try again.'
-
-        # Check expiration
-        try:
-            expires_at = dt_from_str(user.get('expires_at'), format='%Y-%m-%dT%H:%M:%S.%f')
-            if datetime.now() > expires_at:
-                return False, 'PIN has expired. Please sign up again.'
-        except (ValueError, TypeError):
-            return False, 'PIN has expired. Please sign up again.'
-
-        return True, ''
+        outcome = store.signup_outcome(user, pin, SignupManager.PIN_MAX_ATTEMPTS)
+        if outcome == 'mismatch':
+            store.update({'table': SignupManager.PENDING_USERS_TABLE, 'data': {'username': email},
+                          'increment': {'pin_attempts': 1}})
+        return outcome == 'ok', SignupManager.ERRORS.get(outcome, '')
 
     @staticmethod
-    def complete_signup(store, email: str) -> Optional[dict]:
+    @metered('signup.complete', outcome=lambda result: 'ok' if result[0] else 'rejected')
+    @audited('signup.complete', outcome=lambda result: 'ok' if result[0] else 'rejected')
+    def complete_signup(store, email: str, pin: str) -> Tuple[Optional[dict], str]:
         """
-        Complete a pending signup by moving user to main users table.
+        Verify the PIN and move the pending user to the main users table.
 
-        This operation is atomic: both upsert and delete must succeed.
-        If delete fails, the pending record remains in the DB as a cleanup marker.
+        One provider operation (`store.complete_signup`): a single transaction on the SQL
+        providers, so the user is either created and the pending row removed, or nothing
+        changes. A wrong PIN counts an attempt; an expired sign-up is deleted.
 
         Args:
             store: Storage provider instance
             email: User's email
+            pin: PIN to validate
 
         Returns:
-            User dict (for auto-login) or None if signup not found, invalid, or DB operation fails
+            (user dict for auto-login or None, error_message)
         """
-        user = SignupManager.get_pending_user(store, email)
-        if not user:
-            return None
-
+        now = datetime.now().isoformat()
         try:
-            # Move to users table
-            store.upsert({
-                'table': 'USERS',
-                'data': {
-                    'username': email,
-                    'password': user['password'],
-                    'su': 0,
-                }
-            })
-        except Exception as ex:
-            logging.error(f'Failed to create user {email} in signup completion: {str(ex)}')
-            return None
-
-        try:
-            # Delete from pending users
-            store.delete({
+            result = store.complete_signup({
                 'table': SignupManager.PENDING_USERS_TABLE,
-                'conds': f'username="{email}"',
+                'users_table': 'USERS',
+                'username': email,
+                'pin': pin,
+                'max_attempts': SignupManager.PIN_MAX_ATTEMPTS,
+                'data': {'su': 0, 'logins_count': 0, 'created_at': now, 'updated_at': now},
             })
         except Exception as ex:
-            # Log but don't fail - user is already created, pending record is just cleanup
-            logging.warning(f'Failed to delete pending user {email}: {str(ex)}. User created but pending record remains.')
-
-        # Return user dict for auto-login (matching the structure returned by query)
-        return {
-            'username': email,
-            'password': user['password'],
-            'su': 0,
-        }
+            logging.error(f'Failed to complete signup for {email}: {str(ex)}')
+            return None, SignupManager.ERRORS['error']
+        if result['outcome'] != 'ok':
+            return None, SignupManager.ERRORS.get(result['outcome'], SignupManager.ERRORS['error'])
+        return result['user'], ''
 
     @staticmethod
-    def cleanup_expired(store) -> None:
-        """Delete expired pending user registrations."""
+    @metered('signup.cleanup_expired')
+    def cleanup_expired(store) -> int:
+        """Delete expired pending user registrations (a full scan; run it from a scheduled job). Returns rows deleted."""
         try:
-            # Query all pending users and filter locally
-            all_pending = store.query({
-                'table': SignupManager.PENDING_USERS_TABLE,
-                'fields': '*',
-            })
-
-            if not all_pending:
-                return
-
+            # Stream pending users and keep only the expired usernames, then delete those in bulk
             now = datetime.now()
-            for user in all_pending:
+            expired = []
+            for user in store.iterate({
+                'table': SignupManager.PENDING_USERS_TABLE,
+                'fields': 'username, expires_at',
+            }):
                 try:
-                    expires_at = dt_from_str(user.get('expires_at'), format='%Y-%m-%dT%H:%M:%S.%f')
-                    if now > expires_at:
-                        store.delete({
-                            'table': SignupManager.PENDING_USERS_TABLE,
-                            'conds': f'username="{user.get("username")}"',
-                        })
+                    if now <= dt_from_str(user.get('expires_at'), format='%Y-%m-%dT%H:%M:%S.%f'):
+                        continue
                 except (ValueError, TypeError):
-                    # If we can't parse the date, assume expired and delete
-                    store.delete({
-                        'table': SignupManager.PENDING_USERS_TABLE,
-                        'conds': f'username="{user.get("username")}"',
-                    })
+                    pass  # If we can't parse the date, assume expired and delete
+                expired.append(user.get('username'))
+
+            if not expired:
+                return 0
+            return store.delete_many({'table': SignupManager.PENDING_USERS_TABLE, 'usernames': expired})
         except Exception:
             # Cleanup is opportunistic; don't crash if it fails
-            pass
+            return 0
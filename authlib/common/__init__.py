@@ -2,10 +2,28 @@ from functools import wraps
 
 # Imports
 from .const import *  # noqa: F401, F403
-from .crypto import aes256cbcExtended  # noqa: F401
-from .session_token_manager import SessionTokenManager  # noqa: F401
-from .cookie_manager import CookieManager  # noqa: F401
 from .dt_helpers import tnow_iso, tnow_iso_str, dt_from_str, dt_from_ts, dt_to_str  # noqa: F401
+from .metrics import METRICS, metered  # noqa: F401
+
+# Loaded on first attribute access (see __getattr__) so that importing authlib doesn't pay
+# for pycryptodome or Streamlit's cookie components until they're actually used.
+_LAZY_IMPORTS = {
+    'aes256cbcExtended': '.crypto',
+    'SessionTokenManager': '.session_token_manager',
+    'CookieManager': '.cookie_manager',  # deprecated, use SessionTokenManager
+}
+
+def __getattr__(name):
+    module = _LAZY_IMPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from importlib import import_module
+    value = getattr(import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_IMPORTS))
 
 # Easy inteceptor for tracing
 def trace_activity(fn, trace=True):
@@ -25,4 +43,3 @@ class AppError(Exception):
 class DatabaseError(AppError):
     def __init__(self, error, status_code):
         super().__init__(error, status_code)
-
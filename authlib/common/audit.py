@@ -0,0 +1,315 @@
+"""
+Append-only audit log of authentication events.
+
+`audit(event, ...)` only puts a small dict on a bounded queue; a background thread
+writes queued events in batches to an append-only SQLite table (`AUDIT_LOG='sqlite'`)
+or to size-rotated JSON-lines files (`AUDIT_LOG='jsonl'`). When the queue is full,
+events are either dropped (counted in metrics) or spilled to a side file that the
+writer folds back in once it has caught up (`AUDIT_OVERFLOW='spill'`).
+
+Sinks are opened on the writer thread (creating the parent directory). A sink that
+cannot be opened or written is logged and its events dropped: auditing never makes
+an authentication call fail.
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from functools import wraps
+from os import environ as osenv
+from typing import Callable, List, Optional
+
+from .metrics import METRICS, ERROR
+
+AUDIT_LOG = osenv.get('AUDIT_LOG', '').lower()  # '', 'sqlite' or 'jsonl'
+AUDIT_LOG_PATH = osenv.get('AUDIT_LOG_PATH', '')
+AUDIT_QUEUE_SIZE = int(osenv.get('AUDIT_QUEUE_SIZE', '10000'))
+AUDIT_BATCH_SIZE = int(osenv.get('AUDIT_BATCH_SIZE', '500'))
+AUDIT_FLUSH_SECONDS = float(osenv.get('AUDIT_FLUSH_SECONDS', '1'))
+AUDIT_OVERFLOW = osenv.get('AUDIT_OVERFLOW', 'drop').lower()  # 'drop' or 'spill'
+AUDIT_JSONL_MAX_BYTES = int(osenv.get('AUDIT_JSONL_MAX_BYTES', str(10 * 1024 * 1024)))
+AUDIT_JSONL_BACKUPS = int(osenv.get('AUDIT_JSONL_BACKUPS', '5'))
+
+FIELDS = ('ts', 'event', 'outcome', 'username', 'client', 'actor', 'detail')
+
+
+def _make_parent_dir(path: str) -> None:
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+
+
+class SQLiteAuditSink:
+    """AUDIT_LOG table; triggers reject UPDATE and DELETE so rows can only be appended."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.con = None  # opened by the first write
+
+    def _open(self) -> None:
+        _make_parent_dir(self.path)
+        self.con = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        with self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS AUDIT_LOG (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                             'ts TEXT, event TEXT, outcome TEXT, username TEXT, client TEXT, actor TEXT, detail TEXT)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS AUDIT_LOG_USERNAME ON AUDIT_LOG (username, ts)')
+            for op in ('UPDATE', 'DELETE'):
+                self.con.execute(f"CREATE TRIGGER IF NOT EXISTS AUDIT_LOG_NO_{op} BEFORE {op} ON AUDIT_LOG "
+                                 f"BEGIN SELECT RAISE(ABORT, 'AUDIT_LOG is append-only'); END")
+
+    @staticmethod
+    def _column(event: dict, field: str):
+        value = event.get(field)
+        if value is None or isinstance(value, (str, int, float)):
+            return value
+        return json.dumps(value, default=str) if field == 'detail' else str(value)
+
+    def write(self, events: List[dict]) -> None:
+        if self.con is None:
+            self._open()
+        rows = [tuple(self._column(e, f) for f in FIELDS) for e in events]
+        with self.con:
+            self.con.executemany(f'INSERT INTO AUDIT_LOG ({", ".join(FIELDS)}) VALUES ({", ".join("?" * len(FIELDS))})', rows)
+
+    def recent(self, limit: int = 100) -> List[dict]:
+        """Latest events, newest first (separate read connection, never blocks the writer)."""
+        if not os.path.exists(self.path):
+            return []
+        con = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        try:
+            cur = con.execute(f'SELECT {", ".join(FIELDS)} FROM AUDIT_LOG ORDER BY id DESC LIMIT ?', (limit,))
+            return [dict(zip(FIELDS, row)) for row in cur.fetchall()]
+        finally:
+            con.close()
+
+    def close(self) -> None:
+        if self.con is not None:
+            self.con.close()
+
+
+class JSONLAuditSink:
+    """JSON lines in `path`, rotated to `path.1` ... `path.<backups>` once it exceeds `max_bytes`."""
+
+    def __init__(self, path: str, max_bytes: int = AUDIT_JSONL_MAX_BYTES, backups: int = AUDIT_JSONL_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._file = None  # opened by the first write
+
+    def _rotate(self) -> None:
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def write(self, events: List[dict]) -> None:
+        if self._file is None:
+            _make_parent_dir(self.path)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(''.join(json.dumps(e, default=str) + '\n' for e in events))
+        self._file.flush()
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def recent(self, limit: int = 100) -> List[dict]:
+        """Latest events in the current file, newest first."""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding='utf-8') as f:
+            lines = deque(f, maxlen=limit)
+        return [json.loads(line) for line in reversed(lines) if line.strip()]
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+
+class AuditLog:
+    """
+    Bounded queue plus one background writer thread.
+
+    `emit` never blocks and never raises. The writer takes up to `batch_size` events
+    at a time, waiting at most `flush_seconds` to fill a batch.
+    """
+
+    def __init__(self, sink, queue_size: int = AUDIT_QUEUE_SIZE, batch_size: int = AUDIT_BATCH_SIZE,
+                 flush_seconds: float = AUDIT_FLUSH_SECONDS, overflow: str = AUDIT_OVERFLOW,
+                 spill_path: Optional[str] = None):
+        assert overflow in ('drop', 'spill')
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.overflow = overflow
+        self.spill_path = spill_path or f'{sink.path}.spill'
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._spill_lock = threading.Lock()
+        self._spilled = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+        self._thread.start()
+
+    def emit(self, event: dict) -> None:
+        if self._closed:
+            return
+        try:
+            self._queue.put_nowait(event)
+            return
+        except queue.Full:
+            pass
+        if self.overflow == 'spill':
+            try:
+                with self._spill_lock:
+                    with open(self.spill_path, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(event, default=str) + '\n')
+                    self._spilled = True
+                METRICS.inc('audit.spilled')
+                return
+            except OSError:
+                pass
+        METRICS.inc('audit.dropped')
+
+    def _next_batch(self) -> List[dict]:
+        batch = []
+        deadline = time.monotonic() + self.flush_seconds
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, events: List[dict]) -> None:
+        started = time.perf_counter()
+        try:
+            self.sink.write(events)
+        except Exception as ex:
+            logging.error(f'Audit write of {len(events)} events failed: {str(ex)}')
+            METRICS.inc('audit.write', outcome=ERROR)
+            METRICS.inc('audit.dropped', amount=len(events))
+            return
+        METRICS.observe('audit.write', time.perf_counter() - started)
+        METRICS.inc('audit.events', amount=len(events))
+
+    def _reclaim_spill(self) -> None:
+        """Fold spilled events back into the sink once the queue has drained."""
+        with self._spill_lock:
+            if not self._spilled:
+                return
+            reclaim_path = f'{self.spill_path}.reclaim'
+            os.replace(self.spill_path, reclaim_path)
+            self._spilled = False
+        with open(reclaim_path, encoding='utf-8') as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        for i in range(0, len(events), self.batch_size):
+            self._write(events[i:i + self.batch_size])
+        os.remove(reclaim_path)
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+                for _ in batch:
+                    self._queue.task_done()
+            if self._queue.empty():
+                try:
+                    self._reclaim_spill()
+                except Exception as ex:
+                    logging.error(f'Audit spill reclaim failed: {str(ex)}')
+                if self._closed and not batch:
+                    break
+
+    def flush(self, timeout: float = 5.0) -> None:
+        """Wait (up to `timeout` seconds) until queued events have been written."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Stop accepting events, drain the queue and close the sink."""
+        self._closed = True
+        self._thread.join(timeout)
+        try:
+            self.sink.close()
+        except Exception as ex:
+            logging.error(f'Audit sink close failed: {str(ex)}')
+
+
+_audit_log: Optional[AuditLog] = None
+_audit_log_lock = threading.Lock()
+_audit_log_disabled = False
+
+
+def get_audit_log() -> Optional[AuditLog]:
+    """The process-wide AuditLog configured from the environment (None if AUDIT_LOG is unset)."""
+    global _audit_log, _audit_log_disabled
+    if _audit_log is None and AUDIT_LOG and not _audit_log_disabled:
+        with _audit_log_lock:
+            if _audit_log is None and not _audit_log_disabled:
+                if AUDIT_LOG == 'sqlite':
+                    sink = SQLiteAuditSink(AUDIT_LOG_PATH or os.path.join('db', 'audit.db'))
+                elif AUDIT_LOG == 'jsonl':
+                    sink = JSONLAuditSink(AUDIT_LOG_PATH or os.path.join('db', 'audit.jsonl'))
+                else:
+                    logging.error(f'Unknown AUDIT_LOG `{AUDIT_LOG}` (use sqlite or jsonl); audit log disabled')
+                    _audit_log_disabled = True
+                    return None
+                _audit_log = AuditLog(sink)
+                atexit.register(_audit_log.close)
+    return _audit_log
+
+
+def audit(event: str, outcome: str = 'ok', username: Optional[str] = None, client: Optional[str] = None,
+          actor: Optional[str] = None, **detail) -> None:
+    """Queue an audit event. Never blocks on I/O; a no-op unless AUDIT_LOG is set."""
+    log = get_audit_log()
+    if log is None:
+        return
+    log.emit({
+        'ts': datetime.datetime.now().isoformat(),
+        'event': event,
+        'outcome': outcome,
+        'username': username,
+        'client': client,
+        'actor': actor,
+        'detail': detail or None,
+    })
+
+
+def audited(event: str, outcome: Optional[Callable[[object], str]] = None, username_arg: int = 1):
+    """
+    Decorator emitting `event` after each call of a `(store, email, ...)` static method.
+
+    Args:
+        event: Audit event name, e.g. 'signup.complete'
+        outcome: Optional function mapping the return value to an outcome label.
+            Exceptions are audited as 'error' and re-raised.
+        username_arg: Position of the username/email argument.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            username = args[username_arg] if len(args) > username_arg else kwargs.get('email')
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                audit(event, outcome=ERROR, username=username)
+                raise
+            audit(event, outcome=outcome(result) if outcome else 'ok', username=username)
+            return result
+        return wrapper
+    return decorator
@@ -8,7 +8,9 @@ EXPIRES_AT      = 'expires_at'
 CREATED_AT      = 'created_at'
 ACTIVE          = 'active'
 LOGINS_COUNT    = 'logins_count'
+LAST_LOGIN      = 'last_login'
 SU              = 'su'
+ROLES           = 'roles'
 
 BLANK           = ''
 
@@ -0,0 +1,117 @@
+"""
+Per-run buffer of browser cookie writes.
+
+Cookie sets and deletes are queued in session state, merged per cookie name (the last
+write wins; a set followed by a delete of a cookie the browser never had is dropped)
+and written by a single injected script when the batch is flushed. auth() flushes once
+at the end of each run; outside a batch every operation is flushed straight away.
+"""
+
+import datetime
+import json
+import threading
+from contextlib import contextmanager
+
+import streamlit as st
+
+_STATE_KEY = '_auth_cookie_ops'  # {name: (value, expires_iso) or None for a delete}
+_WRITTEN_KEY = '_auth_cookie_written'  # names set by a flush in this session (st.context.cookies won't show them)
+
+
+class CookieOps:
+    """Queues cookie operations and writes them in one st.html() script block."""
+
+    _local = threading.local()
+
+    @staticmethod
+    def _ops() -> dict:
+        return st.session_state.setdefault(_STATE_KEY, {})
+
+    @staticmethod
+    def _browser_has(name: str) -> bool:
+        if name in st.session_state.get(_WRITTEN_KEY, ()):
+            return True
+        try:
+            return name in st.context.cookies
+        except Exception:
+            return True  # can't tell, so keep the delete
+
+    @staticmethod
+    def set(name: str, value, expires_at=None) -> None:
+        """Queue setting cookie `name` (default expiry: 30 days from now)."""
+        if expires_at is None:
+            expires_at = datetime.datetime.now() + datetime.timedelta(days=30)
+        ops = CookieOps._ops()
+        ops.pop(name, None)  # re-insert so the op keeps the order of the latest write
+        ops[name] = (value, expires_at.isoformat())
+        CookieOps._flush_unless_batching()
+
+    @staticmethod
+    def delete(name: str) -> None:
+        """Queue deleting cookie `name`; cancels a pending set if the browser doesn't have it yet."""
+        ops = CookieOps._ops()
+        ops.pop(name, None)
+        if CookieOps._browser_has(name):
+            ops[name] = None
+        CookieOps._flush_unless_batching()
+
+    @staticmethod
+    def pending(name: str):
+        """`(True, value)` if a write to `name` is queued (value None for a delete), else `(False, None)`."""
+        ops = st.session_state.get(_STATE_KEY, {})
+        if name not in ops:
+            return False, None
+        return True, None if ops[name] is None else ops[name][0]
+
+    @staticmethod
+    def flush() -> int:
+        """Write queued operations in one script block. Returns the number of cookies written."""
+        ops = st.session_state.get(_STATE_KEY)
+        if not ops:
+            return 0
+        writes = [[name, None, None] if op is None else [name, op[0], op[1]] for name, op in ops.items()]
+        script = f"""
+        <script>
+            (function() {{
+                for (const [name, value, expiresAt] of {json.dumps(writes, default=str)}) {{
+                    if (value === null) {{
+                        document.cookie = name + "=; expires=" + new Date(0).toUTCString() + "; path=/; SameSite=Lax";
+                        continue;
+                    }}
+                    const expires = expiresAt ? "; expires=" + new Date(expiresAt).toUTCString() : "";
+                    document.cookie = name + "=" + encodeURIComponent(typeof value === 'string' ? value : JSON.stringify(value)) + expires + "; path=/; SameSite=Lax";
+                }}
+            }})();
+        </script>
+        """
+        st.html(script, unsafe_allow_javascript=True)
+        written = st.session_state.setdefault(_WRITTEN_KEY, set())
+        for name, op in ops.items():
+            if op is None:
+                written.discard(name)
+            else:
+                written.add(name)
+        ops.clear()
+        return len(writes)
+
+    @staticmethod
+    @contextmanager
+    def batch(flush: bool = True):
+        """
+        Queue cookie operations until the outermost batch exits, then flush them. With
+        flush=False (e.g. in widget callbacks) they stay queued for the next flush. Nothing
+        is flushed when the block raises (a rerun discards the run's elements anyway).
+        """
+        local = CookieOps._local
+        local.depth = getattr(local, 'depth', 0) + 1
+        try:
+            yield
+        finally:
+            local.depth -= 1
+        if flush and local.depth == 0:
+            CookieOps.flush()
+
+    @staticmethod
+    def _flush_unless_batching() -> None:
+        if not getattr(CookieOps._local, 'depth', 0):
+            CookieOps.flush()
@@ -3,6 +3,8 @@ from hashlib import md5
 # https://www.pycryptodome.org/en/latest/src/examples.html 
 from Crypto.Cipher import AES
 
+from .metrics import metered
+
 BLOCK_SIZE = 16
 
 class aes256cbcExtended:
@@ -35,6 +37,7 @@ class aes256cbcExtended:
         pad = int(padded[-1])
         return padded[:-pad]
 
+    @metered('crypto.encrypt', provider='aes256cbc')
     def encrypt(self, plainText):
         data_enc = (plainText + self.nonce).encode('utf-8')
         padded = self.__pad(data_enc)
@@ -42,6 +45,7 @@ class aes256cbcExtended:
         encrypted = aes.encrypt(padded)
         return base64.urlsafe_b64encode(encrypted).decode("utf-8") 
 
+    @metered('crypto.decrypt', provider='aes256cbc')
     def decrypt(self, cipherText):
         data_enc = base64.urlsafe_b64decode(cipherText)
         aes = AES.new(self.KEY, AES.MODE_CBC, self.IV)
@@ -4,8 +4,7 @@ Email service for sending signup verification PINs via SendGrid.
 
 import logging
 from os import environ as osenv
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email, To, Content
+from .metrics import metered
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +16,7 @@ class EmailService:
     FROM_EMAIL = osenv.get('NOTIFICATION_FROM_EMAIL')
 
     @staticmethod
+    @metered('email.send_signup_pin', provider='sendgrid', outcome=lambda sent: 'ok' if sent else 'fail')
     def send_signup_pin(to_email: str, pin: str) -> bool:
         """
         Send a signup verification PIN to the user's email.
@@ -33,6 +33,10 @@ class EmailService:
             return False
 
         try:
+            # Imported here so apps without sign-up never load the SendGrid client
+            from sendgrid import SendGridAPIClient
+            from sendgrid.helpers.mail import Mail, Email, To, Content
+
             subject = 'Your sign-up verification code'
 
             # Plain text body
@@ -0,0 +1,194 @@
+"""
+In-process metrics for auth and storage operations.
+
+Counters and latency histograms labeled by operation, provider and outcome.
+Read them through `METRICS.snapshot()`, `METRICS.render_prometheus()` or the
+superuser Metrics panel.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from os import environ as osenv
+from typing import Callable, Dict, List, Optional, Tuple
+
+METRICS_ENABLED = osenv.get('AUTH_METRICS', 'True').lower() == 'true'
+
+# Latency bucket upper bounds in seconds (Prometheus `le` labels)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+OK = 'ok'
+ERROR = 'error'
+
+LabelKey = Tuple[str, str, str]  # (op, provider, outcome)
+
+
+class _Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Thread-safe registry of labeled counters and latency histograms."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[LabelKey, int] = {}
+        self._histograms: Dict[LabelKey, _Histogram] = {}
+
+    def inc(self, op: str, provider: str = '-', outcome: str = OK, amount: int = 1) -> None:
+        """Increment the counter for (op, provider, outcome)."""
+        key = (op, provider, outcome)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, op: str, seconds: float, provider: str = '-', outcome: str = OK) -> None:
+        """Count one call and record its latency."""
+        key = (op, provider, outcome)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = _Histogram()
+            hist.observe(seconds)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self) -> List[dict]:
+        """
+        Return one row per (op, provider, outcome) label set.
+
+        Each row has `op`, `provider`, `outcome`, `count`, and for timed
+        operations `total_ms`, `avg_ms` and `p50_ms`/`p95_ms`/`p99_ms` estimated
+        from the histogram buckets (`inf` when the quantile is past the largest
+        bucket; `format_ms` renders that as "> max bucket").
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: (list(h.counts), h.sum, h.count) for k, h in self._histograms.items()}
+
+        rows = []
+        for key in sorted(counters):
+            op, provider, outcome = key
+            row = {'op': op, 'provider': provider, 'outcome': outcome, 'count': counters[key]}
+            if key in histograms:
+                counts, total, count = histograms[key]
+                row['total_ms'] = round(total * 1000, 3)
+                row['avg_ms'] = round(total * 1000 / count, 3) if count else 0.0
+                for q in (50, 95, 99):
+                    row[f'p{q}_ms'] = _quantile_ms(counts, count, q / 100)
+            rows.append(row)
+        return rows
+
+    def render_prometheus(self, prefix: str = 'authlib') -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: (list(h.counts), h.sum, h.count) for k, h in self._histograms.items()}
+
+        lines = [
+            f'# HELP {prefix}_operations_total Auth and storage operations by outcome.',
+            f'# TYPE {prefix}_operations_total counter',
+        ]
+        for key in sorted(counters):
+            lines.append(f'{prefix}_operations_total{{{_labels(key)}}} {counters[key]}')
+
+        lines += [
+            f'# HELP {prefix}_operation_duration_seconds Auth and storage operation latency.',
+            f'# TYPE {prefix}_operation_duration_seconds histogram',
+        ]
+        for key in sorted(histograms):
+            counts, total, count = histograms[key]
+            labels = _labels(key)
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS, counts):
+                cumulative += n
+                lines.append(f'{prefix}_operation_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_operation_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'{prefix}_operation_duration_seconds_sum{{{labels}}} {total:.6f}')
+            lines.append(f'{prefix}_operation_duration_seconds_count{{{labels}}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(key: LabelKey) -> str:
+    op, provider, outcome = (v.replace('\\', '\\\\').replace('"', '\\"') for v in key)
+    return f'op="{op}",provider="{provider}",outcome="{outcome}"'
+
+
+def _quantile_ms(counts: List[int], count: int, q: float) -> Optional[float]:
+    """Estimate a quantile as the upper bound of the bucket that contains it (inf in the +Inf bucket)."""
+    if not count:
+        return None
+    rank = q * count
+    cumulative = 0
+    for i, n in enumerate(counts):
+        cumulative += n
+        if cumulative >= rank:
+            return LATENCY_BUCKETS[i] * 1000 if i < len(LATENCY_BUCKETS) else float('inf')
+    return float('inf')
+
+
+def format_ms(value: Optional[float]) -> str:
+    """A snapshot latency for display: '' if unknown, '> <max bucket>' past the largest bucket."""
+    if value is None:
+        return ''
+    if value == float('inf'):
+        return f'> {LATENCY_BUCKETS[-1] * 1000:g}'
+    return f'{value:g}'
+
+
+# Process-wide registry
+METRICS = MetricsRegistry()
+
+
+def provider_label(obj) -> str:
+    """Label for a storage provider instance (or '-' if `obj` is not one)."""
+    if obj is not None and hasattr(obj, 'query') and hasattr(obj, 'upsert'):
+        return type(obj).__name__
+    return '-'
+
+
+def metered(op: str, provider: Optional[str] = None, outcome: Optional[Callable[[object], str]] = None):
+    """
+    Decorator recording call count and latency of `fn` under `op`.
+
+    Args:
+        op: Operation name, e.g. 'storage.query'
+        provider: Fixed provider label. If None, derived from the first positional
+            argument when it is a storage provider (`self` on providers, `store` on
+            AuthSession/SignupManager static methods).
+        outcome: Optional function mapping the return value to an outcome label
+            (e.g. 'ok'/'miss'). Exceptions are always labeled 'error'.
+    """
+    def decorator(fn):
+        if not METRICS_ENABLED:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            label = provider if provider is not None else provider_label(args[0] if args else kwargs.get('store'))
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                METRICS.observe(op, time.perf_counter() - start, provider=label, outcome=ERROR)
+                raise
+            METRICS.observe(op, time.perf_counter() - start, provider=label,
+                            outcome=outcome(result) if outcome else OK)
+            return result
+        return wrapper
+    return decorator
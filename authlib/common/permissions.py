@@ -0,0 +1,153 @@
+"""
+Roles and permissions as bitsets.
+
+A user's roles are stored as a comma-separated `roles` column next to the user. Roles map
+to permissions through AUTH_ROLES (`'admin:*;editor:users.read,users.write;viewer:users.read'`)
+or `define_roles()`. Every role and permission name gets a fixed bit the first time it is
+seen, so a session's roles resolve to two ints (role mask, permission mask) and a check is
+one AND. Resolved masks are cached per distinct roles value. Superusers (su == 1) hold every
+role and permission.
+
+Editing a user's roles calls `invalidate(username)`, which bumps that user's epoch; sessions
+holding an older epoch reload the user's roles on their next check. Epochs live in this
+process, so sessions served by other processes pick up role changes at their next login.
+"""
+
+import threading
+from os import environ as osenv
+from typing import Dict, Iterable, Mapping, NamedTuple, Tuple
+
+AUTH_ROLES = osenv.get('AUTH_ROLES', '')
+
+ALL = -1  # every bit set, including bits of names defined later
+
+
+class Access(NamedTuple):
+    """A session's resolved roles and permissions, stamped with what it was resolved against."""
+    username: str
+    roles: int
+    permissions: int
+    version: int  # PermissionModel.version at resolution
+    epoch: int    # the user's invalidation epoch at resolution
+
+
+def split_roles(value) -> Tuple[str, ...]:
+    """Role names from a `roles` column value ('a, b') or an iterable, sorted and de-duplicated."""
+    if not value:
+        return ()
+    names = value.split(',') if isinstance(value, str) else value
+    return tuple(sorted({name.strip() for name in names if name and name.strip()}))
+
+
+def join_roles(roles) -> str:
+    """The `roles` column value for role names."""
+    return ','.join(split_roles(roles))
+
+
+def parse_roles(spec: str) -> Dict[str, Tuple[str, ...]]:
+    """`'role:perm,perm;role:*'` -> `{'role': ('perm', 'perm'), 'role': ('*',)}`."""
+    roles = {}
+    for entry in (e.strip() for e in spec.split(';')):
+        if not entry:
+            continue
+        role, _, permissions = entry.partition(':')
+        roles[role.strip()] = tuple(p.strip() for p in permissions.split(',') if p.strip())
+    return roles
+
+
+class PermissionModel:
+    """Role and permission bit assignments plus per-user invalidation epochs."""
+
+    def __init__(self, roles: Mapping[str, Iterable[str]] = None):
+        self._lock = threading.Lock()
+        self._role_bits: Dict[str, int] = {}
+        self._permission_bits: Dict[str, int] = {}
+        self._grants: Dict[str, int] = {}
+        self._resolved: Dict[Tuple[str, ...], Tuple[int, int]] = {}
+        self._epochs: Dict[str, int] = {}
+        self.version = 0
+        self.define(roles or {})
+
+    @staticmethod
+    def _bit(bits: Dict[str, int], name: str) -> int:
+        # Bits are never reassigned, so masks computed earlier stay valid
+        if name not in bits:
+            bits[name] = 1 << len(bits)
+        return bits[name]
+
+    def define(self, roles: Mapping[str, Iterable[str]]) -> None:
+        """Replace the role -> permissions map ('*' grants every permission)."""
+        with self._lock:
+            grants = {}
+            for role, permissions in roles.items():
+                self._bit(self._role_bits, role)
+                mask = 0
+                for permission in permissions:
+                    mask = ALL if permission == '*' else mask | self._bit(self._permission_bits, permission)
+                    if mask == ALL:
+                        break
+                grants[role] = mask
+            if grants == self._grants and self.version:
+                return  # unchanged (e.g. define_roles() in an app script on every rerun)
+            self._grants = grants
+            self._resolved = {}
+            self.version += 1
+
+    def roles(self) -> Dict[str, int]:
+        """Defined roles and their permission masks."""
+        return dict(self._grants)
+
+    def role_mask(self, *roles: str) -> int:
+        with self._lock:
+            mask = 0
+            for role in roles:
+                mask |= self._bit(self._role_bits, role)
+            return mask
+
+    def permission_mask(self, *permissions: str) -> int:
+        with self._lock:
+            mask = 0
+            for permission in permissions:
+                mask |= self._bit(self._permission_bits, permission)
+            return mask
+
+    def _masks(self, roles: Tuple[str, ...]) -> Tuple[int, int]:
+        masks = self._resolved.get(roles)
+        if masks is None:
+            role_mask = self.role_mask(*roles)
+            permission_mask = 0
+            for role in roles:
+                permission_mask |= self._grants.get(role, 0)
+            masks = self._resolved[roles] = (role_mask, permission_mask)
+        return masks
+
+    def resolve(self, username: str, roles, su: int = 0) -> Access:
+        """Resolve a user's `roles` column value (and su flag) into an `Access`."""
+        epoch, version = self._epochs.get(username, 0), self.version
+        if su == 1:
+            return Access(username, ALL, ALL, version, epoch)
+        role_mask, permission_mask = self._masks(split_roles(roles))
+        return Access(username, role_mask, permission_mask, version, epoch)
+
+    def epoch(self, username: str) -> int:
+        return self._epochs.get(username, 0)
+
+    def is_current(self, access: Access) -> bool:
+        return access.version == self.version and access.epoch == self._epochs.get(access.username, 0)
+
+    def invalidate(self, username: str) -> None:
+        """Make sessions of `username` reload their roles on their next check."""
+        with self._lock:
+            self._epochs[username] = self._epochs.get(username, 0) + 1
+
+
+MODEL = PermissionModel(parse_roles(AUTH_ROLES))
+
+
+def define_roles(roles: Mapping[str, Iterable[str]]) -> None:
+    """Set the role -> permissions map in code (instead of AUTH_ROLES)."""
+    MODEL.define(roles)
+
+
+def invalidate(username: str) -> None:
+    MODEL.invalidate(username)
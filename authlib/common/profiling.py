@@ -0,0 +1,270 @@
+"""
+On-demand profiling of auth runs.
+
+With AUTH_PROFILE set to 'cprofile' or 'sample' (or switched on for one session from the
+superuser Profiling panel), each `auth()` run, auth widget callback and auth fragment run
+is captured:
+
+- 'cprofile' records every call with cProfile (exact call counts, more overhead); the
+  capture downloads as a pstats file (`python -m pstats`, snakeviz, ...).
+- 'sample' samples the running thread's stack every AUTH_PROFILE_SAMPLE_INTERVAL seconds
+  on a helper thread (low overhead); the capture downloads as collapsed stacks, the input
+  of flamegraph.pl and speedscope.
+
+With AUTH_PROFILE_TRACEMALLOC on, each capture also records the peak traced memory and
+the source lines that allocated the most. The slowest AUTH_PROFILE_KEEP captures are kept
+in memory. One run is captured at a time per process (cProfile and tracemalloc are
+process-wide); runs that start while another is being captured run unprofiled.
+"""
+
+import datetime
+import heapq
+import io
+import itertools
+import logging
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from os import environ as osenv
+from typing import List, Optional
+
+from .metrics import METRICS
+
+PROFILE_MODES = ('off', 'cprofile', 'sample')
+AUTH_PROFILE = osenv.get('AUTH_PROFILE', 'off').lower()
+if AUTH_PROFILE not in PROFILE_MODES:
+    AUTH_PROFILE = 'off'  # auth.py logs the bad value
+AUTH_PROFILE_KEEP = int(osenv.get('AUTH_PROFILE_KEEP', '10'))
+AUTH_PROFILE_MIN_MS = float(osenv.get('AUTH_PROFILE_MIN_MS', '0'))  # don't keep captures faster than this
+AUTH_PROFILE_SAMPLE_INTERVAL = float(osenv.get('AUTH_PROFILE_SAMPLE_INTERVAL', '0.001'))
+AUTH_PROFILE_TRACEMALLOC = osenv.get('AUTH_PROFILE_TRACEMALLOC', 'True').lower() == 'true'
+AUTH_PROFILE_TOP_ALLOCATIONS = int(osenv.get('AUTH_PROFILE_TOP_ALLOCATIONS', '10'))
+
+_capturing = threading.Lock()
+_local = threading.local()
+_sequence = itertools.count(1)
+
+
+def _frame_label(code) -> str:
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class Capture:
+    """One profiled run: timing, the profile data and (optionally) memory statistics."""
+
+    __slots__ = ('id', 'label', 'mode', 'started_at', 'seconds', 'username', 'stats', 'stacks',
+                 'peak_bytes', 'allocations')
+
+    def __init__(self, label: str, mode: str):
+        self.id = next(_sequence)
+        self.label = label
+        self.mode = mode
+        self.started_at = datetime.datetime.now().isoformat(timespec='seconds')
+        self.seconds = 0.0
+        self.username = None
+        self.stats = None        # pstats dict (cprofile)
+        self.stacks = None       # Counter of collapsed stacks (sample)
+        self.peak_bytes = None
+        self.allocations = None  # [{'line', 'bytes', 'count'}], largest first
+
+    def summary(self) -> dict:
+        return {
+            'id': self.id,
+            'label': self.label,
+            'mode': self.mode,
+            'started_at': self.started_at,
+            'ms': round(self.seconds * 1000, 1),
+            'username': self.username,
+            'peak_kb': None if self.peak_bytes is None else round(self.peak_bytes / 1024, 1),
+        }
+
+    def pstats_bytes(self) -> Optional[bytes]:
+        """The capture in the format written by `pstats.Stats.dump_stats` (cprofile captures)."""
+        return marshal.dumps(self.stats) if self.stats is not None else None
+
+    def collapsed(self) -> Optional[str]:
+        """The capture as collapsed stacks, `frame;frame;frame count` per line (sample captures)."""
+        if self.stacks is None:
+            return None
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit: int = 25) -> str:
+        """Readable pstats report (cprofile) or the most sampled leaf frames (sample)."""
+        if self.stats is not None:
+            import pstats
+            out = io.StringIO()
+            stats = pstats.Stats(self._stats_holder(), stream=out)
+            stats.sort_stats('cumulative').print_stats(limit)
+            return out.getvalue()
+        if self.stacks is not None:
+            leaves = Counter()
+            for stack, count in self.stacks.items():
+                leaves[stack.rsplit(';', 1)[-1]] += count
+            total = sum(leaves.values()) or 1
+            return '\n'.join(f'{count:6d} {100 * count / total:5.1f}%  {leaf}' for leaf, count in leaves.most_common(limit))
+        return ''
+
+    def _stats_holder(self):
+        # pstats.Stats accepts any object with `create_stats()` and a `stats` dict
+        holder = type('_Profile', (), {'create_stats': lambda s: None})()
+        holder.stats = self.stats
+        return holder
+
+
+class _Sampler:
+    """Samples one thread's stack on a daemon thread."""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='auth-profile-sampler', daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+
+class ProfileStore:
+    """The slowest `keep` captures (a min-heap on duration)."""
+
+    def __init__(self, keep: int = AUTH_PROFILE_KEEP):
+        self.keep = keep
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def add(self, capture: Capture) -> bool:
+        """Keep `capture` if it is among the slowest. Returns True if kept."""
+        with self._lock:
+            entry = (capture.seconds, capture.id, capture)
+            if len(self._heap) < self.keep:
+                heapq.heappush(self._heap, entry)
+                return True
+            if entry[0] > self._heap[0][0]:
+                heapq.heapreplace(self._heap, entry)
+                return True
+            return False
+
+    def slowest(self) -> List[Capture]:
+        with self._lock:
+            return [capture for _, _, capture in sorted(self._heap, reverse=True)]
+
+    def get(self, capture_id: int) -> Optional[Capture]:
+        return next((c for c in self.slowest() if c.id == capture_id), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+
+PROFILES = ProfileStore()
+
+
+def _start_tracemalloc():
+    import tracemalloc
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    elif hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+
+        tracemalloc.reset_peak()
+    return started, tracemalloc.take_snapshot()
+
+
+def _stop_tracemalloc(capture: Capture, started: bool, before) -> None:
+    import tracemalloc
+    capture.peak_bytes = tracemalloc.get_traced_memory()[1]
+    after = tracemalloc.take_snapshot()
+    if started:
+        tracemalloc.stop()
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+    diff = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'lineno')
+    capture.allocations = [
+        {'line': str(stat.traceback[0]), 'bytes': stat.size_diff, 'count': stat.count_diff}
+        for stat in sorted(diff, key=lambda stat: stat.size_diff, reverse=True)[:AUTH_PROFILE_TOP_ALLOCATIONS]
+        if stat.size_diff > 0
+    ]
+
+
+@contextmanager
+def profiled(label: str, mode: Optional[str] = None, store: ProfileStore = PROFILES):
+    """
+    Capture the enclosed block with `mode` ('cprofile', 'sample'; 'off' or None: AUTH_PROFILE).
+
+    Yields the Capture (set `.username` on it), or None when not profiling: profiling is
+    off, this thread is already inside a capture, or another thread is being captured.
+    """
+    mode = (mode or AUTH_PROFILE).lower()
+    if mode not in PROFILE_MODES or mode == 'off' or getattr(_local, 'active', False):
+        yield None
+        return
+    if not _capturing.acquire(blocking=False):
+        METRICS.inc('profile.capture', outcome='busy')
+        yield None
+        return
+
+    _local.active = True
+    capture = Capture(label, mode)
+    profiler = sampler = None
+    try:
+        memory = _start_tracemalloc() if AUTH_PROFILE_TRACEMALLOC else None
+        if mode == 'cprofile':
+            import cProfile
+            profiler = cProfile.Profile()
+        else:
+            sampler = _Sampler(threading.get_ident(), AUTH_PROFILE_SAMPLE_INTERVAL)
+            sampler.start()
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield capture
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            capture.seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.create_stats()
+                capture.stats = profiler.stats
+            if sampler is not None:
+                capture.stacks = sampler.stop()
+            if memory is not None:
+                _stop_tracemalloc(capture, *memory)
+    finally:
+        _local.active = False
+        _capturing.release()
+        # Kept even when the block raised (st.rerun() and st.stop() end runs with an exception)
+        _keep(capture, store)
+
+
+def _keep(capture: Capture, store: ProfileStore) -> None:
+    if capture.stats is None and capture.stacks is None:
+        return  # the profiler failed to start
+    if capture.seconds * 1000 < AUTH_PROFILE_MIN_MS:
+        METRICS.inc('profile.capture', outcome='fast')
+    elif store.add(capture):
+        METRICS.inc('profile.capture', outcome='kept')
+        logging.debug(f'Profiled `{capture.label}` ({capture.mode}) in {capture.seconds * 1000:.1f} ms')
+    else:
+        METRICS.inc('profile.capture', outcome='dropped')
@@ -0,0 +1,104 @@
+"""
+Structured, lazy and sampled query logging for storage providers.
+
+Events are only formatted when a handler actually emits them. Secret columns are
+redacted, successful calls are sampled at QUERY_LOG_SAMPLE_RATE, and errors and
+calls slower than QUERY_LOG_SLOW_MS are always logged.
+"""
+
+import logging
+import random
+import re
+import time
+from os import environ as osenv
+
+QUERY_LOG_SAMPLE_RATE = float(osenv.get('QUERY_LOG_SAMPLE_RATE', '0.1'))
+QUERY_LOG_SLOW_MS = float(osenv.get('QUERY_LOG_SLOW_MS', '250'))
+
+SECRET_FIELDS = frozenset(('password', 'auth_token', 'validation_pin'))
+REDACTED = '***'
+
+_SECRET_CONDS_RE = re.compile(r'\b(' + '|'.join(SECRET_FIELDS) + r')(\s*=\s*)(["\'])(.*?)\3')
+
+logger = logging.getLogger('authlib.query')
+
+
+def redact(data: dict) -> dict:
+    """Copy of `data` with secret column values masked."""
+    if not data:
+        return data
+    return {k: (REDACTED if k in SECRET_FIELDS and v is not None else v) for k, v in data.items()}
+
+
+def redact_conds(conds: str) -> str:
+    """Mask literal values compared against secret columns in a conds string."""
+    if not conds:
+        return conds
+    return _SECRET_CONDS_RE.sub(lambda m: f'{m.group(1)}{m.group(2)}{m.group(3)}{REDACTED}{m.group(3)}', conds)
+
+
+class QueryEvent:
+    """A single provider call. Formatting is deferred until the record is emitted."""
+
+    __slots__ = ('provider', 'op', 'table', 'elapsed_ms', 'fields', 'conds', 'modifier', 'data', 'rows', 'error')
+
+    def __init__(self, provider, op, table, elapsed_ms, fields=None, conds=None, modifier=None, data=None, rows=None, error=None):
+        self.provider = provider
+        self.op = op
+        self.table = table
+        self.elapsed_ms = elapsed_ms
+        self.fields = fields
+        self.conds = conds
+        self.modifier = modifier
+        self.data = data
+        self.rows = rows
+        self.error = error
+
+    def as_dict(self) -> dict:
+        event = {
+            'provider': type(self.provider).__name__,
+            'db': getattr(self.provider, 'db_name', None),
+            'op': self.op,
+            'table': self.table,
+            'elapsed_ms': round(self.elapsed_ms, 3),
+        }
+        if self.fields is not None:
+            event['fields'] = self.fields
+        if self.conds:
+            event['conds'] = redact_conds(self.conds)
+        if self.modifier:
+            event['modifier'] = self.modifier
+        if self.data is not None:
+            event['data'] = redact(self.data)
+        if self.rows is not None:
+            event['rows'] = self.rows
+        if self.error is not None:
+            event['error'] = f'{type(self.error).__name__}: {self.error}'
+        return event
+
+    def __str__(self):
+        return ' '.join(f'{k}={v}' for k, v in self.as_dict().items())
+
+
+def log_query(provider, op: str, table: str, started: float, **fields) -> None:
+    """
+    Log a provider call started at `started` (a `time.perf_counter()` value).
+
+    Keyword args are the QueryEvent fields: fields, conds, modifier, data, rows, error.
+    Errors log at ERROR, slow calls at WARNING, and sampled successful calls at INFO.
+    """
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if fields.get('error') is not None:
+        level = logging.ERROR
+    elif elapsed_ms >= QUERY_LOG_SLOW_MS:
+        level = logging.WARNING
+    else:
+        level = logging.INFO
+        if not logger.isEnabledFor(level):
+            return
+        if QUERY_LOG_SAMPLE_RATE < 1.0 and random.random() >= QUERY_LOG_SAMPLE_RATE:
+            return
+
+    if logger.isEnabledFor(level):
+        event = QueryEvent(provider, op, table, elapsed_ms, **fields)
+        logger.log(level, '%s', event, extra={'query_event': event})
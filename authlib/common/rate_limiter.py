@@ -0,0 +1,223 @@
+"""
+Sliding-window rate limiting with exponential backoff and bounded memory.
+
+`SlidingWindowLimiter` keeps at most `limit` timestamps per key and at most
+`max_keys` keys (least recently used keys are evicted first).
+`SQLiteSlidingWindowLimiter` keeps the same state in a SQLite file so several
+app processes share one view. `LoginThrottle` combines per-username and
+per-client limiters for the login form.
+"""
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from os import environ as osenv
+from typing import Optional
+
+
+class SlidingWindowLimiter:
+    """
+    Allows `limit` events per key within any `window_seconds` span.
+
+    Each event recorded while a key is at its limit adds a strike and blocks the
+    key for `backoff_seconds * 2 ** (strikes - 1)` seconds, capped at
+    `backoff_max_seconds`.
+    """
+
+    def __init__(self, limit: int, window_seconds: float, backoff_seconds: float = 30.0,
+                 backoff_max_seconds: float = 3600.0, max_keys: int = 10000):
+        assert limit > 0 and window_seconds > 0
+        self.limit = limit
+        self.window = window_seconds
+        self.backoff = backoff_seconds
+        self.backoff_max = backoff_max_seconds
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        # key -> [timestamps deque, strikes, blocked_until]
+        self._entries: 'OrderedDict[str, list]' = OrderedDict()
+
+    def _entry(self, key: str, create: bool):
+        entry = self._entries.get(key)
+        if entry is None:
+            if not create:
+                return None
+            entry = self._entries[key] = [deque(maxlen=self.limit), 0, 0.0]
+            if len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _purge(self, events: deque, now: float) -> None:
+        horizon = now - self.window
+        while events and events[0] <= horizon:
+            events.popleft()
+
+    def retry_after(self, key: str, now: Optional[float] = None) -> float:
+        """Seconds until `key` may act again (0.0 if it may act now)."""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entry(key, create=False)
+            if entry is None:
+                return 0.0
+            events, strikes, blocked_until = entry
+            if blocked_until > now:
+                return blocked_until - now
+            self._purge(events, now)
+            if len(events) >= self.limit:
+                return events[0] + self.window - now
+            if not events and strikes:
+                # Quiet for a full window: forgive earlier strikes
+                entry[1] = 0
+            return 0.0
+
+    def hit(self, key: str, now: Optional[float] = None) -> float:
+        """Record an event for `key`. Returns the resulting retry_after."""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entry(key, create=True)
+            events = entry[0]
+            self._purge(events, now)
+            events.append(now)
+            if len(events) >= self.limit:
+                entry[1] += 1
+                entry[2] = now + min(self.backoff_max, self.backoff * 2 ** (entry[1] - 1))
+                return entry[2] - now
+            return 0.0
+
+    def reset(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteSlidingWindowLimiter(SlidingWindowLimiter):
+    """SlidingWindowLimiter with its state in a SQLite file shared across processes."""
+
+    PRUNE_EVERY = 100
+
+    def __init__(self, db_path: str, limit: int, window_seconds: float, backoff_seconds: float = 30.0,
+                 backoff_max_seconds: float = 3600.0, max_keys: int = 10000, namespace: str = 'default'):
+        super().__init__(limit, window_seconds, backoff_seconds, backoff_max_seconds, max_keys)
+        self.namespace = namespace
+        self._hits = 0
+        self.con = sqlite3.connect(db_path, timeout=5, check_same_thread=False, isolation_level=None)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('CREATE TABLE IF NOT EXISTS RATE_EVENTS (ns TEXT, key TEXT, ts REAL)')
+        self.con.execute('CREATE INDEX IF NOT EXISTS RATE_EVENTS_KEY ON RATE_EVENTS (ns, key, ts)')
+        self.con.execute('CREATE TABLE IF NOT EXISTS RATE_BLOCKS (ns TEXT, key TEXT, strikes INTEGER, blocked_until REAL, '
+                         'last_seen REAL, PRIMARY KEY (ns, key))')
+
+    def _state(self, key: str, now: float):
+        horizon = now - self.window
+        count, oldest = self.con.execute(
+            'SELECT COUNT(*), MIN(ts) FROM RATE_EVENTS WHERE ns=? AND key=? AND ts>?', (self.namespace, key, horizon)
+        ).fetchone()
+        row = self.con.execute(
+            'SELECT strikes, blocked_until FROM RATE_BLOCKS WHERE ns=? AND key=?', (self.namespace, key)
+        ).fetchone()
+        strikes, blocked_until = row if row else (0, 0.0)
+        return count, oldest, strikes, blocked_until
+
+    def retry_after(self, key: str, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        with self._lock:
+            count, oldest, strikes, blocked_until = self._state(key, now)
+            if blocked_until > now:
+                return blocked_until - now
+            if count >= self.limit:
+                return oldest + self.window - now
+            return 0.0
+
+    def hit(self, key: str, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        with self._lock:
+            self.con.execute('BEGIN IMMEDIATE')
+            try:
+                self.con.execute('INSERT INTO RATE_EVENTS (ns, key, ts) VALUES (?, ?, ?)', (self.namespace, key, now))
+                count, _, strikes, _ = self._state(key, now)
+                if strikes and count == 1:
+                    strikes = 0  # quiet for a full window
+                retry_after = 0.0
+                if count >= self.limit:
+                    strikes += 1
+                    retry_after = float(min(self.backoff_max, self.backoff * 2 ** (strikes - 1)))
+                self.con.execute(
+                    'REPLACE INTO RATE_BLOCKS (ns, key, strikes, blocked_until, last_seen) VALUES (?, ?, ?, ?, ?)',
+                    (self.namespace, key, strikes, now + retry_after if retry_after else 0.0, now)
+                )
+                self.con.execute('COMMIT')
+            except Exception:
+                self.con.execute('ROLLBACK')
+                raise
+            self._hits += 1
+            if self._hits % self.PRUNE_EVERY == 0:
+                self._prune(now)
+            return retry_after
+
+    def _prune(self, now: float) -> None:
+        """Drop expired events and keep at most `max_keys` block rows."""
+        self.con.execute('DELETE FROM RATE_EVENTS WHERE ns=? AND ts<=?', (self.namespace, now - self.window))
+        self.con.execute(
+            'DELETE FROM RATE_BLOCKS WHERE ns=? AND blocked_until<=? AND last_seen<=?', (self.namespace, now, now - self.window)
+        )
+        self.con.execute(
+            'DELETE FROM RATE_BLOCKS WHERE ns=? AND key NOT IN '
+            '(SELECT key FROM RATE_BLOCKS WHERE ns=? ORDER BY last_seen DESC LIMIT ?)',
+            (self.namespace, self.namespace, self.max_keys)
+        )
+
+    def reset(self, key: str) -> None:
+        with self._lock:
+            self.con.execute('DELETE FROM RATE_EVENTS WHERE ns=? AND key=?', (self.namespace, key))
+            self.con.execute('DELETE FROM RATE_BLOCKS WHERE ns=? AND key=?', (self.namespace, key))
+
+    def __len__(self):
+        return self.con.execute('SELECT COUNT(*) FROM RATE_BLOCKS WHERE ns=?', (self.namespace,)).fetchone()[0]
+
+
+def make_limiter(namespace: str, limit: int, window_seconds: float, **kwargs) -> SlidingWindowLimiter:
+    """In-memory limiter, or a SQLite-backed one if RATE_LIMIT_DB is set."""
+    db_path = osenv.get('RATE_LIMIT_DB')
+    if db_path:
+        return SQLiteSlidingWindowLimiter(db_path, limit, window_seconds, namespace=namespace, **kwargs)
+    return SlidingWindowLimiter(limit, window_seconds, **kwargs)
+
+
+class LoginThrottle:
+    """Failed-login limits per username and per client address."""
+
+    ENABLED = osenv.get('LOGIN_THROTTLE', 'True').lower() == 'true'
+    MAX_ATTEMPTS = int(osenv.get('LOGIN_MAX_ATTEMPTS', '5'))
+    CLIENT_MAX_ATTEMPTS = int(osenv.get('LOGIN_CLIENT_MAX_ATTEMPTS', '20'))
+    WINDOW_SECONDS = float(osenv.get('LOGIN_WINDOW_SECONDS', '300'))
+    BACKOFF_SECONDS = float(osenv.get('LOGIN_BACKOFF_SECONDS', '30'))
+    BACKOFF_MAX_SECONDS = float(osenv.get('LOGIN_BACKOFF_MAX_SECONDS', '3600'))
+    MAX_KEYS = int(osenv.get('LOGIN_THROTTLE_MAX_KEYS', '10000'))
+
+    def __init__(self):
+        options = dict(backoff_seconds=self.BACKOFF_SECONDS, backoff_max_seconds=self.BACKOFF_MAX_SECONDS, max_keys=self.MAX_KEYS)
+        self.by_username = make_limiter('login_username', self.MAX_ATTEMPTS, self.WINDOW_SECONDS, **options)
+        self.by_client = make_limiter('login_client', self.CLIENT_MAX_ATTEMPTS, self.WINDOW_SECONDS, **options)
+
+    @staticmethod
+    def _username_key(username: str) -> str:
+        return (username or '').strip().lower()
+
+    def check(self, username: str, client: str) -> float:
+        """Seconds the caller must wait before another attempt (0.0 if allowed)."""
+        if not self.ENABLED:
+            return 0.0
+        return max(self.by_username.retry_after(self._username_key(username)), self.by_client.retry_after(client))
+
+    def record_failure(self, username: str, client: str) -> None:
+        if self.ENABLED:
+            self.by_username.hit(self._username_key(username))
+            self.by_client.hit(client)
+
+    def record_success(self, username: str, client: str) -> None:
+        if self.ENABLED:
+            self.by_username.reset(self._username_key(username))
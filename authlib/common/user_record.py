@@ -0,0 +1,78 @@
+"""
+Compact, read-only rows returned by the storage providers.
+
+A `UserRecord` holds a row's values as a tuple plus a column-name -> position index that
+is shared by every row with the same columns, so a row costs one small object instead
+of a dict. It behaves as a read-only mapping (`row['username']`, `row.get('su')`,
+`dict(row)`).
+
+`principal(user)` is the slice of a user row kept in `st.session_state` for a logged-in
+session: no password and no admin/statistics columns.
+"""
+
+from collections.abc import Mapping
+from functools import lru_cache
+
+from . import const
+
+PRINCIPAL_FIELDS = (const.USERNAME, const.SU, const.ROLES, const.AUTH_TOKEN, const.EXPIRES_AT)
+SESSION_FIELDS = ', '.join(PRINCIPAL_FIELDS)
+LOGIN_FIELDS = f'{SESSION_FIELDS}, {const.PASSWORD}'
+
+
+@lru_cache(maxsize=256)
+def column_index(columns: tuple) -> dict:
+    """Shared `{column: position}` for a tuple of column names."""
+    return {col: idx for idx, col in enumerate(columns)}
+
+
+class UserRecord(Mapping):
+    """A database row as a read-only mapping over a tuple of values."""
+
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index: dict, values: tuple):
+        self._index = index
+        self._values = values
+
+    @classmethod
+    def from_columns(cls, columns, values) -> 'UserRecord':
+        return cls(column_index(tuple(columns)), tuple(values))
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return f'UserRecord({dict(self)!r})'
+
+    def __reduce__(self):
+        return UserRecord.from_columns, (tuple(self._index), self._values)
+
+
+_last_description = (None, None)
+
+def record_factory(cursor, row) -> UserRecord:
+    """sqlite3 row_factory building UserRecords; the index is looked up once per result set."""
+    global _last_description
+    description, index = _last_description
+    if cursor.description is not description:
+        description = cursor.description
+        index = column_index(tuple(col[0] for col in description))
+        _last_description = (description, index)
+    return UserRecord(index, row)
+
+
+def principal(user) -> dict:
+    """The session-state view of a user row (missing columns default to None, su to 0)."""
+    session = {field: user.get(field) for field in PRINCIPAL_FIELDS}
+    session[const.SU] = session[const.SU] or 0
+    return session
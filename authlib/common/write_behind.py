@@ -0,0 +1,158 @@
+"""
+Write-behind buffering of per-user column changes.
+
+Changes are coalesced in memory per key (later values win, increments add up)
+and written in one bulk call when the flush interval elapses, when `max_pending`
+keys are waiting, or at interpreter shutdown. `buffer_for(store)` returns the shared buffer that
+flushes into a storage provider's `update_many`.
+"""
+
+import atexit
+import logging
+import threading
+import time
+import weakref
+from os import environ as osenv
+from typing import Callable, Dict, List, Optional
+
+from .metrics import METRICS, ERROR, provider_label
+
+FLUSH_SECONDS = float(osenv.get('WRITE_BEHIND_FLUSH_SECONDS', '30'))
+MAX_PENDING = int(osenv.get('WRITE_BEHIND_MAX_PENDING', '1000'))
+
+
+class WriteBehindBuffer:
+    """
+    Coalesces `put(key, changes, increments)` calls and hands them to `flush_fn` as a list
+    of `{'username': key, **changes}` rows plus a `{key: {col: n}}` dict of increments.
+
+    A daemon thread flushes every `interval_seconds`. If `flush_fn` fails, the rows
+    are merged back under any newer changes and retried on the next flush.
+    """
+
+    def __init__(self, flush_fn: Callable[[List[dict], Dict[str, dict]], object], interval_seconds: float = FLUSH_SECONDS,
+                 max_pending: int = MAX_PENDING, label: str = '-'):
+        self.flush_fn = flush_fn
+        self.interval = interval_seconds
+        self.max_pending = max_pending
+        self.label = label
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[str, dict] = {}
+        self._increments: Dict[str, dict] = {}
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        _BUFFERS.add(self)
+
+    def put(self, key: str, changes: dict = None, increments: dict = None) -> None:
+        with self._lock:
+            self._pending.setdefault(key, {}).update(changes or {})
+            if increments:
+                counters = self._increments.setdefault(key, {})
+                for col, n in increments.items():
+                    counters[col] = counters.get(col, 0) + n
+            full = len(self._pending) >= self.max_pending
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name=f'write-behind-{self.label}', daemon=True)
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def pending(self, key: str) -> Optional[dict]:
+        """Changes for `key` not yet flushed (a copy), or None."""
+        with self._lock:
+            changes = self._pending.get(key)
+            return dict(changes) if changes is not None else None
+
+    def discard(self, key: str, columns=None) -> None:
+        """Drop unflushed changes for `key`, or only those to `columns` (e.g. they are being rewritten anyway)."""
+        with self._lock:
+            if columns is None:
+                self._pending.pop(key, None)
+                self._increments.pop(key, None)
+                return
+            changes = self._pending.get(key)
+            if changes is not None:
+                for col in columns:
+                    changes.pop(col, None)
+
+    def flush(self) -> int:
+        """Write all pending changes now. Returns the number of rows handed to `flush_fn`."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                increments, self._increments = self._increments, {}
+            if not batch:
+                return 0
+            rows = [{'username': key, **changes} for key, changes in batch.items()]
+            started = time.perf_counter()
+            try:
+                self.flush_fn(rows, increments)
+            except Exception as ex:
+                logging.error(f'Write-behind flush of {len(rows)} rows failed ({self.label}): {str(ex)}')
+                METRICS.inc('write_behind.flush', provider=self.label, outcome=ERROR)
+                with self._lock:
+                    for key, changes in batch.items():
+                        self._pending[key] = {**changes, **self._pending.get(key, {})}
+                    for key, counters in increments.items():
+                        merged = self._increments.setdefault(key, {})
+                        for col, n in counters.items():
+                            merged[col] = merged.get(col, 0) + n
+                return 0
+            METRICS.observe('write_behind.flush', time.perf_counter() - started, provider=self.label)
+            METRICS.inc('write_behind.rows', provider=self.label, amount=len(rows))
+            return len(rows)
+
+    def close(self) -> None:
+        """Stop the flusher thread and write what is left."""
+        self._closed = True
+        self._wake.set()
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def __len__(self):
+        return len(self._pending)
+
+
+_BUFFERS: 'weakref.WeakSet[WriteBehindBuffer]' = weakref.WeakSet()
+_STORE_BUFFERS: Dict[tuple, WriteBehindBuffer] = {}
+_STORE_BUFFERS_LOCK = threading.Lock()
+
+
+def buffer_for(store, table: str = 'USERS') -> WriteBehindBuffer:
+    """The shared buffer flushing into `store.update_many` for `table`, created on first use."""
+    key = (id(store), table.upper())
+    with _STORE_BUFFERS_LOCK:
+        buffer = _STORE_BUFFERS.get(key)
+        if buffer is None:
+            buffer = WriteBehindBuffer(
+                lambda rows, increments: store.update_many({'table': table, 'rows': rows, 'increments': increments}),
+                label=provider_label(store),
+            )
+            _STORE_BUFFERS[key] = buffer
+        return buffer
+
+
+def release_buffers(store) -> int:
+    """Flush and forget `store`'s buffers (before the provider is closed). Returns the number of rows written."""
+    with _STORE_BUFFERS_LOCK:
+        buffers = [_STORE_BUFFERS.pop(key) for key in list(_STORE_BUFFERS) if key[0] == id(store)]
+    written = 0
+    for buffer in buffers:
+        written += buffer.flush()
+        buffer.close()
+    return written
+
+
+def flush_all() -> int:
+    """Flush every live buffer. Returns the number of rows written."""
+    return sum(buffer.flush() for buffer in list(_BUFFERS))
+
+
+atexit.register(flush_all)
@@ -1,9 +1,13 @@
 import json
-from typing import List, Literal
+import re
+import time
+from itertools import islice
+from typing import Iterable, Iterator, List, Literal
 import logging
 
 # https://pyairtable.readthedocs.io/en/stable/getting-started.html
 # https://support.airtable.com/docs/formula-field-reference
+import requests
 from pyairtable import Api
 # from pyairtable.formulas import match
 from pyairtable.orm import Model, fields
@@ -12,6 +16,11 @@ from ..base_provider import StorageProvider
 
 from .settings import AIRTABLE_SETTINGS
 from . import DatabaseError
+from ..conds import parse_limit
+from ..connection import ConnectionManager
+from authlib.common.metrics import metered
+from authlib.common.query_log import log_query, redact, redact_conds
+from authlib.common.user_record import UserRecord, column_index
 
 # ------------------------------------------------------------------------------
 # USER
@@ -20,6 +29,11 @@ class User(Model):
     username = fields.TextField('username')
     password = fields.TextField('password')
     su = fields.IntegerField("su")
+    roles = fields.TextField("roles")
+    logins_count = fields.IntegerField("logins_count")
+    last_login = fields.TextField("last_login")
+    created_at = fields.TextField("created_at")
+    updated_at = fields.TextField("updated_at")
 
     def __repr__(self):
         return {
@@ -91,6 +105,7 @@ class PendingUser(Model):
     validation_pin = fields.TextField('validation_pin')
     is_validated = fields.IntegerField('is_validated')
     expires_at = fields.TextField('expires_at')
+    pin_attempts = fields.IntegerField('pin_attempts')
 
     def to_dict(self):
         return {
@@ -99,6 +114,7 @@ class PendingUser(Model):
             "validation_pin": self.validation_pin,
             "is_validated": self.is_validated,
             "expires_at": self.expires_at,
+            "pin_attempts": self.pin_attempts,
         }
 
     class Meta:
@@ -110,34 +126,59 @@ class PendingUser(Model):
 
 # ------------------------------------------------------------------------------
 
+# Columns added after the original schema. Bases created before them keep working: a projection
+# naming one the table lacks is retried without it, and rows come back without that field.
+OPTIONAL_FIELDS = ('roles', 'logins_count', 'last_login', 'created_at', 'updated_at', 'pin_attempts')
+
+_UNKNOWN_FIELD_RE = re.compile(r'Unknown field name: \\?"([^"\\]+)')
+
 class AirtableProvider(StorageProvider):
 
-    def __init__(self, allow_db_create=False, if_table_exists: Literal['ignore', 'recreate'] = 'ignore'):
+    def __init__(self, allow_db_create=False, if_table_exists: Literal['ignore', 'recreate'] = 'ignore', base_id=None):
 
         logging.info('>>> AirtbleProvider: ignoring `allow_db_create` and `if_table_exists` args. <<<')
         logging.info('>>> Please manage database and tables directly in the Airtable service. <<<')
 
+        # `base_id` defaults to AIRTABLE_BASE_KEY (set per tenant by the provider registry)
+        self.db_name = base_id or AIRTABLE_SETTINGS.BASE_ID
+        # The "connection" is an Api session with its two table handles
+        self.connections = ConnectionManager(
+            connect=lambda: AirtableProvider._connect(self.db_name),
+            close=lambda tables: tables[0].api.session.close(),
+            probe=lambda tables: tables[0].first(fields=['username']),
+            is_connection_error=AirtableProvider._is_connection_error,
+            label=type(self).__name__,
+        )
+        self._missing_fields = {}  # table name -> OPTIONAL_FIELDS the table doesn't have
+
+    @staticmethod
+    def _connect(base_id: str):
         air_api = Api(AIRTABLE_SETTINGS.API_PAT)
-        air_users_table = air_api.table(AIRTABLE_SETTINGS.BASE_ID, AIRTABLE_SETTINGS.USERS_TABLE)
-        air_pending_users_table = air_api.table(AIRTABLE_SETTINGS.BASE_ID, AIRTABLE_SETTINGS.PENDING_USERS_TABLE)
-
-        self.db_name = AIRTABLE_SETTINGS.BASE_ID
-        self.api = air_api
-        self.users_table = air_users_table
-        self.pending_users_table = air_pending_users_table
+        air_users_table = air_api.table(base_id, AIRTABLE_SETTINGS.USERS_TABLE)
+        air_pending_users_table = air_api.table(base_id, AIRTABLE_SETTINGS.PENDING_USERS_TABLE)
+        return air_users_table, air_pending_users_table
+
+    @staticmethod
+    def _is_connection_error(ex: Exception) -> bool:
+        """Network failures, timeouts, rate limiting and 5xx responses (not 4xx, e.g. a bad formula)."""
+        if isinstance(ex, (requests.ConnectionError, requests.Timeout)):
+            return True
+        response = getattr(ex, 'response', None)
+        status = getattr(response, 'status_code', None)
+        return status is not None and (status == 429 or status >= 500)
 
     def close_database(self) -> None:
-        """Shuts down the database."""
-        self.api = None
-        self.users_table = None
-        self.pending_users_table = None
+        """Shuts down the database (the next call reconnects)."""
+        self.connections.close()
 
     def _get_table(self, table_name: str):
-        """Get the appropriate table instance."""
+        """Get the appropriate table instance (raises CircuitOpenError while Airtable is unavailable)."""
+        users_table, pending_users_table = self.connections.acquire()
         if table_name.upper() == 'PENDING_USERS':
-            return self.pending_users_table
-        return self.users_table
+            return pending_users_table
+        return users_table
 
+    @metered('storage.upsert')
     def upsert(self, context: dict=None) -> None:
         """Updates or inserts a record with supplied data (cols + value dict)."""
         assert(context is not None and context.get('data') is not None)
@@ -148,9 +189,9 @@ class AirtableProvider(StorageProvider):
         assert(data.get('username') is not None)
         assert(data.get('password') is not None)
 
-        logging.info(f"Upsert: {data}")
+        started = time.perf_counter()
+        table = self._get_table(table_name)
         try:
-            table = self._get_table(table_name)
             username = data['username']
             user_record = table.first(formula=f"username='{username}'")
             user_id = user_record['id'] if user_record else None
@@ -159,16 +200,34 @@ class AirtableProvider(StorageProvider):
             else:
                 table.create(fields=data, typecast=True)
         except Exception as ex:
-            self.close_database()
+            log_query(self, 'upsert', table_name, started, data=data, error=ex)
+            self.connections.failed(ex)
             raise DatabaseError({
                 "code": "Airtable exception",
-                "description": f'Database: `{self.db_name}`\n`upsert({data})`\nEnsure DB entities exist',
+                "description": f'Database: `{self.db_name}`\n`upsert({redact(data)})`\nEnsure DB entities exist',
                 "message": str(ex),
             }, 500)
+        self.connections.succeeded()
+        log_query(self, 'upsert', table_name, started, data=data)
 
 
-    def query(self, context: dict=None) -> List[dict]:
-        """Executes a query and returns rows as list of dicts."""
+    @staticmethod
+    def _pages(table, context: dict, missing=()) -> Iterator[list]:
+        """Airtable list requests for a query context, one page of records at a time."""
+        options = {'page_size': context.get('page_size') or AIRTABLE_SETTINGS.PAGE_SIZE}
+        fields = context.get('fields')
+        if fields.strip() != '*':
+            options['fields'] = [f.strip() for f in fields.split(',') if f.strip() not in missing]
+        if context.get('conds'):
+            options['formula'] = context['conds']
+        if context.get('sort'):
+            options['sort'] = list(context['sort'])
+        limit = parse_limit(context.get('modifier'))
+        if limit is not None:
+            options['max_records'] = limit
+        return table.iterate(**options)
+
+    def _stream(self, context: dict, op: str) -> Iterator[dict]:
         assert(context is not None and context.get('fields') is not None)
 
         table_name = context.get('table', 'USERS')
@@ -176,27 +235,74 @@ class AirtableProvider(StorageProvider):
         conds = context.get('conds')
         modifier = context.get('modifier')
 
-        logging.info(f"Query: {fields}, {conds}, {modifier}")
+        started = time.perf_counter()
+        table = self._get_table(table_name)
+        rows = 0
         try:
-            table = self._get_table(table_name)
-            max_records = 1000
-            if modifier and modifier.startswith('LIMIT '):
-                max_records = int(modifier.replace('LIMIT ', ''))
-            if fields == '*':
-                records = table.all(formula=conds, sort=['username'], max_records=max_records)
-            else:
-                fields_list = fields.replace(' ', '').split(',')
-                records = table.all(fields=fields_list, formula=conds, sort=['username'], max_records=max_records)
-            results = [record['fields'] for record in records]
-            return results
+            while True:
+                missing = self._missing_fields.get(table_name.upper(), ())
+                # Airtable leaves empty fields out of a record, so projected rows are filled in with None
+                columns = None if fields.strip() == '*' else tuple(f.strip() for f in fields.split(','))
+                index = column_index(columns) if columns else None
+                try:
+                    for page in self._pages(table, context, missing):
+                        for record in page:
+                            rows += 1
+                            values = record['fields']
+                            if index is None:
+                                yield UserRecord.from_columns(values.keys(), values.values())
+                            else:
+                                yield UserRecord(index, tuple(values.get(col) for col in columns))
+                    break
+                except Exception as ex:
+                    if rows or not self._skip_unknown_field(table_name, fields, ex):
+                        raise
         except Exception as ex:
-            self.close_database()
+            log_query(self, op, table_name, started, fields=fields, conds=conds, modifier=modifier, error=ex)
+            self.connections.failed(ex)
             raise DatabaseError({
                 "code": "Airtable exception",
-                "description": f'Database: `{self.db_name}`\n`query({fields}, {conds}, {modifier})`\nEnsure DB entities exist',
+                "description": f'Database: `{self.db_name}`\n`{op}({fields}, {redact_conds(conds)}, {modifier})`\nEnsure DB entities exist',
                 "message": str(ex),
             }, 500)
-
+        self.connections.succeeded()
+        log_query(self, op, table_name, started, fields=fields, conds=conds, modifier=modifier, rows=rows)
+
+    def _skip_unknown_field(self, table_name: str, fields: str, ex: Exception) -> bool:
+        """Remember a projected OPTIONAL_FIELDS column the table lacks (UNKNOWN_FIELD_NAME); False for other errors."""
+        match = _UNKNOWN_FIELD_RE.search(str(ex))
+        field = match.group(1) if match else None
+        requested = [f.strip() for f in fields.split(',')]
+        missing = self._missing_fields.get(table_name.upper(), ())
+        if field not in OPTIONAL_FIELDS or field not in requested or field in missing:
+            return False
+        logging.warning(f'Airtable table `{table_name}` has no `{field}` field; reading without it (add the field to use it)')
+        self._missing_fields[table_name.upper()] = (*missing, field)
+        return True
+
+    @metered('storage.query')
+    def query(self, context: dict=None) -> List[dict]:
+        """Executes a query and returns rows as read-only UserRecords (all pages, unless the modifier has a LIMIT)."""
+        return list(self._stream(context, 'query'))
+
+    def iterate(self, context: dict=None) -> Iterator[dict]:
+        """Yields a query's rows as each page (AIRTABLE_PAGE_SIZE records) arrives."""
+        return self._stream(context, 'iterate')
+
+    @staticmethod
+    def _chunks(items: Iterable, size: int) -> Iterator[list]:
+        items = iter(items)
+        while chunk := list(islice(items, size)):
+            yield chunk
+
+    def _records_by_username(self, table, usernames: list, fields: list) -> Iterator[dict]:
+        """Streams the records of `usernames` (one formula per 50 names, to stay within URL limits)."""
+        for chunk in self._chunks(usernames, 50):
+            formula = 'OR(' + ','.join(f"username='{u}'" for u in chunk) + ')'
+            for page in table.iterate(formula=formula, fields=['username', *fields], page_size=AIRTABLE_SETTINGS.PAGE_SIZE):
+                yield from page
+
+    @metered('storage.delete')
     def delete(self, context: dict=None) -> None:
         """Deletes record from specified table."""
         assert(context is not None and context.get('conds') is not None)
@@ -204,17 +310,164 @@ class AirtableProvider(StorageProvider):
         table_name = context.get('table', 'USERS')
         conds = context['conds']
 
-        logging.info(f"Delete: {conds}")
+        started = time.perf_counter()
+        table = self._get_table(table_name)
         try:
-            table = self._get_table(table_name)
             record = table.first(formula=conds)
             record_id = record['id'] if record else None
             if record_id:
                 table.delete(record_id)
         except Exception as ex:
-            self.close_database()
+            log_query(self, 'delete', table_name, started, conds=conds, error=ex)
+            self.connections.failed(ex)
+            raise DatabaseError({
+                "code": "Airtable exception",
+                "description": f'Database: `{self.db_name}`\n`delete({redact_conds(conds)})`\nEnsure DB entities exist',
+                "message": str(ex),
+            }, 500)
+        self.connections.succeeded()
+        log_query(self, 'delete', table_name, started, conds=conds, rows=1 if record_id else 0)
+
+    @metered('storage.upsert_many')
+    def upsert_many(self, context: dict=None) -> None:
+        """Upserts rows keyed on username, AIRTABLE_PAGE_SIZE rows at a time (10 records per request, no lookups)."""
+        assert(context is not None and context.get('rows') is not None)
+
+        table_name = context.get('table', 'USERS')
+        started = time.perf_counter()
+        table = self._get_table(table_name)
+        count = 0
+        try:
+            for chunk in self._chunks(context['rows'], AIRTABLE_SETTINGS.PAGE_SIZE):
+                table.batch_upsert([{'fields': row} for row in chunk], key_fields=['username'], replace=True, typecast=True)
+                count += len(chunk)
+        except Exception as ex:
+            log_query(self, 'upsert_many', table_name, started, rows=count, error=ex)
+            self.connections.failed(ex)
+            raise DatabaseError({
+                "code": "Airtable exception",
+                "description": f'Database: `{self.db_name}`\n`upsert_many()` failed after {count} rows\nEnsure DB entities exist',
+                "message": str(ex),
+            }, 500)
+        self.connections.succeeded()
+        log_query(self, 'upsert_many', table_name, started, rows=count)
+
+    @metered('storage.delete_many')
+    def delete_many(self, context: dict=None) -> int:
+        """Looks up the record ids of 50 usernames at a time and deletes them in batches. Returns records deleted."""
+        assert(context is not None and context.get('usernames') is not None)
+
+        table_name = context.get('table', 'USERS')
+        started = time.perf_counter()
+        table = self._get_table(table_name)
+        count = 0
+        try:
+            for chunk in self._chunks(context['usernames'], 50):
+                ids = [record['id'] for record in self._records_by_username(table, chunk, [])]
+                if ids:
+                    table.batch_delete(ids)
+                    count += len(ids)
+        except Exception as ex:
+            log_query(self, 'delete_many', table_name, started, rows=count, error=ex)
+            self.connections.failed(ex)
+            raise DatabaseError({
+                "code": "Airtable exception",
+                "description": f'Database: `{self.db_name}`\n`delete_many()` failed after {count} rows\nEnsure DB entities exist',
+                "message": str(ex),
+            }, 500)
+        self.connections.succeeded()
+        log_query(self, 'delete_many', table_name, started, rows=count)
+        return count
+
+    @metered('storage.update_many')
+    def update_many(self, context: dict=None) -> int:
+        """Partial updates: one lookup per 50 usernames, then batched PATCHes (10 records per request)."""
+        assert(context is not None and context.get('rows') is not None)
+
+        table_name = context.get('table', 'USERS')
+        rows = context['rows']
+        increments = context.get('increments') or {}
+
+        started = time.perf_counter()
+        table = self._get_table(table_name)
+        # Airtable has no atomic increment: read the current counters with the record ids
+        inc_fields = sorted({col for counters in increments.values() for col in counters})
+        count = 0
+        try:
+            for chunk in self._chunks(rows, 50):
+                changes = {row['username']: {k: v for k, v in row.items() if k != 'username'} for row in chunk}
+                updates = []
+                for record in self._records_by_username(table, list(changes), inc_fields):
+                    username = record['fields']['username']
+                    fields = dict(changes[username])
+                    for col, n in (increments.get(username) or {}).items():
+                        fields[col] = (record['fields'].get(col) or 0) + n
+                    updates.append({'id': record['id'], 'fields': fields})
+                if updates:
+                    table.batch_update(updates, typecast=True)
+                    count += len(updates)
+        except Exception as ex:
+            log_query(self, 'update_many', table_name, started, rows=count, error=ex)
+            self.connections.failed(ex)
+            raise DatabaseError({
+                "code": "Airtable exception",
+                "description": f'Database: `{self.db_name}`\n`update_many()` failed after {count} rows\nEnsure DB entities exist',
+                "message": str(ex),
+            }, 500)
+        self.connections.succeeded()
+        log_query(self, 'update_many', table_name, started, rows=count)
+        return count
+
+    def update(self, context: dict=None) -> int:
+        """Sets the supplied fields on an existing record (no insert, other fields untouched)."""
+        assert(context is not None and context.get('data') is not None)
+        assert(context['data'].get('username') is not None)
+        username = context['data']['username']
+        return self.update_many({
+            'table': context.get('table', 'USERS'),
+            'rows': [context['data']],
+            'increments': {username: context['increment']} if context.get('increment') else None,
+        })
+
+    @metered('storage.complete_signup', outcome=lambda result: result['outcome'])
+    def complete_signup(self, context: dict=None) -> dict:
+        """
+        Verifies the PIN and moves the pending user to the users table: one lookup, then one
+        upsert keyed on username plus one delete (or a single PATCH for a wrong PIN).
+
+        Airtable has no transactions. The user is written before the pending record is
+        deleted, and the upsert is idempotent, so a retry after a partial failure completes
+        the move. An existing user of the same name is replaced rather than reported as
+        'registered' (sign-up checks for one before creating the pending record).
+        """
+        assert(context is not None and context.get('username') is not None)
+
+        pending_table_name = context.get('table', 'PENDING_USERS')
+        username = context['username']
+
+        started = time.perf_counter()
+        pending_table = self._get_table(pending_table_name)
+        users_table = self._get_table(context.get('users_table', 'USERS'))
+        user = None
+        try:
+            record = pending_table.first(formula=f"username='{username}'")
+            outcome = self.signup_outcome(record['fields'] if record else None, context.get('pin'), context.get('max_attempts', 5))
+            if outcome == 'mismatch':
+                attempts = int(record['fields'].get('pin_attempts') or 0) + 1
+                pending_table.update(record['id'], {'pin_attempts': attempts}, typecast=True)
+            elif outcome == 'ok':
+                user = {**(context.get('data') or {}), 'username': username, 'password': record['fields']['password']}
+                users_table.batch_upsert([{'fields': user}], key_fields=['username'], replace=True, typecast=True)
+            if outcome in ('ok', 'expired'):
+                pending_table.delete(record['id'])
+        except Exception as ex:
+            log_query(self, 'complete_signup', pending_table_name, started, error=ex)
+            self.connections.failed(ex)
             raise DatabaseError({
                 "code": "Airtable exception",
-                "description": f'Database: `{self.db_name}`\n`delete({conds})`\nEnsure DB entities exist',
+                "description": f'Database: `{self.db_name}`\n`complete_signup()`\nEnsure DB entities exist',
                 "message": str(ex),
             }, 500)
+        self.connections.succeeded()
+        log_query(self, 'complete_signup', pending_table_name, started, rows=1 if user else 0)
+        return {'outcome': outcome, 'user': user}
@@ -1,11 +1,12 @@
 from os import environ as osenv
 from collections import namedtuple
 
-AIRTABLE_SETTINGS = namedtuple('air_settings', ['API_PAT', 'BASE_ID', 'USERS_TABLE', 'PENDING_USERS_TABLE'])(
+AIRTABLE_SETTINGS = namedtuple('air_settings', ['API_PAT', 'BASE_ID', 'USERS_TABLE', 'PENDING_USERS_TABLE', 'PAGE_SIZE'])(
     API_PAT=osenv.get('AIRTABLE_PAT'),
     BASE_ID=osenv.get('AIRTABLE_BASE_KEY'),
     USERS_TABLE=osenv.get('USERS_TABLE', 'USERS').upper(),
-    PENDING_USERS_TABLE=osenv.get('PENDING_USERS_TABLE', 'PENDING_USERS').upper()
+    PENDING_USERS_TABLE=osenv.get('PENDING_USERS_TABLE', 'PENDING_USERS').upper(),
+    PAGE_SIZE=min(int(osenv.get('AIRTABLE_PAGE_SIZE', '100')), 100),  # records per list request (Airtable's maximum is 100)
 )
 
 ENC_PASSWORD = osenv.get('ENC_PASSWORD')
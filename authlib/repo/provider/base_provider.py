@@ -1,5 +1,7 @@
+import datetime
+import re
 from abc import ABC, abstractmethod
-from typing import List, Literal
+from typing import Iterable, Iterator, List, Literal, Optional, Tuple
 
 class StorageProvider(ABC):
     @abstractmethod
@@ -37,3 +39,154 @@ class StorageProvider(ABC):
         """Deletes record from users table."""
         pass
 
+    ### STREAMING ###
+    # Same context as `query`, plus optional 'page_size' and 'sort' (list of fields, '-field'
+    # for descending). Rows are yielded as they arrive, so a caller that consumes them one
+    # at a time holds one page in memory. SQLite and Airtable page through the result; the
+    # default sorts the result of `query` (sort fields must then be among the fields).
+
+    def iterate(self, context: dict=None) -> Iterator[dict]:
+        """Yields the rows of a query one at a time, in context['sort'] order if given."""
+        rows = self.query(context)
+        yield from self.sort_rows(rows, self.sort_order(context.get('sort')))
+
+    @staticmethod
+    def sort_order(sort: Optional[Iterable[str]]) -> List[Tuple[str, bool]]:
+        """[(field, descending), ...] from a 'sort' list such as ['-logins_count', 'username']."""
+        order = []
+        for field in sort or ():
+            name = field[1:] if field.startswith('-') else field
+            if not re.fullmatch(r'\w+', name):
+                raise ValueError(f'Invalid sort field: {field}')
+            order.append((name, field.startswith('-')))
+        return order
+
+    @staticmethod
+    def sort_key(field: str):
+        """Sort key for one field; NULLs sort first, as in SQLite."""
+        return lambda row: (row[field] is not None, row[field])
+
+    @staticmethod
+    def sort_rows(rows: List[dict], order: List[Tuple[str, bool]]) -> List[dict]:
+        """`rows` sorted by `order` (stable sorts from the last field to the first)."""
+        for field, descending in reversed(order):
+            rows = sorted(rows, key=StorageProvider.sort_key(field), reverse=descending)
+        return rows
+
+    ### BULK OPERATIONS ###
+    # Defaults loop over the single-row calls. Providers override them with a real
+    # bulk path (one transaction / executemany / batched API calls).
+
+    def upsert_many(self, context: dict=None) -> None:
+        """Upserts every row in context['rows'] (list of cols + value dicts) into context['table']."""
+        assert(context is not None and context.get('rows') is not None)
+        for row in context['rows']:
+            self.upsert({'table': context.get('table', 'USERS'), 'data': row})
+
+    def delete_many(self, context: dict=None) -> int:
+        """Deletes the records of every username in context['usernames'] from context['table']. Returns rows deleted."""
+        assert(context is not None and context.get('usernames') is not None)
+        table_name = context.get('table', 'USERS')
+        deleted = 0
+        for username in dict.fromkeys(context['usernames']):
+            conds = f'username="{username}"'
+            if self.query({'table': table_name, 'fields': 'username', 'conds': conds, 'modifier': 'LIMIT 1'}):
+                self.delete({'table': table_name, 'conds': conds})
+                deleted += 1
+        return deleted
+
+    ### PARTIAL UPDATES ###
+    # Unlike upsert (which replaces the whole row), these only touch the supplied
+    # columns of an existing row and never insert. Defaults read-merge-write.
+    #
+    # update:      {'table', 'data': {username, col: value, ...}, 'increment': {col: n}}
+    # update_many: {'table', 'rows': [data, ...], 'increments': {username: {col: n}}}
+
+    def update(self, context: dict=None) -> int:
+        """Sets the columns in context['data'] on the row of data['username']. Returns rows updated (0 or 1)."""
+        assert(context is not None and context.get('data') is not None)
+        assert(context['data'].get('username') is not None)
+
+        table_name = context.get('table', 'USERS')
+        data = context['data']
+        rows = self.query({'table': table_name, 'fields': '*', 'conds': f'username="{data["username"]}"'})
+        if not rows:
+            return 0
+        row = {**rows[0], **data}
+        for col, n in (context.get('increment') or {}).items():
+            row[col] = (row.get(col) or 0) + n
+        self.upsert({'table': table_name, 'data': row})
+        return 1
+
+    def update_many(self, context: dict=None) -> int:
+        """Applies `update` for every row in context['rows']. Returns rows updated."""
+        assert(context is not None and context.get('rows') is not None)
+        table_name = context.get('table', 'USERS')
+        increments = context.get('increments') or {}
+        return sum(
+            self.update({'table': table_name, 'data': row, 'increment': increments.get(row['username'])})
+            for row in context['rows']
+        )
+
+    ### SIGN-UP COMPLETION ###
+    # Verifies a pending sign-up's PIN and moves the row from the pending users table to
+    # the users table as one operation.
+    #
+    # complete_signup: {'table': pending table, 'users_table', 'username', 'pin', 'max_attempts',
+    #                   'data': {cols of the new users row other than username and password}}
+    #             ==> {'outcome': see SIGNUP_OUTCOMES, 'user': the new users row (outcome 'ok') or None}
+    #
+    # 'mismatch' counts an attempt on the pending row; 'ok', 'expired' and 'registered'
+    # delete it. The default runs the steps as separate calls; SQL providers override it
+    # with a single transaction.
+
+    SIGNUP_OUTCOMES = ('ok', 'missing', 'expired', 'validated', 'attempts', 'mismatch', 'registered')
+
+    @staticmethod
+    def signup_outcome(pending: Optional[dict], pin: str, max_attempts: int, now: datetime.datetime = None) -> str:
+        """Checks a pending users row against a PIN ('registered' is left to the caller)."""
+        if not pending:
+            return 'missing'
+        try:
+            if (now or datetime.datetime.now()) > datetime.datetime.fromisoformat(pending.get('expires_at')):
+                return 'expired'
+        except (TypeError, ValueError):
+            return 'expired'
+        if pending.get('is_validated'):
+            return 'validated'
+        if int(pending.get('pin_attempts') or 0) >= max_attempts:
+            return 'attempts'
+        if pending.get('validation_pin') != pin:
+            return 'mismatch'
+        return 'ok'
+
+    def complete_signup(self, context: dict=None) -> dict:
+        """Verifies context['pin'] and moves the pending user to the users table."""
+        assert(context is not None and context.get('username') is not None)
+
+        pending_table = context.get('table', 'PENDING_USERS')
+        username = context['username']
+        conds = f'username="{username}"'
+        rows = self.query({'table': pending_table, 'fields': '*', 'conds': conds})
+        pending = rows[0] if rows else None
+        outcome = self.signup_outcome(pending, context.get('pin'), context.get('max_attempts', 5))
+        users_table = context.get('users_table', 'USERS')
+        if outcome == 'ok' and self.query({'table': users_table, 'fields': 'username', 'conds': conds, 'modifier': 'LIMIT 1'}):
+            outcome = 'registered'
+
+        user = None
+        if outcome == 'mismatch':
+            self.update({'table': pending_table, 'data': {'username': username}, 'increment': {'pin_attempts': 1}})
+        elif outcome == 'ok':
+            user = {**(context.get('data') or {}), 'username': username, 'password': pending['password']}
+            self.upsert({'table': users_table, 'data': user})
+        if outcome in ('ok', 'expired', 'registered'):
+            self.delete({'table': pending_table, 'conds': conds})
+        return {'outcome': outcome, 'user': user}
+
+    ### OPTIONAL HOOKS ###
+
+    def tag_session_token(self, username: str, token: str) -> str:
+        """Returns the session token to issue for `username`. Providers may embed routing info in it."""
+        return token
+
@@ -0,0 +1,76 @@
+"""
+Parsing of the simple `conds` strings used by callers of StorageProvider.query/delete.
+
+Callers build conds like `username="bob"` or `auth_token="..." AND su=1`. Providers
+that don't speak SQL (or that route by key) parse them into an equality dict.
+"""
+
+import re
+from typing import List, Optional, Tuple
+
+_TERM_RE = re.compile(r'''\s*(\w+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|'((?:[^'\\]|\\.)*)'|(-?\d+(?:\.\d+)?))\s*''')
+_AND_RE = re.compile(r'\s+AND\s+', re.IGNORECASE)
+_UNSAFE_RE = re.compile(r'["\'\\\x00-\x1f\x7f]')
+_MODIFIER_RE = re.compile(r'\s*(?:ORDER\s+BY\s+(.+?))?\s*(?:LIMIT\s+(\d+))?\s*', re.IGNORECASE | re.DOTALL)
+_ORDER_TERM_RE = re.compile(r'\s*(\w+)(?:\s+(ASC|DESC))?\s*', re.IGNORECASE)
+
+
+def parse_conds(conds: Optional[str]) -> Optional[dict]:
+    """
+    Parse `col="value" [AND col2=123 ...]` into {col: value}.
+
+    Returns {} for empty conds, and None if any term isn't a simple equality
+    (callers then fall back to a generic path).
+    """
+    if not conds or not conds.strip():
+        return {}
+    result = {}
+    for term in _AND_RE.split(conds.strip()):
+        m = _TERM_RE.fullmatch(term)
+        if not m:
+            return None
+        col, dq, sq, num = m.groups()
+        if dq is not None:
+            value = dq
+        elif sq is not None:
+            value = sq
+        else:
+            value = float(num) if '.' in num else int(num)
+        result[col] = value
+    return result
+
+
+def is_literal(value) -> bool:
+    """True if `value` can be quoted into a conds string as-is (no quotes, backslashes or control characters)."""
+    return isinstance(value, str) and bool(value) and not _UNSAFE_RE.search(value)
+
+
+def parse_modifier(modifier: Optional[str]) -> Optional[Tuple[List[Tuple[str, bool]], Optional[int]]]:
+    """
+    Parse `[ORDER BY col [ASC|DESC], ...] [LIMIT N]` into ([(col, descending), ...], N or None).
+
+    Returns ([], None) for an empty modifier, and None for anything else (providers that
+    don't hand the modifier to SQLite verbatim reject it rather than ignore part of it).
+    """
+    if not modifier or not modifier.strip():
+        return [], None
+    m = _MODIFIER_RE.fullmatch(modifier)
+    if not m:
+        return None
+    order, limit = m.groups()
+    order_by = []
+    for term in (order.split(',') if order else []):
+        t = _ORDER_TERM_RE.fullmatch(term)
+        if not t:
+            return None
+        order_by.append((t.group(1), (t.group(2) or '').upper() == 'DESC'))
+    return order_by, int(limit) if limit is not None else None
+
+
+def parse_limit(modifier: Optional[str]) -> Optional[int]:
+    """Return N from a `LIMIT N` modifier, else None."""
+    if modifier:
+        m = re.search(r'\bLIMIT\s+(\d+)', modifier, re.IGNORECASE)
+        if m:
+            return int(m.group(1))
+    return None
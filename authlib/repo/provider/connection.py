@@ -0,0 +1,179 @@
+"""
+Connection handling shared by the storage providers.
+
+A `ConnectionManager` owns a provider's connection (a sqlite3 connection, an Airtable
+Api, ...). After a connection-level failure it drops the connection and reconnects on
+the next call; query errors (bad SQL, constraint violations) leave it alone. A
+`CircuitBreaker` guards it: after CIRCUIT_FAILURE_THRESHOLD consecutive failures calls
+fail fast with `CircuitOpenError` for CIRCUIT_RESET_SECONDS (jittered, doubling up to
+CIRCUIT_MAX_RESET_SECONDS while the outage lasts). Then a single caller probes the
+connection (half-open) and either closes the circuit or opens it again.
+"""
+
+import logging
+import random
+import threading
+import time
+from os import environ as osenv
+from typing import Callable, Optional
+
+from . import DatabaseError
+from authlib.common.metrics import METRICS
+
+CIRCUIT_FAILURE_THRESHOLD = int(osenv.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_SECONDS = float(osenv.get('CIRCUIT_RESET_SECONDS', '5'))
+CIRCUIT_MAX_RESET_SECONDS = float(osenv.get('CIRCUIT_MAX_RESET_SECONDS', '120'))
+CIRCUIT_JITTER = float(osenv.get('CIRCUIT_JITTER', '0.5'))  # +/- fraction of the reset delay
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class CircuitOpenError(DatabaseError):
+    def __init__(self, label: str, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__({
+            "code": "Circuit open",
+            "description": f'Storage `{label}` is unavailable; failing fast',
+            "message": f'retry in {retry_after:.1f}s',
+        }, 503)
+
+
+class CircuitBreaker:
+    """Thread-safe closed -> open -> half-open circuit breaker."""
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_seconds: float = CIRCUIT_RESET_SECONDS,
+                 max_reset_seconds: float = CIRCUIT_MAX_RESET_SECONDS, jitter: float = CIRCUIT_JITTER, label: str = '-'):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.max_reset_seconds = max_reset_seconds
+        self.jitter = jitter
+        self.label = label
+        self.state = CLOSED
+        self.failures = 0
+        self._trips = 0           # consecutive openings, for backoff
+        self._opened_until = 0.0
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        return max(0.0, self._opened_until - time.monotonic()) if self.state != CLOSED else 0.0
+
+    def acquire(self) -> bool:
+        """
+        Raise CircuitOpenError while open. Returns True if the caller is the half-open
+        probe (it must report `success()` or `failure()`), else False.
+        """
+        if self.state == CLOSED:
+            return False
+        with self._lock:
+            if self.state == OPEN and time.monotonic() >= self._opened_until:
+                self.state = HALF_OPEN
+                METRICS.inc('storage.circuit', provider=self.label, outcome=HALF_OPEN)
+                return True
+            if self.state == CLOSED:
+                return False
+        METRICS.inc('storage.circuit', provider=self.label, outcome='rejected')
+        raise CircuitOpenError(self.label, self.retry_after())
+
+    def allow(self) -> bool:
+        """Non-raising `acquire`: True if a call may go ahead."""
+        try:
+            self.acquire()
+            return True
+        except CircuitOpenError:
+            return False
+
+    def success(self) -> None:
+        if self.state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            if self.state != CLOSED:
+                logging.info(f'Circuit for `{self.label}` closed')
+                METRICS.inc('storage.circuit', provider=self.label, outcome=CLOSED)
+            self.state = CLOSED
+            self.failures = 0
+            self._trips = 0
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                delay = min(self.max_reset_seconds, self.reset_seconds * 2 ** self._trips)
+                delay *= 1 + random.uniform(-self.jitter, self.jitter)
+                self._opened_until = time.monotonic() + delay
+                self._trips += 1
+                if self.state != OPEN:
+                    logging.warning(f'Circuit for `{self.label}` opened for {delay:.1f}s after {self.failures} failures')
+                    METRICS.inc('storage.circuit', provider=self.label, outcome=OPEN)
+                self.state = OPEN
+
+
+class ConnectionManager:
+    """
+    Lazily (re)connects and hands out a provider's connection behind a CircuitBreaker.
+
+    Args:
+        connect: Creates a new connection.
+        close: Closes a connection (errors are ignored).
+        probe: Cheap health check run on the half-open probe call.
+        is_connection_error: True if an exception means the connection is unusable.
+            Other exceptions neither drop the connection nor count against the circuit.
+        label: Name used in logs and metrics.
+        conn: An already open connection to start with.
+    """
+
+    def __init__(self, connect: Callable[[], object], close: Optional[Callable[[object], None]] = None,
+                 probe: Optional[Callable[[object], object]] = None,
+                 is_connection_error: Callable[[Exception], bool] = lambda ex: True,
+                 breaker: Optional[CircuitBreaker] = None, label: str = '-', conn=None):
+        self._connect = connect
+        self._close = close
+        self._probe = probe
+        self.is_connection_error = is_connection_error
+        self.breaker = breaker or CircuitBreaker(label=label)
+        self.label = label
+        self._conn = conn
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """The live connection, connecting first if needed. Raises CircuitOpenError while the circuit is open."""
+        probing = self.breaker.acquire()
+        try:
+            conn = self._conn
+            if conn is None:
+                with self._lock:
+                    if self._conn is None:
+                        self._conn = self._connect()
+                        METRICS.inc('storage.connect', provider=self.label)
+                    conn = self._conn
+            if probing and self._probe is not None:
+                self._probe(conn)
+        except Exception as ex:
+            logging.warning(f'Connecting to `{self.label}` failed: {str(ex)}')
+            self.failed(ex, force=True)
+            raise
+        if probing:
+            self.breaker.success()
+        return conn
+
+    def succeeded(self) -> None:
+        self.breaker.success()
+
+    def failed(self, ex: Exception, force: bool = False) -> None:
+        """Report a failed call: connection errors drop the connection and count against the circuit."""
+        if isinstance(ex, CircuitOpenError) or not (force or self.is_connection_error(ex)):
+            return
+        self.reset()
+        self.breaker.failure()
+
+    def reset(self) -> None:
+        """Drop the current connection; the next `acquire` reconnects."""
+        with self._lock:
+            conn, self._conn = self._conn, None
+        if conn is not None and self._close is not None:
+            try:
+                self._close(conn)
+            except Exception:
+                pass
+
+    def close(self) -> None:
+        self.reset()
@@ -0,0 +1,390 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left, insort
+from typing import Dict, List, Literal, Optional
+
+from ..base_provider import StorageProvider
+from ..conds import parse_conds, parse_limit
+
+from .settings import MEMORY_SETTINGS
+from . import DatabaseError
+from authlib.common.metrics import metered
+from authlib.common.query_log import log_query, redact, redact_conds
+from authlib.common.user_record import UserRecord, column_index
+
+
+class _Table:
+    """Rows keyed by username, with a sorted username index and secondary hash indexes."""
+
+    def __init__(self, indexed=('auth_token',)):
+        self.rows: Dict[str, dict] = {}
+        self.usernames: List[str] = []  # sorted, for ordered listings
+        self.indexes: Dict[str, Dict[object, str]] = {col: {} for col in indexed}
+
+    def put(self, row: dict) -> None:
+        username = row['username']
+        old = self.rows.get(username)
+        if old is None:
+            insort(self.usernames, username)
+        else:
+            self._unindex(old)
+        self.rows[username] = row
+        for col, index in self.indexes.items():
+            if row.get(col) is not None:
+                index[row[col]] = username
+
+    def remove(self, username: str) -> None:
+        row = self.rows.pop(username, None)
+        if row is not None:
+            self._unindex(row)
+            del self.usernames[bisect_left(self.usernames, username)]
+
+    def _unindex(self, row: dict) -> None:
+        for col, index in self.indexes.items():
+            if row.get(col) is not None and index.get(row[col]) == row['username']:
+                del index[row[col]]
+
+    def find(self, conds: dict) -> List[dict]:
+        if 'username' in conds:
+            candidates = [self.rows[conds['username']]] if conds['username'] in self.rows else []
+        else:
+            indexed = next((col for col in conds if col in self.indexes), None)
+            if indexed is not None:
+                username = self.indexes[indexed].get(conds[indexed])
+                candidates = [self.rows[username]] if username is not None else []
+            else:
+                candidates = (self.rows[u] for u in self.usernames)
+        return [row for row in candidates if all(row.get(col) == value for col, value in conds.items())]
+
+
+class MemoryProvider(StorageProvider):
+    """
+    Dict-backed storage provider for tests, ephemeral demos and latency-critical
+    single-process deployments.
+
+    Lookups by username or auth token are hash-map hits; listings walk a sorted
+    username index. Expired pending users stay until `SignupManager.cleanup_expired` or
+    `auth_cli purge-expired` deletes them, so sign-up completion can tell an expired PIN apart.
+    If MEMORY_SNAPSHOT_PATH is set, every write is appended to a JSON-lines journal
+    and a full snapshot is written at most every MEMORY_SNAPSHOT_INTERVAL_SECONDS
+    (which truncates the journal). State is restored from snapshot + journal on start.
+    """
+
+    def __init__(self, allow_db_create=False, if_table_exists: Literal['ignore', 'recreate'] = 'ignore', snapshot_path=None):
+        self.snapshot_path = snapshot_path if snapshot_path is not None else MEMORY_SETTINGS.SNAPSHOT_PATH
+        self.journal_path = f'{self.snapshot_path}.journal' if self.snapshot_path else None
+        self.db_name = os.path.basename(self.snapshot_path) if self.snapshot_path else ':memory:'
+        self.users_table = MEMORY_SETTINGS.USERS_TABLE
+        self.pending_users_table = MEMORY_SETTINGS.PENDING_USERS_TABLE
+
+        self._lock = threading.RLock()
+        self.tables = {
+            self.users_table: _Table(indexed=('auth_token',)),
+            self.pending_users_table: _Table(indexed=()),
+        }
+        self._journal = None
+        self._last_snapshot = time.monotonic()
+
+        if self.snapshot_path:
+            if if_table_exists == 'recreate':
+                self._remove_persisted()
+            else:
+                self._load()
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    # --------------------------------------------------------------------------
+    # Persistence
+
+    def _remove_persisted(self) -> None:
+        for path in (self.snapshot_path, self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _load(self) -> None:
+        try:
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path, encoding='utf-8') as f:
+                    snapshot = json.load(f)
+                for table_name, rows in snapshot.get('tables', {}).items():
+                    table = self._table(table_name)
+                    for row in rows:
+                        table.put(row)
+            replayed = 0
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, encoding='utf-8') as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            logging.warning(f">>> Ignoring torn journal entry in `{self.journal_path}` <<<")
+                            break
+                        self._apply(entry)
+                        replayed += 1
+            logging.info(f">>> Loaded memory store `{self.db_name}` ({replayed} journal entries replayed) <<<")
+        except Exception as ex:
+            raise DatabaseError({
+                "code": "Memory store exception",
+                "description": f'`_load({self.snapshot_path})`\nEnsure snapshot and journal files are readable',
+                "message": str(ex),
+            }, 500)
+
+    def _apply(self, entry: dict) -> None:
+        table = self._table(entry['table'])
+        if entry['op'] == 'upsert':
+            table.put(entry['data'])
+        elif entry['op'] == 'delete':
+            for username in entry['usernames']:
+                table.remove(username)
+
+    def _record(self, entry: dict) -> None:
+        """Append a write to the journal and snapshot if the interval has elapsed. Caller holds the lock."""
+        if self._journal is None:
+            return
+        self._journal.write(json.dumps(entry, default=str) + '\n')
+        self._journal.flush()
+        if time.monotonic() - self._last_snapshot >= MEMORY_SETTINGS.SNAPSHOT_INTERVAL:
+            self.snapshot()
+
+    def snapshot(self) -> None:
+        """Write a full snapshot atomically and truncate the journal."""
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            tmp_path = f'{self.snapshot_path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'created_at': datetime.datetime.now().isoformat(),
+                    'tables': {name: [table.rows[u] for u in table.usernames] for name, table in self.tables.items()},
+                }, f, default=str)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            if self._journal is not None:
+                self._journal.close()
+            self._journal = open(self.journal_path, 'w', encoding='utf-8')
+            self._last_snapshot = time.monotonic()
+
+    # --------------------------------------------------------------------------
+    # Private helpers
+
+    def _table(self, table_name: str) -> _Table:
+        table = self.tables.get(table_name.upper())
+        if table is None:
+            table = self.tables[table_name.upper()] = _Table()
+        return table
+
+    @staticmethod
+    def _conds(conds: Optional[str]) -> dict:
+        parsed = parse_conds(conds)
+        if parsed is None:
+            raise ValueError(f'Unsupported conds for memory provider (use col="value" [AND ...]): {conds}')
+        return parsed
+
+    @staticmethod
+    def _project(row: dict, fields: str) -> UserRecord:
+        if fields.strip() == '*':
+            return UserRecord.from_columns(row.keys(), row.values())
+        columns = tuple(f.strip() for f in fields.split(','))
+        return UserRecord(column_index(columns), tuple(row.get(col) for col in columns))
+
+    # --------------------------------------------------------------------------
+    # StorageProvider interface implementation
+
+    @property
+    def persistent(self) -> bool:
+        """False without a snapshot path: the data lives only in this object."""
+        return bool(self.snapshot_path)
+
+    def close_database(self) -> None:
+        """Writes a final snapshot (if persistent) and closes the journal."""
+        with self._lock:
+            if self._journal is not None:
+                self.snapshot()
+                self._journal.close()
+                self._journal = None
+
+    @metered('storage.upsert')
+    def upsert(self, context: dict=None) -> None:
+        """Updates or inserts a record (replaces the whole row, like SQLite REPLACE)."""
+        assert(context is not None and context.get('data') is not None)
+        assert(context['data'].get('username') is not None)
+
+        table_name = context.get('table', 'USERS')
+        data = dict(context['data'])
+
+        started = time.perf_counter()
+        try:
+            with self._lock:
+                self._table(table_name).put(data)
+                self._record({'op': 'upsert', 'table': table_name.upper(), 'data': data})
+        except Exception as ex:
+            log_query(self, 'upsert', table_name, started, data=data, error=ex)
+            raise DatabaseError({
+                "code": "Memory store exception",
+                "description": f'Database: `{self.db_name}`\n`upsert({redact(data)})`',
+                "message": str(ex),
+            }, 500)
+        log_query(self, 'upsert', table_name, started, data=data)
+
+    @metered('storage.query')
+    def query(self, context: dict=None) -> List[dict]:
+        """Executes a query and returns rows (read-only UserRecord copies), ordered by username."""
+        assert(context is not None and context.get('fields') is not None)
+
+        table_name = context.get('table', 'USERS')
+        fields = context.get('fields')
+        conds = context.get('conds')
+        modifier = context.get('modifier')
+
+        started = time.perf_counter()
+        try:
+            limit = parse_limit(modifier)
+            with self._lock:
+                rows = self._table(table_name).find(self._conds(conds))
+                if limit is not None:
+                    rows = rows[:limit]
+                results = [self._project(row, fields) for row in rows]
+        except Exception as ex:
+            log_query(self, 'query', table_name, started, fields=fields, conds=conds, modifier=modifier, error=ex)
+            raise DatabaseError({
+                "code": "Memory store exception",
+                "description": f'Database: `{self.db_name}`\n`query({fields}, {redact_conds(conds)}, {modifier})`',
+                "message": str(ex),
+            }, 500)
+        log_query(self, 'query', table_name, started, fields=fields, conds=conds, modifier=modifier, rows=len(results))
+        return results
+
+    @metered('storage.delete')
+    def delete(self, context: dict=None) -> None:
+        """Deletes matching records from specified table."""
+        assert(context is not None and context.get('conds') is not None)
+
+        table_name = context.get('table', 'USERS')
+        conds = context['conds']
+
+        started = time.perf_counter()
+        try:
+            with self._lock:
+                table = self._table(table_name)
+                usernames = [row['username'] for row in table.find(self._conds(conds))]
+                for username in usernames:
+                    table.remove(username)
+                if usernames:
+                    self._record({'op': 'delete', 'table': table_name.upper(), 'usernames': usernames})
+        except Exception as ex:
+            log_query(self, 'delete', table_name, started, conds=conds, error=ex)
+            raise DatabaseError({
+                "code": "Memory store exception",
+                "description": f'Database: `{self.db_name}`\n`delete({redact_conds(conds)})`',
+                "message": str(ex),
+            }, 500)
+        log_query(self, 'delete', table_name, started, conds=conds, rows=len(usernames))
+
+    @metered('storage.delete_many')
+    def delete_many(self, context: dict=None) -> int:
+        """Deletes all given usernames under one lock (one journal entry). Returns rows deleted."""
+        assert(context is not None and context.get('usernames') is not None)
+
+        table_name = context.get('table', 'USERS')
+
+        started = time.perf_counter()
+        with self._lock:
+            table = self._table(table_name)
+            usernames = [username for username in dict.fromkeys(context['usernames']) if username in table.rows]
+            for username in usernames:
+                table.remove(username)
+            if usernames:
+                self._record({'op': 'delete', 'table': table_name.upper(), 'usernames': usernames})
+        log_query(self, 'delete_many', table_name, started, rows=len(usernames))
+        return len(usernames)
+
+    @metered('storage.update')
+    def update(self, context: dict=None) -> int:
+        """Sets the supplied columns on an existing row (no insert, other columns untouched)."""
+        assert(context is not None and context.get('data') is not None)
+        assert(context['data'].get('username') is not None)
+        username = context['data']['username']
+        return self.update_many({
+            'table': context.get('table', 'USERS'),
+            'rows': [context['data']],
+            'increments': {username: context['increment']} if context.get('increment') else None,
+        })
+
+    @metered('storage.update_many')
+    def update_many(self, context: dict=None) -> int:
+        """Partial updates for many rows under one lock acquisition."""
+        assert(context is not None and context.get('rows') is not None)
+
+        table_name = context.get('table', 'USERS')
+        rows = context['rows']
+        increments = context.get('increments') or {}
+
+        started = time.perf_counter()
+        try:
+            updated = 0
+            with self._lock:
+                table = self._table(table_name)
+                for changes in rows:
+                    row = table.rows.get(changes['username'])
+                    if row is None:
+                        continue
+                    merged = {**row, **changes}
+                    for col, n in (increments.get(changes['username']) or {}).items():
+                        merged[col] = (merged.get(col) or 0) + n
+                    table.put(merged)
+                    self._record({'op': 'upsert', 'table': table_name.upper(), 'data': merged})
+                    updated += 1
+        except Exception as ex:
+            log_query(self, 'update_many', table_name, started, rows=len(rows), error=ex)
+            raise DatabaseError({
+                "code": "Memory store exception",
+                "description": f'Database: `{self.db_name}`\n`update_many({len(rows)} rows)`',
+                "message": str(ex),
+            }, 500)
+        log_query(self, 'update_many', table_name, started, rows=updated)
+        return updated
+
+    @metered('storage.complete_signup', outcome=lambda result: result['outcome'])
+    def complete_signup(self, context: dict=None) -> dict:
+        """Verifies the PIN and moves the pending user to the users table under one lock acquisition."""
+        assert(context is not None and context.get('username') is not None)
+
+        pending_table = context.get('table', self.pending_users_table).upper()
+        users_table = context.get('users_table', self.users_table).upper()
+        username = context['username']
+
+        started = time.perf_counter()
+        try:
+            with self._lock:
+                pending = self._table(pending_table).rows.get(username)
+                outcome = self.signup_outcome(pending, context.get('pin'), context.get('max_attempts', 5))
+                if outcome == 'ok' and username in self._table(users_table).rows:
+                    outcome = 'registered'
+
+                user = None
+                if outcome == 'mismatch':
+                    pending = {**pending, 'pin_attempts': int(pending.get('pin_attempts') or 0) + 1}
+                    self._table(pending_table).put(pending)
+                    self._record({'op': 'upsert', 'table': pending_table, 'data': pending})
+                elif outcome == 'ok':
+                    user = {**(context.get('data') or {}), 'username': username, 'password': pending['password']}
+                    self._table(users_table).put(user)
+                    self._record({'op': 'upsert', 'table': users_table, 'data': user})
+                if outcome in ('ok', 'expired', 'registered'):
+                    self._table(pending_table).remove(username)
+                    self._record({'op': 'delete', 'table': pending_table, 'usernames': [username]})
+        except Exception as ex:
+            log_query(self, 'complete_signup', pending_table, started, error=ex)
+            raise DatabaseError({
+                "code": "Memory store exception",
+                "description": f'Database: `{self.db_name}`\n`complete_signup()`',
+                "message": str(ex),
+            }, 500)
+        log_query(self, 'complete_signup', pending_table, started, rows=1 if user else 0)
+        return {'outcome': outcome, 'user': dict(user) if user else None}
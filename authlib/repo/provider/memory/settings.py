@@ -0,0 +1,11 @@
+from os import environ as osenv
+from collections import namedtuple
+
+MEMORY_SETTINGS = namedtuple('memory_settings', ['SNAPSHOT_PATH', 'SNAPSHOT_INTERVAL', 'USERS_TABLE', 'PENDING_USERS_TABLE'])(
+    # Optional JSON snapshot file. Its append-only journal is written next to it as `<SNAPSHOT_PATH>.journal`.
+    # Unset means a purely in-memory (ephemeral) store.
+    SNAPSHOT_PATH=osenv.get('MEMORY_SNAPSHOT_PATH'),
+    SNAPSHOT_INTERVAL=float(osenv.get('MEMORY_SNAPSHOT_INTERVAL_SECONDS', '60')),
+    USERS_TABLE=osenv.get('USERS_TABLE', 'USERS').upper(),
+    PENDING_USERS_TABLE=osenv.get('PENDING_USERS_TABLE', 'PENDING_USERS').upper()
+)
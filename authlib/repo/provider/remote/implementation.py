@@ -0,0 +1,253 @@
+import http.client
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Literal, Optional
+from urllib.parse import urlsplit
+
+from ..base_provider import StorageProvider
+from ..connection import CircuitBreaker
+
+from .settings import REMOTE_SETTINGS
+from . import DatabaseError
+from authlib.common.metrics import metered, METRICS
+from authlib.common.user_record import column_index, UserRecord
+
+# A kept-alive connection the service has since closed fails like this before the request is processed
+_STALE_CONNECTION = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+
+class RemoteProvider(StorageProvider):
+    """
+    Storage provider backed by the shared auth service (see `authlib.auth_service`).
+
+    Every provider call is a JSON POST to the service, which runs the real provider. Each
+    thread keeps its own HTTP/1.1 connection alive between calls. Query results are cached
+    in this process for AUTH_SERVICE_CACHE_SECONDS (rows are read-only UserRecords, so they
+    are shared safely); any write through this provider clears the cache. Writes made by
+    other apps are seen once the cached entry expires.
+
+    `login`, `validate_session`, `logout`, `signup` and `verify_signup` call the service's
+    session endpoints directly, for apps that don't run `auth()`.
+    """
+
+    def __init__(self, allow_db_create=False, if_table_exists: Literal['ignore', 'recreate'] = 'ignore',
+                 url=None, tenant=None):
+        logging.info('>>> RemoteProvider: the auth service owns the database; ignoring `allow_db_create` and `if_table_exists` args. <<<')
+        parts = urlsplit(url or REMOTE_SETTINGS.URL)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname or '127.0.0.1'
+        self.port = parts.port or (443 if self.https else 80)
+        self.base_path = parts.path.rstrip('/')
+        self.tenant = tenant
+        self.db_name = f'{parts.netloc}{f"/{tenant}" if tenant else ""}'
+
+        self.breaker = CircuitBreaker(label=type(self).__name__)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        self.cache_seconds = REMOTE_SETTINGS.CACHE_SECONDS
+        self._cache: 'OrderedDict[tuple, tuple]' = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+    # --------------------------------------------------------------------------
+    # Transport
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = self._local.conn = cls(self.host, self.port, timeout=REMOTE_SETTINGS.TIMEOUT)
+            with self._connections_lock:
+                self._connections.append(conn)
+            METRICS.inc('storage.connect', provider=type(self).__name__)
+        return conn
+
+    def _drop_connection(self) -> None:
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn.close()
+            with self._connections_lock:
+                if conn in self._connections:
+                    self._connections.remove(conn)
+
+    def call(self, path: str, payload: dict) -> dict:
+        """POST `payload` to the service and return the decoded reply. Service errors raise DatabaseError."""
+        self.breaker.acquire()
+        if self.tenant is not None:
+            payload = {**payload, 'tenant': self.tenant}
+        body = json.dumps(payload)
+        headers = {'Content-Type': 'application/json'}
+        if REMOTE_SETTINGS.KEY:
+            headers['Authorization'] = f'Bearer {REMOTE_SETTINGS.KEY}'
+
+        for attempt in (1, 2):
+            reused = getattr(self._local, 'conn', None) is not None
+            conn = self._connection()
+            try:
+                conn.request('POST', f'{self.base_path}{path}', body=body, headers=headers)
+                response = conn.getresponse()
+                status, data = response.status, response.read()
+                break
+            except Exception as ex:
+                self._drop_connection()
+                if attempt == 1 and reused and isinstance(ex, _STALE_CONNECTION):
+                    continue  # the request never reached the service; retry once on a new connection
+                self.breaker.failure()
+                raise DatabaseError({
+                    "code": "Auth service unavailable",
+                    "description": f'`{path}` on `{self.host}:{self.port}` failed',
+                    "message": str(ex),
+                }, 503)
+        self.breaker.success()
+
+        reply = json.loads(data) if data else {}
+        if status != 200:
+            raise DatabaseError(reply.get('error') or {"code": "Auth service error", "description": path, "message": ''}, status)
+        return reply
+
+    # --------------------------------------------------------------------------
+    # Query cache
+
+    def _cached(self, key: tuple):
+        if self.cache_seconds <= 0:
+            return None
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                self._cache_hits += 1
+                return entry[1]
+            self._cache_misses += 1
+            return None
+
+    def _remember(self, key: tuple, rows: list) -> None:
+        if self.cache_seconds <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = (time.monotonic() + self.cache_seconds, rows)
+            self._cache.move_to_end(key)
+            while len(self._cache) > REMOTE_SETTINGS.CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def invalidate_cache(self) -> None:
+        with self._cache_lock:
+            self._cache.clear()
+
+    def _write(self, op: str, context: dict):
+        try:
+            return self.call(f'/v1/storage/{op}', {'context': context}).get('result')
+        finally:
+            self.invalidate_cache()
+
+    def pool_stats(self) -> dict:
+        """Open keep-alive connections and query cache statistics."""
+        with self._cache_lock:
+            return {
+                'service': f'{self.host}:{self.port}',
+                'connections': len(self._connections),
+                'cache_entries': len(self._cache),
+                'cache_hits': self._cache_hits,
+                'cache_misses': self._cache_misses,
+            }
+
+    # --------------------------------------------------------------------------
+    # StorageProvider interface implementation
+
+    def close_database(self) -> None:
+        """Closes every kept-alive connection (the next call reconnects)."""
+        logging.info(f">>> Closing connections to auth service `{self.db_name}` <<<")
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+        self.invalidate_cache()
+
+    @metered('storage.upsert')
+    def upsert(self, context: dict=None) -> None:
+        """Updates or inserts a new user record with supplied data (cols + value dict)."""
+        assert(context is not None and context.get('data') is not None)
+        self._write('upsert', context)
+
+    @metered('storage.query')
+    def query(self, context: dict=None) -> List[dict]:
+        """Executes a query on users table and returns rows as read-only UserRecords."""
+        context = context or {}
+        key = (context.get('table', 'USERS'), context.get('fields', '*'), context.get('conds'), context.get('modifier'))
+        rows = self._cached(key)
+        if rows is None:
+            reply = self.call('/v1/storage/query', {'context': context})
+            index = column_index(tuple(reply['columns']))
+            rows = [UserRecord(index, tuple(values)) for values in reply['rows']]
+            self._remember(key, rows)
+        return list(rows)
+
+    @metered('storage.delete')
+    def delete(self, context: dict=None) -> None:
+        """Deletes record from users table."""
+        assert(context is not None)
+        self._write('delete', context)
+
+    @metered('storage.upsert_many')
+    def upsert_many(self, context: dict=None) -> None:
+        assert(context is not None and context.get('rows') is not None)
+        self._write('upsert_many', context)
+
+    @metered('storage.delete_many')
+    def delete_many(self, context: dict=None) -> int:
+        assert(context is not None and context.get('usernames') is not None)
+        return self._write('delete_many', context)
+
+    @metered('storage.update')
+    def update(self, context: dict=None) -> int:
+        assert(context is not None and context.get('data') is not None)
+        return self._write('update', context)
+
+    @metered('storage.update_many')
+    def update_many(self, context: dict=None) -> int:
+        assert(context is not None and context.get('rows') is not None)
+        return self._write('update_many', context)
+
+    @metered('storage.complete_signup', outcome=lambda result: result['outcome'])
+    def complete_signup(self, context: dict=None) -> dict:
+        """Runs the service provider's sign-up completion (one round trip)."""
+        assert(context is not None and context.get('username') is not None)
+        return self._write('complete_signup', context)
+
+    def tag_session_token(self, username: str, token: str) -> str:
+        """Lets the service's provider tag the token (e.g. with a shard id)."""
+        return self.call('/v1/storage/tag_session_token', {'context': {'username': username, 'token': token}})['result']
+
+    # --------------------------------------------------------------------------
+    # Session endpoints
+
+    def login(self, username: str, password: str, remember_me: bool = False, client: str = 'unknown') -> dict:
+        """{'user': principal, 'token': token or None}; raises DatabaseError (401/429) on failure."""
+        return self.call('/v1/login', {'username': username, 'password': password, 'remember_me': remember_me, 'client': client})
+
+    def validate_session(self, token: str, renew: bool = False) -> Optional[dict]:
+        """The session principal, or None if the token is invalid or expired."""
+        try:
+            return self.call('/v1/session/validate', {'token': token, 'renew': renew})['user']
+        except DatabaseError as ex:
+            if ex.status_code == 401:
+                return None
+            raise
+
+    def logout(self, token: str) -> bool:
+        return self.call('/v1/logout', {'token': token})['cleared']
+
+    def signup(self, email: str, password: str, client: str = 'unknown') -> bool:
+        """Creates a pending user and emails its PIN. Returns True if the email was sent."""
+        return self.call('/v1/signup', {'email': email, 'password': password, 'client': client})['sent']
+
+    def verify_signup(self, email: str, pin: str, client: str = 'unknown') -> dict:
+        """{'user': principal, 'token': token}; raises DatabaseError (400/429) on a wrong PIN."""
+        return self.call('/v1/signup/verify', {'email': email, 'pin': pin, 'client': client})
@@ -0,0 +1,12 @@
+from os import environ as osenv
+from collections import namedtuple
+
+REMOTE_SETTINGS = namedtuple('remote_settings', ['URL', 'KEY', 'TIMEOUT', 'CACHE_SECONDS', 'CACHE_SIZE'])(
+    # Base URL of the auth service (python -m authlib.auth_service)
+    URL=osenv.get('AUTH_SERVICE_URL', 'http://127.0.0.1:8765'),
+    KEY=osenv.get('AUTH_SERVICE_KEY'),
+    TIMEOUT=float(osenv.get('AUTH_SERVICE_TIMEOUT', '10')),
+    # Query results are cached per process for this long (0 disables); writes through this process clear the cache
+    CACHE_SECONDS=float(osenv.get('AUTH_SERVICE_CACHE_SECONDS', '2')),
+    CACHE_SIZE=int(osenv.get('AUTH_SERVICE_CACHE_SIZE', '1024')),
+)
@@ -0,0 +1,2 @@
+from .. import base_provider, const, trace_activity, AppError, DatabaseError
+from .. import tnow_iso , tnow_iso_str, dt_from_str, dt_from_ts, dt_to_str
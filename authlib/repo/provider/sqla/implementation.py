@@ -0,0 +1,399 @@
+import logging
+import time
+from typing import List, Literal
+
+# https://docs.sqlalchemy.org/en/20/core/
+from sqlalchemy import Column, Integer, MetaData, String, Table, bindparam, create_engine, func, inspect, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import CreateColumn
+
+from ..base_provider import StorageProvider
+from ..conds import parse_conds, parse_modifier
+
+from .settings import SQLALCHEMY_SETTINGS
+from . import DatabaseError
+from authlib.common.metrics import metered
+from authlib.common.query_log import log_query, redact, redact_conds
+from authlib.common.user_record import UserRecord, column_index
+
+
+def _define_tables(metadata: MetaData):
+    users = Table(
+        SQLALCHEMY_SETTINGS.USERS_TABLE, metadata,
+        Column('id', Integer, primary_key=True, autoincrement=True),
+        Column('username', String(255), unique=True, nullable=False),
+        Column('password', String(512)),
+        Column('su', Integer, default=0),
+        Column('roles', String(255)),
+        Column('auth_token', String(255), index=True),
+        Column('expires_at', String(64)),
+        Column('logins_count', Integer, default=0),
+        Column('last_login', String(64)),
+        Column('created_at', String(64)),
+        Column('updated_at', String(64)),
+    )
+    pending_users = Table(
+        SQLALCHEMY_SETTINGS.PENDING_USERS_TABLE, metadata,
+        Column('id', Integer, primary_key=True, autoincrement=True),
+        Column('username', String(255), unique=True, nullable=False),
+        Column('password', String(512)),
+        Column('validation_pin', String(16)),
+        Column('is_validated', Integer, default=0),
+        Column('expires_at', String(64)),
+        Column('pin_attempts', Integer, default=0),
+    )
+    return users, pending_users
+
+
+class SQLAlchemyProvider(StorageProvider):
+    """
+    Storage provider on SQLAlchemy core with a pooled engine, so the auth tables can live
+    in a client-server database (e.g. Postgres) as well as SQLite.
+
+    All values go through bound parameters. Simple equality conds (`username="bob"`) are
+    compiled to column comparisons. Anything else is passed through as a SQL text clause,
+    as the SQLite provider does.
+    """
+
+    def __init__(self, allow_db_create=False, if_table_exists: Literal['ignore', 'recreate'] = 'ignore', url=None):
+        url = url or SQLALCHEMY_SETTINGS.URL
+        try:
+            if url.startswith('sqlite') and (':memory:' in url or url.rstrip('/') == 'sqlite:'):
+                # One shared in-memory database; a pool would give each connection its own empty DB
+                self.engine = create_engine(url, poolclass=StaticPool, connect_args={'check_same_thread': False})
+            else:
+                self.engine = create_engine(
+                    url,
+                    pool_size=SQLALCHEMY_SETTINGS.POOL_SIZE,
+                    max_overflow=SQLALCHEMY_SETTINGS.MAX_OVERFLOW,
+                    pool_timeout=SQLALCHEMY_SETTINGS.POOL_TIMEOUT,
+                    pool_pre_ping=SQLALCHEMY_SETTINGS.POOL_PRE_PING,
+                    pool_recycle=SQLALCHEMY_SETTINGS.POOL_RECYCLE,
+                )
+            self.db_name = self.engine.url.database or self.engine.url.drivername
+
+            self.metadata = MetaData()
+            users, pending_users = _define_tables(self.metadata)
+            self.tables = {users.name: users, pending_users.name: pending_users}
+
+            if if_table_exists == 'recreate' and allow_db_create:
+                logging.info(f">>> Recreating tables in database `{self.db_name}` <<<")
+                self.metadata.drop_all(self.engine)
+            if allow_db_create:
+                self.metadata.create_all(self.engine)
+                self._add_missing_columns()
+            else:
+                missing = set(self.tables) - set(inspect(self.engine).get_table_names())
+                if missing:
+                    raise RuntimeError(f'Missing tables: {", ".join(sorted(missing))}')
+        except Exception as ex:
+            raise DatabaseError({
+                "code": "SQLAlchemy exception",
+                "description": f'`SQLAlchemyProvider({self.engine.url.render_as_string() if hasattr(self, "engine") else "?"}, '
+                               f'allow_db_create={allow_db_create})`\nEnsure DB entities exist',
+                "message": str(ex),
+            }, 500)
+
+    # --------------------------------------------------------------------------
+    # Private helpers
+
+    def _add_missing_columns(self) -> None:
+        """Add columns defined here that existing tables don't have yet (schema upgrades)."""
+        inspector = inspect(self.engine)
+        with self.engine.begin() as conn:
+            for table in self.tables.values():
+                existing = {col['name'] for col in inspector.get_columns(table.name)}
+                for col in table.columns:
+                    if col.name not in existing:
+                        logging.info(f">>> Adding column `{col.name}` to table `{table.name}` in database `{self.db_name}` <<<")
+                        conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {CreateColumn(col).compile(dialect=self.engine.dialect)}'))
+
+    def _table(self, table_name: str) -> Table:
+        return self.tables[table_name.upper()]
+
+    @staticmethod
+    def _where(table: Table, conds):
+        """Bound column comparisons for simple conds, else a text clause."""
+        parsed = parse_conds(conds)
+        if parsed is None:
+            return [text(conds)]
+        return [table.c[col] == value for col, value in parsed.items()]
+
+    @staticmethod
+    def _full_row(table: Table, data: dict) -> dict:
+        """Row with every column set, defaults for those not in `data` (REPLACE semantics)."""
+        row = {}
+        for col in table.columns:
+            if col.primary_key:
+                continue
+            if col.name in data:
+                row[col.name] = data[col.name]
+            else:
+                row[col.name] = col.default.arg if col.default is not None else None
+        return row
+
+    def _upsert_row(self, conn, table: Table, data: dict) -> None:
+        row = self._full_row(table, data)
+        result = conn.execute(table.update().where(table.c.username == row['username']).values(**row))
+        if result.rowcount == 0:
+            try:
+                with conn.begin_nested():
+                    conn.execute(table.insert().values(**row))
+            except IntegrityError:
+                # Concurrent insert of the same username won the race; update that row instead
+                conn.execute(table.update().where(table.c.username == row['username']).values(**row))
+
+    def pool_stats(self) -> dict:
+        """Connection pool statistics, for sizing the pool against login concurrency."""
+        pool = self.engine.pool
+        stats = {'pool': type(pool).__name__, 'status': pool.status()}
+        for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+            fn = getattr(pool, name, None)
+            if callable(fn):
+                stats[name] = fn()
+        return stats
+
+    # --------------------------------------------------------------------------
+    # StorageProvider interface implementation
+
+    def close_database(self) -> None:
+        """Closes all pooled connections."""
+        logging.info(f">>> Disposing engine for database `{self.db_name}` <<<")
+        self.engine.dispose()
+
+    @metered('storage.upsert')
+    def upsert(self, context: dict=None) -> None:
+        """Updates or inserts a record with supplied data (cols + value dict)."""
+        assert(context is not None and context.get('data') is not None)
+        assert(context['data'].get('username') is not None)
+
+        table_name = context.get('table', 'USERS')
+        data = context['data']
+
+        started = time.perf_counter()
+        try:
+            with self.engine.begin() as conn:
+                self._upsert_row(conn, self._table(table_name), data)
+        except Exception as ex:
+            log_query(self, 'upsert', table_name, started, data=data, error=ex)
+            raise DatabaseError({
+                "code": "SQLAlchemy exception",
+                "description": f'Database: `{self.db_name}`\n`upsert({redact(data)})`\nEnsure DB entities exist',
+                "message": str(ex),
+            }, 500)
+        log_query(self, 'upsert', table_name, started, data=data)
+
+    @metered('storage.query')
+    def query(self, context: dict=None) -> List[dict]:
+        """Executes a query and returns rows as list of dicts."""
+        assert(context is not None and context.get('fields') is not None)
+
+        table_name = context.get('table', 'USERS')
+        fields = context.get('fields')
+        conds = context.get('conds')
+        modifier = context.get('modifier')
+        parsed = parse_modifier(modifier)
+        if parsed is None:
+            raise ValueError(f'Unsupported modifier for SQLAlchemy provider (use [ORDER BY col [ASC|DESC], ...] [LIMIT N]): {modifier}')
+        order_by, limit = parsed
+
+        started = time.perf_counter()
+        try:
+            table = self._table(table_name)
+            if fields.strip() == '*':
+                columns = list(table.columns)
+            else:
+                columns = [table.c[f.strip()] for f in fields.split(',')]
+            stmt = select(*columns)
+            if conds:
+                stmt = stmt.where(*self._where(table, conds))
+            for col, descending in order_by:
+                stmt = stmt.order_by(table.c[col].desc() if descending else table.c[col].asc())
+            if limit is not None:
+                stmt = stmt.limit(limit)
+            with self.engine.connect() as conn:
+                result = conn.execute(stmt)
+                index = column_index(tuple(result.keys()))
+                results = [UserRecord(index, tuple(row)) for row in result]
+        except Exception as ex:
+            log_query(self, 'query', table_name, started, fields=fields, conds=conds, modifier=modifier, error=ex)
+            raise DatabaseError({
+                "code": "SQLAlchemy exception",
+                "description": f'Database: `{self.db_name}`\n`query({fields}, {redact_conds(conds)}, {modifier})`\nEnsure DB entities exist',
+                "message": str(ex),
+            }, 500)
+        log_query(self, 'query', table_name, started, fields=fields, conds=conds, modifier=modifier, rows=len(results))
+        return results
+
+    @metered('storage.delete')
+    def delete(self, context: dict=None) -> None:
+        """Deletes record from specified table."""
+        assert(context is not None and context.get('conds') is not None)
+
+        table_name = context.get('table', 'USERS')
+        conds = context['conds']
+
+        started = time.perf_counter()
+        try:
+            table = self._table(table_name)
+            stmt = table.delete()
+            if conds:
+                stmt = stmt.where(*self._where(table, conds))
+            with self.engine.begin() as conn:
+                rowcount = conn.execute(stmt).rowcount
+        except Exception as ex:
+            log_query(self, 'delete', table_name, started, conds=conds, error=ex)
+            raise DatabaseError({
+                "code": "SQLAlchemy exception",
+                "description": f'Database: `{self.db_name}`\n`delete({redact_conds(conds)})`\nEnsure DB entities exist',
+                "message": str(ex),
+            }, 500)
+        log_query(self, 'delete', table_name, started, conds=conds, rows=rowcount)
+
+    @metered('storage.upsert_many')
+    def upsert_many(self, context: dict=None) -> None:
+        """Replaces all rows in one transaction: bulk delete by username, then one executemany insert."""
+        assert(context is not None and context.get('rows') is not None)
+
+        table_name = context.get('table', 'USERS')
+        rows = context['rows']
+
+        started = time.perf_counter()
+        try:
+            table = self._table(table_name)
+            full_rows = list({row['username']: self._full_row(table, row) for row in rows}.values())
+            with self.engine.begin() as conn:
+                for i in range(0, len(full_rows), 500):
+                    batch = full_rows[i:i + 500]
+                    conn.execute(table.delete().where(table.c.username.in_([row['username'] for row in batch])))
+                if full_rows:
+                    conn.execute(table.insert(), full_rows)
+        except Exception as ex:
+            log_query(self, 'upsert_many', table_name, started, rows=len(rows), error=ex)
+            raise DatabaseError({
+                "code": "SQLAlchemy exception",
+                "description": f'Database: `{self.db_name}`\n`upsert_many({len(rows)} rows)`\nEnsure DB entities exist',
+                "message": str(ex),
+            }, 500)
+        log_query(self, 'upsert_many', table_name, started, rows=len(rows))
+
+    @metered('storage.delete_many')
+    def delete_many(self, context: dict=None) -> int:
+        """Deletes all given usernames in one transaction. Returns rows deleted."""
+        assert(context is not None and context.get('usernames') is not None)
+
+        table_name = context.get('table', 'USERS')
+        usernames = list(context['usernames'])
+
+        started = time.perf_counter()
+        deleted = 0
+        try:
+            table = self._table(table_name)
+            with self.engine.begin() as conn:
+                for i in range(0, len(usernames), 500):
+                    deleted += conn.execute(table.delete().where(table.c.username.in_(usernames[i:i + 500]))).rowcount
+        except Exception as ex:
+            log_query(self, 'delete_many', table_name, started, rows=len(usernames), error=ex)
+            raise DatabaseError({
+                "code": "SQLAlchemy exception",
+                "description": f'Database: `{self.db_name}`\n`delete_many({len(usernames)} usernames)`\nEnsure DB entities exist',
+                "message": str(ex),
+            }, 500)
+        log_query(self, 'delete_many', table_name, started, rows=deleted)
+        return deleted
+
+    @metered('storage.update')
+    def update(self, context: dict=None) -> int:
+        """Sets the supplied columns on an existing row (no insert, other columns untouched)."""
+        assert(context is not None and context.get('data') is not None)
+        assert(context['data'].get('username') is not None)
+        username = context['data']['username']
+        return self.update_many({
+            'table': context.get('table', 'USERS'),
+            'rows': [context['data']],
+            'increments': {username: context['increment']} if context.get('increment') else None,
+        })
+
+    @metered('storage.update_many')
+    def update_many(self, context: dict=None) -> int:
+        """Partial updates for many rows in one transaction, one executemany per distinct column set."""
+        assert(context is not None and context.get('rows') is not None)
+
+        table_name = context.get('table', 'USERS')
+        rows = context['rows']
+        increments = context.get('increments') or {}
+
+        started = time.perf_counter()
+        try:
+            table = self._table(table_name)
+            batches = {}
+            for row in rows:
+                counters = increments.get(row['username']) or {}
+                cols = tuple(col for col in row if col != 'username')
+                inc_cols = tuple(counters)
+                if cols or inc_cols:
+                    params = {'_username': row['username']}
+                    params.update({f'_v_{col}': row[col] for col in cols})
+                    params.update({f'_i_{col}': counters[col] for col in inc_cols})
+                    batches.setdefault((cols, inc_cols), []).append(params)
+            updated = 0
+            with self.engine.begin() as conn:
+                for (cols, inc_cols), params in batches.items():
+                    values = {col: bindparam(f'_v_{col}') for col in cols}
+                    values.update({col: func.coalesce(table.c[col], 0) + bindparam(f'_i_{col}') for col in inc_cols})
+                    stmt = table.update().where(table.c.username == bindparam('_username')).values(values)
+                    updated += conn.execute(stmt, params).rowcount
+        except Exception as ex:
+            log_query(self, 'update_many', table_name, started, rows=len(rows), error=ex)
+            raise DatabaseError({
+                "code": "SQLAlchemy exception",
+                "description": f'Database: `{self.db_name}`\n`update_many({len(rows)} rows)`\nEnsure DB entities exist',
+                "message": str(ex),
+            }, 500)
+        log_query(self, 'update_many', table_name, started, rows=updated)
+        return updated
+
+    @metered('storage.complete_signup', outcome=lambda result: result['outcome'])
+    def complete_signup(self, context: dict=None) -> dict:
+        """Verifies the PIN and moves the pending user to the users table in one transaction (pending row locked FOR UPDATE)."""
+        assert(context is not None and context.get('username') is not None)
+
+        pending_table_name = context.get('table', SQLALCHEMY_SETTINGS.PENDING_USERS_TABLE)
+        username = context['username']
+
+        started = time.perf_counter()
+        try:
+            pending_table = self._table(pending_table_name)
+            users_table = self._table(context.get('users_table', SQLALCHEMY_SETTINGS.USERS_TABLE))
+            with self.engine.begin() as conn:
+                pending = conn.execute(
+                    select(pending_table).where(pending_table.c.username == username).with_for_update()
+                ).mappings().first()
+                outcome = self.signup_outcome(pending, context.get('pin'), context.get('max_attempts', 5))
+                if outcome == 'ok' and conn.execute(select(users_table.c.username).where(users_table.c.username == username)).first():
+                    outcome = 'registered'
+
+                user = None
+                if outcome == 'mismatch':
+                    conn.execute(pending_table.update().where(pending_table.c.username == username)
+                                 .values(pin_attempts=func.coalesce(pending_table.c.pin_attempts, 0) + 1))
+                elif outcome == 'ok':
+                    user = {**(context.get('data') or {}), 'username': username, 'password': pending['password']}
+                    try:
+                        with conn.begin_nested():
+                            conn.execute(users_table.insert().values(**self._full_row(users_table, user)))
+                    except IntegrityError:
+                        # A concurrent completion won the race (databases without FOR UPDATE, e.g. SQLite)
+                        outcome, user = 'registered', None
+                if outcome in ('ok', 'expired', 'registered'):
+                    conn.execute(pending_table.delete().where(pending_table.c.username == username))
+        except Exception as ex:
+            log_query(self, 'complete_signup', pending_table_name, started, error=ex)
+            raise DatabaseError({
+                "code": "SQLAlchemy exception",
+                "description": f'Database: `{self.db_name}`\n`complete_signup()`\nEnsure DB entities exist',
+                "message": str(ex),
+            }, 500)
+        log_query(self, 'complete_signup', pending_table_name, started, rows=1 if user else 0)
+        return {'outcome': outcome, 'user': user}
@@ -0,0 +1,257 @@
+"""
+Online snapshots of the SQLite auth database.
+
+Snapshots use the sqlite3 online backup API on a separate connection, copying
+BACKUP_PAGES_PER_STEP pages per step. The database is only read-locked while a step runs,
+so logins and session writes go ahead between steps. A write from another connection
+restarts the copy; after BACKUP_MAX_RESTARTS steps without progress it is copied in one step.
+`mode='vacuum'` writes a compacted copy with `VACUUM INTO` instead (one read transaction,
+no free pages). A snapshot is written to a `.part` file and renamed into place, so a
+snapshot file is never half written.
+
+Timestamped snapshots go to BACKUP_PATH and `prune` keeps the newest BACKUP_KEEP per
+database. `master=True` refreshes the `<db>_master.db` copy next to the database instead.
+With BACKUP_INTERVAL_SECONDS > 0, the storage factory's SQLite providers are snapshotted on
+a daemon thread.
+"""
+
+import datetime
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+from os import environ as osenv
+from typing import List, Literal, Optional
+
+import sqlite3 as sql
+
+from . import DatabaseError
+from .implementation import SQLiteProvider
+from .settings import SQLITE_SETTINGS
+from authlib.common.metrics import metered
+
+BACKUP_PATH = osenv.get('BACKUP_PATH', os.path.join(SQLITE_SETTINGS.DB_PATH, 'backups'))
+BACKUP_MODE = osenv.get('BACKUP_MODE', 'backup').lower()  # 'backup' (page by page) or 'vacuum' (VACUUM INTO)
+BACKUP_PAGES_PER_STEP = int(osenv.get('BACKUP_PAGES_PER_STEP', '64'))
+BACKUP_STEP_SLEEP_SECONDS = float(osenv.get('BACKUP_STEP_SLEEP_SECONDS', '0.005'))
+BACKUP_MAX_RESTARTS = int(osenv.get('BACKUP_MAX_RESTARTS', '10'))
+BACKUP_KEEP = int(osenv.get('BACKUP_KEEP', '7'))
+BACKUP_INTERVAL_SECONDS = float(osenv.get('BACKUP_INTERVAL_SECONDS', '0'))  # 0 disables scheduled snapshots
+
+_STAMP = '%Y%m%dT%H%M%S%f'  # microseconds, so snapshots taken in the same second don't collide
+_SECONDS_STAMP = '%Y%m%dT%H%M%S'  # snapshots written before microseconds were added
+
+
+class _Restarting(Exception):
+    """The copy keeps restarting because of concurrent writes."""
+
+
+def supports_backup(provider) -> bool:
+    """True for SQLite and sharded SQLite providers."""
+    return bool(_databases(provider))
+
+
+def _databases(provider) -> List[SQLiteProvider]:
+    providers = getattr(provider, 'shards', None) or [provider]
+    return providers if all(isinstance(p, SQLiteProvider) for p in providers) else []
+
+
+def _stem(provider: SQLiteProvider) -> str:
+    return provider.db_name or 'memory'
+
+
+def _copy_pages(src, dest: str, pages: int, sleep: float) -> None:
+    """Online-backup `src` into the file `dest`, `pages` pages per step."""
+    progress_state = {'remaining': None, 'restarts': 0}
+
+    def progress(status, remaining, total):
+        last = progress_state['remaining']
+        progress_state['remaining'] = remaining
+        if last is not None and remaining >= last:  # restarted (or locked out) instead of moving on
+            progress_state['restarts'] += 1
+            if progress_state['restarts'] > BACKUP_MAX_RESTARTS:
+                raise _Restarting()
+        if sleep > 0:
+            time.sleep(sleep)  # let waiting writers take the lock between steps
+
+    dst = sql.connect(dest)
+    try:
+        try:
+            # `sleep` is also the wait before retrying a step that found the database locked
+            src.backup(dst, pages=pages, progress=progress, sleep=sleep)
+        except _Restarting:
+            logging.info(f'Backup to `{dest}` restarted {BACKUP_MAX_RESTARTS} times; copying in one step')
+            src.backup(dst, pages=-1, sleep=sleep)
+    finally:
+        dst.close()
+
+
+def _vacuum_into(src, dest: str) -> None:
+    """Compacted copy of `src` (VACUUM INTO needs SQLite 3.27+)."""
+    src.execute('VACUUM INTO ?', (dest,))
+
+
+@metered('storage.backup')
+def _snapshot_one(provider: SQLiteProvider, dest: str, mode: str) -> dict:
+    start = time.perf_counter()
+    part = f'{dest}.part'
+    if os.path.exists(part):
+        os.remove(part)
+
+    # In-memory databases can only be read through the provider's own connection
+    in_memory = provider.db == ':memory:'
+    src = provider.con if in_memory else \
+        SQLiteProvider._create_database(db=provider.db, db_name=provider.db_name, allow_db_create=False)
+    try:
+        if mode == 'vacuum':
+            _vacuum_into(src, part)
+        else:
+            _copy_pages(src, part, BACKUP_PAGES_PER_STEP, BACKUP_STEP_SLEEP_SECONDS)
+        os.replace(part, dest)
+    except Exception as ex:
+        if os.path.exists(part):
+            os.remove(part)
+        raise DatabaseError({
+            "code": "SQLite exception",
+            "description": f'`snapshot({provider.db_name}, mode={mode})` to `{dest}` failed',
+            "message": str(ex),
+        }, 500)
+    finally:
+        if not in_memory:
+            src.close()
+
+    return {
+        'db': provider.db_name,
+        'path': dest,
+        'mode': mode,
+        'bytes': os.path.getsize(dest),
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+
+
+def snapshot(provider, mode: Optional[Literal['backup', 'vacuum']] = None, master: bool = False,
+             backup_path: Optional[str] = None) -> List[dict]:
+    """
+    Snapshot a (sharded) SQLite provider's database files while the app is running.
+
+    Args:
+        mode: 'backup' copies page by page; 'vacuum' writes a compacted copy. Defaults to BACKUP_MODE.
+        master: Refresh `<db>_master.db` next to each database instead of writing a timestamped snapshot.
+        backup_path: Directory for timestamped snapshots. Defaults to BACKUP_PATH.
+
+    Returns one dict per database file: db, path, mode, bytes, seconds.
+    """
+    mode = mode or BACKUP_MODE
+    assert mode in ('backup', 'vacuum')
+    databases = _databases(provider)
+    if not databases:
+        raise DatabaseError({
+            "code": "Backup not supported",
+            "description": f'`snapshot()` needs a SQLite store, got `{type(provider).__name__}`',
+            "message": 'Back up other stores with their own tools',
+        }, 400)
+
+    backup_path = backup_path or BACKUP_PATH
+    stamp = datetime.datetime.now().strftime(_STAMP)
+    results = []
+    for db in databases:
+        if master and db.db != ':memory:':
+            dest = os.path.join(os.path.dirname(db.db), f'{_stem(db)}_master.db')
+        else:
+            os.makedirs(backup_path, exist_ok=True)
+            dest = os.path.join(backup_path, f'{_stem(db)}-{stamp}.db')
+            if os.path.exists(dest):
+                raise DatabaseError({
+                    "code": "Snapshot exists",
+                    "description": f'`snapshot({db.db_name})` would overwrite `{dest}`',
+                    "message": 'A snapshot with this timestamp already exists; try again',
+                }, 409)
+        results.append(_snapshot_one(db, dest, mode))
+        logging.info(f'Snapshot of `{db.db_name}` written to `{dest}`')
+    return results
+
+
+def list_backups(provider, backup_path: Optional[str] = None) -> List[dict]:
+    """Timestamped snapshots of the provider's databases, newest first."""
+    backup_path = backup_path or BACKUP_PATH
+    if not os.path.isdir(backup_path):
+        return []
+    rows = []
+    for db in _databases(provider):
+        pattern = re.compile(rf'^{re.escape(_stem(db))}-(\d{{8}}T\d{{6}}(?:\d{{6}})?)\.db$')
+        for name in os.listdir(backup_path):
+            match = pattern.match(name)
+            if match:
+                stamp = match.group(1)
+                rows.append({
+                    'db': db.db_name,
+                    'file': name,
+                    'created': datetime.datetime.strptime(stamp, _STAMP if len(stamp) > 15 else _SECONDS_STAMP).isoformat(),
+                    'bytes': os.path.getsize(os.path.join(backup_path, name)),
+                })
+    return sorted(rows, key=lambda row: row['created'], reverse=True)
+
+
+def prune(provider, keep: int = BACKUP_KEEP, backup_path: Optional[str] = None) -> List[str]:
+    """Delete all but the newest `keep` snapshots of each database. Returns the removed file names."""
+    backup_path = backup_path or BACKUP_PATH
+    removed, seen = [], {}
+    for row in list_backups(provider, backup_path):
+        seen[row['db']] = seen.get(row['db'], 0) + 1
+        if seen[row['db']] > keep:
+            os.remove(os.path.join(backup_path, row['file']))
+            removed.append(row['file'])
+    return removed
+
+
+class BackupScheduler:
+    """Daemon thread taking a snapshot (then pruning) of each scheduled provider every `interval_seconds`."""
+
+    def __init__(self, interval_seconds: float = BACKUP_INTERVAL_SECONDS, keep: int = BACKUP_KEEP):
+        self.interval_seconds = interval_seconds
+        self.keep = keep
+        self._providers = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, provider) -> None:
+        if not supports_backup(provider):
+            return
+        with self._lock:
+            self._providers.add(provider)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sqlite-backup', daemon=True)
+                self._thread.start()
+
+    def run_once(self) -> int:
+        """Snapshot and prune every scheduled provider now. Returns the number of files written."""
+        written = 0
+        for provider in list(self._providers):
+            try:
+                written += len(snapshot(provider))
+                prune(provider, keep=self.keep)
+            except Exception as ex:
+                logging.warning(f'Scheduled backup of `{provider.db_name}` failed: {str(ex)}')
+        return written
+
+    def _run(self) -> None:
+        while not self._wake.wait(self.interval_seconds):
+            self.run_once()
+
+    def stop(self) -> None:
+        self._wake.set()
+
+
+_scheduler: Optional[BackupScheduler] = None
+
+def schedule_backups(provider) -> None:
+    """Snapshot `provider` every BACKUP_INTERVAL_SECONDS (no-op when that is 0 or the store isn't SQLite)."""
+    global _scheduler
+    if BACKUP_INTERVAL_SECONDS <= 0:
+        return
+    if _scheduler is None:
+        _scheduler = BackupScheduler()
+    _scheduler.add(provider)
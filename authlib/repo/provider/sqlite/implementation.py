@@ -1,6 +1,8 @@
 import os
 import platform
-from typing import List, Literal
+import threading
+import time
+from typing import Iterator, List, Literal
 from pathlib import Path
 import logging
 
@@ -10,6 +12,10 @@ from ..base_provider import StorageProvider
 
 from .settings import SQLITE_SETTINGS
 from . import DatabaseError
+from ..connection import ConnectionManager
+from authlib.common.metrics import metered
+from authlib.common.query_log import log_query, redact, redact_conds
+from authlib.common.user_record import record_factory
 
 # Get users table name from settings
 def _get_users_table():
@@ -23,38 +29,55 @@ def _get_pending_users_table():
 
 class SQLiteProvider(StorageProvider):
 
-    def __init__(self, allow_db_create=False, if_table_exists: Literal['ignore', 'recreate'] = 'ignore'):
-        db = SQLITE_SETTINGS.DB
+    def __init__(self, allow_db_create=False, if_table_exists: Literal['ignore', 'recreate'] = 'ignore', db=None, db_path=None):
+        # `db` and `db_path` default to SQLITE_SETTINGS (overridden by the sharded provider)
+        db = SQLITE_SETTINGS.DB if db is None else db
+        db_path = SQLITE_SETTINGS.DB_PATH if db_path is None else db_path
         # Make a proper DB file name, unless in-memory DB.
         # Ignores any supplied database file path and pegs to DB_PATH. Also handles :memory: database correctly.
         database = ':memory:'
         if (db is not None) and (db != ':memory:'):
             db = db.lower()
             database = db if db.endswith('.db') else f'{db}.db'
-            database = os.path.join(SQLITE_SETTINGS.DB_PATH, Path(database).name)
+            database = os.path.join(db_path, Path(database).name)
 
         self.db = database
         self.db_name = Path(database).stem.replace(':', '')
 
-        self.con = SQLiteProvider._create_database(db=self.db, db_name=self.db_name, allow_db_create=allow_db_create)
+        in_memory = self.db == ':memory:'
+        con = SQLiteProvider._create_database(db=self.db, db_name=self.db_name, allow_db_create=allow_db_create)
+        self.connections = ConnectionManager(
+            # Reconnects never create the file: a vanished database is an outage, not a new empty one
+            connect=lambda: SQLiteProvider._create_database(db=self.db, db_name=self.db_name, allow_db_create=False),
+            close=SQLiteProvider._close_connection,
+            probe=lambda con: con.execute('SELECT 1').fetchone(),
+            # Reconnecting to an in-memory DB would start an empty one, so its connection is never dropped
+            is_connection_error=(lambda ex: False) if in_memory else SQLiteProvider._is_connection_error,
+            label=type(self).__name__,
+            conn=con,
+        )
+        # Threads share the connection: a write (statements + commit, or rollback on failure) holds
+        # this lock, so another thread's commit or rollback never lands in the middle of it
+        self._write_lock = threading.RLock()
 
         # Create users table for login and session management
         users_table = _get_users_table()
         SQLiteProvider._create_table(
-            con=self.con,
+            con=con,
             db_name=self.db_name,
             table_name=users_table,
-            col_spec='id INTEGER PRIMARY KEY, username UNIQUE ON CONFLICT REPLACE, password, su INTEGER, auth_token, expires_at',
+            col_spec='id INTEGER PRIMARY KEY, username UNIQUE ON CONFLICT REPLACE, password, su INTEGER, auth_token, expires_at, '
+                     'logins_count INTEGER DEFAULT 0, last_login, created_at, updated_at, roles',
             if_table_exists=if_table_exists
         )
 
         # Create pending users table for signup flow
         pending_users_table = _get_pending_users_table()
         SQLiteProvider._create_table(
-            con=self.con,
+            con=con,
             db_name=self.db_name,
             table_name=pending_users_table,
-            col_spec='id INTEGER PRIMARY KEY, username UNIQUE ON CONFLICT REPLACE, password, validation_pin, is_validated INTEGER DEFAULT 0, expires_at',
+            col_spec='id INTEGER PRIMARY KEY, username UNIQUE ON CONFLICT REPLACE, password, validation_pin, is_validated INTEGER DEFAULT 0, expires_at, pin_attempts INTEGER DEFAULT 0',
             if_table_exists=if_table_exists
         )
 
@@ -85,18 +108,39 @@ class SQLiteProvider(StorageProvider):
 
         # Database exists or will have been created at this point
 
-        # Make database return dicts instead of tuples.
-        # From: https://stackoverflow.com/questions/3300464/how-can-i-get-dict-from-sqlite-query
-        def dict_factory(cursor, row):
-            d = {}
-            for idx, col in enumerate(cursor.description):
-                d[col[0]] = row[idx]
-            return d
-
-        con.row_factory = dict_factory
+        # Rows come back as read-only UserRecord mappings over the row tuple
+        con.row_factory = record_factory
 
         return con
 
+    @staticmethod
+    def _close_connection(con) -> None:
+        con.commit()
+        con.close()
+
+    # Errors that leave the connection unusable (anything else is a problem with the query)
+    _CONNECTION_ERRORS = ('closed database', 'unable to open', 'disk i/o', 'not a database', 'malformed', 'readonly database')
+
+    @staticmethod
+    def _is_connection_error(ex: Exception) -> bool:
+        message = str(ex).lower()
+        return isinstance(ex, sql.Error) and \
+            any(err in message for err in SQLiteProvider._CONNECTION_ERRORS)
+
+    @property
+    def con(self):
+        """The live connection (reconnects if it was dropped; raises CircuitOpenError during an outage)."""
+        return self.connections.acquire()
+
+    def _failed(self, con, ex: Exception) -> None:
+        """Roll back the failed statement; connection errors drop the connection and count against the circuit."""
+        try:
+            with self._write_lock:
+                con.rollback()
+        except Exception:
+            pass
+        self.connections.failed(ex)
+
     @staticmethod
     def _create_table(con, db_name, table_name, col_spec, if_table_exists: Literal['ignore', 'recreate'] = 'ignore'):
         """Create table"""
@@ -104,6 +148,7 @@ class SQLiteProvider(StorageProvider):
             # Table existence check
             con.execute(f"SELECT * FROM {table_name} LIMIT 1")
             if if_table_exists == 'ignore':
+                SQLiteProvider._add_missing_columns(con, db_name, table_name, col_spec)
                 return
             elif if_table_exists == 'recreate':
                 SQLiteProvider._delete_table(con, db_name, table_name)
@@ -124,6 +169,22 @@ class SQLiteProvider(StorageProvider):
                 "message": str(ex),
             }, 500)
 
+    @staticmethod
+    def _add_missing_columns(con, db_name, table_name, col_spec):
+        """Add columns in `col_spec` that an existing table doesn't have yet (schema upgrades)."""
+        existing = {row['name'] for row in con.execute(f"PRAGMA table_info({table_name})").fetchall()}
+        for col_def in (c.strip() for c in col_spec.split(',')):
+            col_name = col_def.split()[0]
+            if col_name in existing or 'PRIMARY KEY' in col_def or 'UNIQUE' in col_def:
+                continue
+            try:
+                logging.info(f">>> Adding column `{col_name}` to table `{table_name}` in database `{db_name}` <<<")
+                con.execute(f"ALTER TABLE {table_name} ADD COLUMN {col_def}")
+                con.commit()
+            except sql.OperationalError as ex:
+                # Read-only database or a concurrent upgrade; queries on the new column will report it
+                logging.warning(f">>> Could not add column `{col_name}` to `{table_name}`: {ex} <<<")
+
     @staticmethod
     def _delete_table(con, db_name, table_name):
         """Delete table with all data."""
@@ -141,23 +202,21 @@ class SQLiteProvider(StorageProvider):
     # --------------------------------------------------------------------------
     # StorageProvider interface implementation
 
+    @property
+    def persistent(self) -> bool:
+        """False for an in-memory database, which closing the connection deletes."""
+        return self.db != ':memory:'
+
     def close_database(self) -> None:
-        """Shuts down the database."""
-        try:
-            logging.info(f">>> Closing database `{self.db_name}` <<<")
-            # Closing will delete the connection. An in-memory DB will lose all data permanently.
-            # See https://stackoverflow.com/questions/48732439/deleting-a-database-file-in-memory
-            self.con.commit()
-            self.con.close()
-        except Exception as ex:
-            raise DatabaseError({
-                "code": "SQLite exception",
-                "description": f'Database: `{self.db_name}`\n`close_database()`\nEnsure DB entities exist',
-                "message": str(ex),
-            }, 500)
+        """Shuts down the database (the next call reconnects)."""
+        logging.info(f">>> Closing database `{self.db_name}` <<<")
+        # Closing will delete the connection. An in-memory DB will lose all data permanently.
+        # See https://stackoverflow.com/questions/48732439/deleting-a-database-file-in-memory
+        self.connections.close()
 
     # UPDATE or CREATE
     # Use REPLACE to handle UNIQUE constraint on username (replaces existing row if username exists)
+    @metered('storage.upsert')
     def upsert(self, context: dict=None) -> None:
         """Updates or inserts a new user record with supplied data (cols + value dict)."""
         assert(context is not None and context.get('data') is not None)
@@ -165,32 +224,31 @@ class SQLiteProvider(StorageProvider):
         table_name = context.get('table', 'USERS')
         data = context.get('data')
 
-        cols = ', '.join(list(data.keys()))
-        # need to quote string values for SQLite
-        # (assumes numeric values correspond to numeric columns)
-        values_ = []
-        for v in data.values():
-            if isinstance(v, int) or isinstance(v, float):
-                values_.append(str(v))
-            else:
-                values_.append(f'"{v}"')
-        values = ', '.join([v for v in values_])
-
-        query = f"REPLACE INTO {table_name}({cols}) VALUES({values})"
-
-        logging.info(f"Upsert: {query}")
-        try:
-            self.con.execute(query)
-            self.con.commit()
-        except Exception as ex:
-            self.close_database()
-            raise DatabaseError({
-                "code": "SQLite exception",
-                "description": f'Database: `{self.db_name}`\n`upsert({data})`\nEnsure DB entities exist',
-                "message": str(ex),
-            }, 500)
+        cols = ', '.join(data.keys())
+        # Bound parameters: values are never formatted into the SQL (or the logs)
+        placeholders = ', '.join('?' * len(data))
+
+        query = f"REPLACE INTO {table_name}({cols}) VALUES({placeholders})"
+
+        started = time.perf_counter()
+        con = self.con
+        with self._write_lock:
+            try:
+                con.execute(query, tuple(data.values()))
+                con.commit()
+            except Exception as ex:
+                log_query(self, 'upsert', table_name, started, data=data, error=ex)
+                self._failed(con, ex)
+                raise DatabaseError({
+                    "code": "SQLite exception",
+                    "description": f'Database: `{self.db_name}`\n`upsert({redact(data)})`\nEnsure DB entities exist',
+                    "message": str(ex),
+                }, 500)
+        self.connections.succeeded()
+        log_query(self, 'upsert', table_name, started, data=data)
 
     # READ
+    @metered('storage.query')
     def query(self, context: dict=None) -> List[dict]:
         """Executes a query and returns rows as list of dicts."""
         assert(context is not None and context.get('fields') is not None)
@@ -206,20 +264,58 @@ class SQLiteProvider(StorageProvider):
 
         query = f'{select}{where}{mod}'.strip()
 
-        logging.info(f"Query: {query}")
+        started = time.perf_counter()
+        con = self.con
         try:
-            cur = self.con.execute(query)
+            cur = con.execute(query)
             results = cur.fetchall()
-            return results
         except Exception as ex:
-            self.close_database()
+            log_query(self, 'query', table_name, started, fields=fields, conds=conds, modifier=modifier, error=ex)
+            self._failed(con, ex)
+            raise DatabaseError({
+                "code": "SQLite exception",
+                "description": f'Database: `{self.db_name}`\n`query({fields}, {redact_conds(conds)}, {modifier})`\nEnsure DB entities exist',
+                "message": str(ex),
+            }, 500)
+        self.connections.succeeded()
+        log_query(self, 'query', table_name, started, fields=fields, conds=conds, modifier=modifier, rows=len(results))
+        return results
+
+    def iterate(self, context: dict=None) -> Iterator[dict]:
+        """Yields a query's rows in context['sort'] order, fetching `page_size` rows at a time from one cursor."""
+        assert(context is not None and context.get('fields') is not None)
+
+        table_name = context.get('table', 'USERS')
+        fields = context.get('fields')
+        conds = context.get('conds')
+        order = self.sort_order(context.get('sort'))
+        page_size = context.get('page_size') or SQLITE_SETTINGS.PAGE_SIZE
+
+        where = f"WHERE {conds} " if conds else ""
+        order_by = f"ORDER BY {', '.join(f'{f} DESC' if desc else f for f, desc in order)}" if order else ""
+        query = f'SELECT {fields} FROM {table_name} {where}{order_by}'.strip()
+
+        started = time.perf_counter()
+        con = self.con
+        rows = 0
+        try:
+            cur = con.execute(query)
+            while page := cur.fetchmany(page_size):
+                rows += len(page)
+                yield from page
+        except Exception as ex:
+            log_query(self, 'iterate', table_name, started, fields=fields, conds=conds, modifier=order_by, error=ex)
+            self._failed(con, ex)
             raise DatabaseError({
                 "code": "SQLite exception",
-                "description": f'Database: `{self.db_name}`\n`query({fields}, {conds}, {modifier})`\nEnsure DB entities exist',
+                "description": f'Database: `{self.db_name}`\n`iterate({fields}, {redact_conds(conds)}, {order_by})`\nEnsure DB entities exist',
                 "message": str(ex),
             }, 500)
+        self.connections.succeeded()
+        log_query(self, 'iterate', table_name, started, fields=fields, conds=conds, modifier=order_by, rows=rows)
 
     # DELETE
+    @metered('storage.delete')
     def delete(self, context: dict=None) -> None:
         """Deletes record from specified table."""
         assert(context is not None and context.get('conds') is not None)
@@ -232,15 +328,191 @@ class SQLiteProvider(StorageProvider):
 
         query = f'{select}{where}'.strip()
 
-        logging.info(f"Delete: {query}")
+        started = time.perf_counter()
+        con = self.con
+        with self._write_lock:
+            try:
+                cur = con.execute(query)
+                con.commit()
+            except Exception as ex:
+                log_query(self, 'delete', table_name, started, conds=conds, error=ex)
+                self._failed(con, ex)
+                raise DatabaseError({
+                    "code": "SQLite exception",
+                    "description": f'Database: `{self.db_name}`\n`delete({redact_conds(conds)})`\nEnsure DB entities exist',
+                    "message": str(ex),
+                }, 500)
+        self.connections.succeeded()
+        log_query(self, 'delete', table_name, started, conds=conds, rows=cur.rowcount)
+
+
+    # BULK
+    @metered('storage.upsert_many')
+    def upsert_many(self, context: dict=None) -> None:
+        """Replaces all rows in one transaction, one executemany per distinct column set."""
+        assert(context is not None and context.get('rows') is not None)
+
+        table_name = context.get('table', 'USERS')
+        rows = context['rows']
+
+        batches = {}
+        for row in rows:
+            batches.setdefault(tuple(row.keys()), []).append(tuple(row.values()))
+
+        started = time.perf_counter()
+        con = self.con
+        with self._write_lock:
+            try:
+                with con:
+                    for cols, values in batches.items():
+                        query = f"REPLACE INTO {table_name}({', '.join(cols)}) VALUES({', '.join('?' * len(cols))})"
+                        con.executemany(query, values)
+            except Exception as ex:
+                log_query(self, 'upsert_many', table_name, started, rows=len(rows), error=ex)
+                self._failed(con, ex)
+                raise DatabaseError({
+                    "code": "SQLite exception",
+                    "description": f'Database: `{self.db_name}`\n`upsert_many({len(rows)} rows)`\nEnsure DB entities exist',
+                    "message": str(ex),
+                }, 500)
+        self.connections.succeeded()
+        log_query(self, 'upsert_many', table_name, started, rows=len(rows))
+
+    @metered('storage.delete_many')
+    def delete_many(self, context: dict=None) -> int:
+        """Deletes all given usernames in one transaction. Returns rows deleted."""
+        assert(context is not None and context.get('usernames') is not None)
+
+        table_name = context.get('table', 'USERS')
+        usernames = [(username,) for username in context['usernames']]
+
+        started = time.perf_counter()
+        con = self.con
+        with self._write_lock:
+            try:
+                with con:
+                    deleted = con.executemany(f"DELETE FROM {table_name} WHERE username = ?", usernames).rowcount
+            except Exception as ex:
+                log_query(self, 'delete_many', table_name, started, rows=len(usernames), error=ex)
+                self._failed(con, ex)
+                raise DatabaseError({
+                    "code": "SQLite exception",
+                    "description": f'Database: `{self.db_name}`\n`delete_many({len(usernames)} usernames)`\nEnsure DB entities exist',
+                    "message": str(ex),
+                }, 500)
+        self.connections.succeeded()
+        log_query(self, 'delete_many', table_name, started, rows=deleted)
+        return deleted
+
+    # PARTIAL UPDATE
+    @metered('storage.update')
+    def update(self, context: dict=None) -> int:
+        """Sets the supplied columns on an existing row (no insert, other columns untouched)."""
+        assert(context is not None and context.get('data') is not None)
+        assert(context['data'].get('username') is not None)
+        username = context['data']['username']
+        return self.update_many({
+            'table': context.get('table', 'USERS'),
+            'rows': [context['data']],
+            'increments': {username: context['increment']} if context.get('increment') else None,
+        })
+
+    @metered('storage.update_many')
+    def update_many(self, context: dict=None) -> int:
+        """Partial updates for many rows in one transaction, one executemany per distinct column set."""
+        assert(context is not None and context.get('rows') is not None)
+
+        table_name = context.get('table', 'USERS')
+        rows = context['rows']
+        increments = context.get('increments') or {}
+
+        batches = {}
+        for row in rows:
+            counters = increments.get(row['username']) or {}
+            cols = tuple(col for col in row if col != 'username')
+            inc_cols = tuple(counters)
+            if cols or inc_cols:
+                values = tuple(row[col] for col in cols) + tuple(counters[col] for col in inc_cols) + (row['username'],)
+                batches.setdefault((cols, inc_cols), []).append(values)
+
+        started = time.perf_counter()
+        con = self.con
+        with self._write_lock:
+            try:
+                updated = 0
+                with con:
+                    for (cols, inc_cols), values in batches.items():
+                        sets = [f'{col} = ?' for col in cols] + [f'{col} = COALESCE({col}, 0) + ?' for col in inc_cols]
+                        query = f"UPDATE {table_name} SET {', '.join(sets)} WHERE username = ?"
+                        updated += con.executemany(query, values).rowcount
+            except Exception as ex:
+                log_query(self, 'update_many', table_name, started, rows=len(rows), error=ex)
+                self._failed(con, ex)
+                raise DatabaseError({
+                    "code": "SQLite exception",
+                    "description": f'Database: `{self.db_name}`\n`update_many({len(rows)} rows)`\nEnsure DB entities exist',
+                    "message": str(ex),
+                }, 500)
+        self.connections.succeeded()
+        log_query(self, 'update_many', table_name, started, rows=updated)
+        return updated
+
+    # SIGN-UP COMPLETION
+    @metered('storage.complete_signup', outcome=lambda result: result['outcome'])
+    def complete_signup(self, context: dict=None) -> dict:
+        """Verifies the PIN and moves the pending user to the users table in one BEGIN IMMEDIATE transaction."""
+        assert(context is not None and context.get('username') is not None)
+
+        pending_table = context.get('table', _get_pending_users_table())
+        users_table = context.get('users_table', _get_users_table())
+        username = context['username']
+
+        started = time.perf_counter()
+        # The transaction runs on its own short-lived connection, so a rollback here never touches
+        # the shared connection. It holds the write lock too: this process's writes on the shared
+        # connection wait for it instead of polling for the database lock. An in-memory database
+        # is private to its connection, so there the shared one is used.
+        shared = self.db == ':memory:'
         try:
-            self.con.execute(query)
-            self.con.commit()
+            with self._write_lock:
+                con = self.con if shared else SQLiteProvider._create_database(db=self.db, db_name=self.db_name, allow_db_create=False)
+                try:
+                    # BEGIN IMMEDIATE takes the database write lock up front, so other verifications
+                    # of the sign-up (other threads or processes) wait for this one to commit
+                    con.execute('BEGIN IMMEDIATE')
+                    pending = con.execute(f"SELECT * FROM {pending_table} WHERE username = ?", (username,)).fetchone()
+                    outcome = self.signup_outcome(pending, context.get('pin'), context.get('max_attempts', 5))
+                    if outcome == 'ok' and con.execute(f"SELECT 1 FROM {users_table} WHERE username = ?", (username,)).fetchone():
+                        outcome = 'registered'
+
+                    user = None
+                    if outcome == 'mismatch':
+                        con.execute(f"UPDATE {pending_table} SET pin_attempts = COALESCE(pin_attempts, 0) + 1 WHERE username = ?", (username,))
+                    elif outcome == 'ok':
+                        user = {**(context.get('data') or {}), 'username': username, 'password': pending['password']}
+                        con.execute(f"INSERT INTO {users_table}({', '.join(user)}) VALUES({', '.join('?' * len(user))})", tuple(user.values()))
+                    if outcome in ('ok', 'expired', 'registered'):
+                        con.execute(f"DELETE FROM {pending_table} WHERE username = ?", (username,))
+                    con.commit()
+                except BaseException:
+                    if con.in_transaction:
+                        con.rollback()
+                    raise
+                finally:
+                    if not shared:
+                        con.close()
         except Exception as ex:
-            self.close_database()
+            log_query(self, 'complete_signup', pending_table, started, error=ex)
+            # Only this call's transaction was rolled back; the shared connection is left alone
+            # unless the error says the database itself is unusable
+            self.connections.failed(ex)
+            if isinstance(ex, DatabaseError):
+                raise
             raise DatabaseError({
                 "code": "SQLite exception",
-                "description": f'Database: `{self.db_name}`\n`delete({conds})`\nEnsure DB entities exist',
+                "description": f'Database: `{self.db_name}`\n`complete_signup()`\nEnsure DB entities exist',
                 "message": str(ex),
             }, 500)
-
+        self.connections.succeeded()
+        log_query(self, 'complete_signup', pending_table, started, rows=1 if user else 0)
+        return {'outcome': outcome, 'user': user}
@@ -5,11 +5,15 @@ from collections import namedtuple
 base_dir = osenv.get('BASE_DIR', '.')
 db_path = osenv.get('SQLITE_DB_PATH', 'db-temp')
 
-SQLITE_SETTINGS = namedtuple('sql_settings', ['DB_PATH', 'DB', 'USERS_TABLE', 'PENDING_USERS_TABLE'])(
+SQLITE_SETTINGS = namedtuple('sql_settings', ['DB_PATH', 'DB', 'USERS_TABLE', 'PENDING_USERS_TABLE', 'SHARDS', 'PAGE_SIZE'])(
     DB_PATH=os.path.join(base_dir, db_path),
     DB=osenv.get('SQLITE_DB', 'auth-temp.db'),
     USERS_TABLE=osenv.get('USERS_TABLE', 'USERS').upper(),
-    PENDING_USERS_TABLE=osenv.get('PENDING_USERS_TABLE', 'PENDING_USERS').upper()
+    PENDING_USERS_TABLE=osenv.get('PENDING_USERS_TABLE', 'PENDING_USERS').upper(),
+    # Number of database files used by the SQLITE_SHARDED storage provider
+    SHARDS=int(osenv.get('SQLITE_SHARDS', '4')),
+    # Rows fetched per step when `iterate` streams a query
+    PAGE_SIZE=int(osenv.get('SQLITE_PAGE_SIZE', '500'))
 )
 
 ENC_PASSWORD = osenv.get('ENC_PASSWORD')
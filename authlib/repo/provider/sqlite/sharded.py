@@ -0,0 +1,185 @@
+import heapq
+import zlib
+from pathlib import Path
+from typing import Iterator, List, Literal, Optional
+
+from ..base_provider import StorageProvider
+from ..conds import parse_conds, parse_modifier
+
+from .implementation import SQLiteProvider
+from .settings import SQLITE_SETTINGS
+from authlib.common.metrics import metered
+
+
+class ShardedSQLiteProvider(StorageProvider):
+    """
+    Spreads users over N SQLite files by a stable hash of the username, so writes for
+    different users don't serialize on one SQLite write lock.
+
+    Session tokens issued through `tag_session_token` carry their shard id
+    (`<shard>.<token>`), so token lookups go straight to one shard. Calls that
+    can't be routed (listings, non-key conditions) fan out to every shard and
+    merge the results.
+    """
+
+    def __init__(self, allow_db_create=False, if_table_exists: Literal['ignore', 'recreate'] = 'ignore', shards=None, db=None):
+        n = shards or SQLITE_SETTINGS.SHARDS
+        assert n > 0
+
+        stem = Path(SQLITE_SETTINGS.DB if db is None else db).stem.lower()
+        self.shards = [
+            SQLiteProvider(allow_db_create=allow_db_create, if_table_exists=if_table_exists, db=f'{stem}_shard{i:02d}.db')
+            for i in range(n)
+        ]
+        self.db_name = f'{stem}[{n} shards]'
+
+    # --------------------------------------------------------------------------
+    # Routing
+
+    def shard_for_username(self, username: str) -> int:
+        """Stable shard index for a username (crc32, independent of PYTHONHASHSEED)."""
+        return zlib.crc32(str(username).encode('utf-8')) % len(self.shards)
+
+    def _shard_for_token(self, token: str) -> Optional[int]:
+        prefix, sep, _ = str(token).partition('.')
+        if sep and prefix.isdigit() and int(prefix) < len(self.shards):
+            return int(prefix)
+        return None  # untagged (legacy) token
+
+    def _route(self, context: dict) -> Optional[int]:
+        data = context.get('data')
+        if data and data.get('username') is not None:
+            return self.shard_for_username(data['username'])
+        conds = parse_conds(context.get('conds'))
+        if conds:
+            if 'username' in conds:
+                return self.shard_for_username(conds['username'])
+            if 'auth_token' in conds:
+                return self._shard_for_token(conds['auth_token'])
+        return None
+
+    # --------------------------------------------------------------------------
+    # StorageProvider interface implementation
+
+    def close_database(self) -> None:
+        """Shuts down all shard databases."""
+        for shard in self.shards:
+            shard.close_database()
+
+    @metered('storage.upsert')
+    def upsert(self, context: dict=None) -> None:
+        """Updates or inserts a record in the username's shard."""
+        assert(context is not None and context.get('data') is not None)
+        assert(context['data'].get('username') is not None)
+        self.shards[self._route(context)].upsert(context)
+
+    @metered('storage.query')
+    def query(self, context: dict=None) -> List[dict]:
+        """Queries the routed shard, or all shards merged in the modifier's ORDER BY (else by username)."""
+        assert(context is not None and context.get('fields') is not None)
+
+        shard = self._route(context)
+        if shard is not None:
+            return self.shards[shard].query(context)
+
+        # Each shard applies the modifier; the merge repeats its ORDER BY and LIMIT over the shards' rows
+        modifier = context.get('modifier')
+        parsed = parse_modifier(modifier)
+        if parsed is None:
+            raise ValueError(f'Unsupported modifier for a fan-out query (use [ORDER BY col [ASC|DESC], ...] [LIMIT N]): {modifier}')
+        order_by, limit = parsed
+        fields = context['fields'].strip()
+        selected = None if fields == '*' else {f.strip() for f in fields.split(',')}
+        missing = [col for col, _ in order_by if selected is not None and col not in selected]
+        if missing:
+            raise ValueError(f'ORDER BY columns must be among the fields of a fan-out query: {", ".join(missing)}')
+        if not order_by and (selected is None or 'username' in selected):
+            order_by = [('username', False)]
+
+        results = []
+        for shard in self.shards:
+            results.extend(shard.query(context))
+        # Stable sorts from the last key to the first; NULLs first ascending, last descending, as SQLite
+        for col, descending in reversed(order_by):
+            results.sort(key=lambda row: (row[col] is not None, row[col]), reverse=descending)
+        return results[:limit] if limit is not None else results
+
+    def iterate(self, context: dict=None) -> Iterator[dict]:
+        """Streams the routed shard, or merges the shards' sorted streams (shard by shard without a sort)."""
+        assert(context is not None and context.get('fields') is not None)
+
+        shard = self._route(context)
+        if shard is not None:
+            yield from self.shards[shard].iterate(context)
+            return
+        order = self.sort_order(context.get('sort'))
+        streams = [shard.iterate(context) for shard in self.shards]
+        if not order:
+            for stream in streams:
+                yield from stream
+        elif len({descending for _, descending in order}) == 1:
+            fields = [field for field, _ in order]
+            yield from heapq.merge(*streams, key=lambda row: tuple(self.sort_key(f)(row) for f in fields), reverse=order[0][1])
+        else:
+            # Mixed directions don't fit one merge key
+            yield from self.sort_rows([row for stream in streams for row in stream], order)
+
+    @metered('storage.delete')
+    def delete(self, context: dict=None) -> None:
+        """Deletes from the routed shard, or from every shard."""
+        assert(context is not None and context.get('conds') is not None)
+
+        shard = self._route(context)
+        targets = self.shards if shard is None else [self.shards[shard]]
+        for target in targets:
+            target.delete(context)
+
+    def _by_shard(self, rows: list) -> dict:
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(self.shard_for_username(row['username']), []).append(row)
+        return grouped
+
+    def upsert_many(self, context: dict=None) -> None:
+        """Bulk upsert, one transaction per shard."""
+        assert(context is not None and context.get('rows') is not None)
+        for shard, rows in self._by_shard(context['rows']).items():
+            self.shards[shard].upsert_many({'table': context.get('table', 'USERS'), 'rows': rows})
+
+    def delete_many(self, context: dict=None) -> int:
+        """Bulk delete, one transaction per shard. Returns rows deleted."""
+        assert(context is not None and context.get('usernames') is not None)
+        grouped = {}
+        for username in context['usernames']:
+            grouped.setdefault(self.shard_for_username(username), []).append(username)
+        return sum(
+            self.shards[shard].delete_many({'table': context.get('table', 'USERS'), 'usernames': usernames})
+            for shard, usernames in grouped.items()
+        )
+
+    def update(self, context: dict=None) -> int:
+        """Partial update in the username's shard."""
+        assert(context is not None and context.get('data') is not None)
+        return self.shards[self._route(context)].update(context)
+
+    def update_many(self, context: dict=None) -> int:
+        """Partial updates, one transaction per shard."""
+        assert(context is not None and context.get('rows') is not None)
+        increments = context.get('increments') or {}
+        return sum(
+            self.shards[shard].update_many({
+                'table': context.get('table', 'USERS'),
+                'rows': rows,
+                'increments': {row['username']: increments[row['username']] for row in rows if row['username'] in increments},
+            })
+            for shard, rows in self._by_shard(context['rows']).items()
+        )
+
+    def complete_signup(self, context: dict=None) -> dict:
+        """Sign-up completion in the username's shard (pending and users rows share it)."""
+        assert(context is not None and context.get('username') is not None)
+        return self.shards[self.shard_for_username(context['username'])].complete_signup(context)
+
+    def tag_session_token(self, username: str, token: str) -> str:
+        """Prefix the token with the user's shard id."""
+        return f'{self.shard_for_username(username)}.{token}'
@@ -0,0 +1,252 @@
+"""
+Multi-tenant storage provider registry.
+
+Each tenant gets its own provider (its own SQLite file, shard set, Airtable base,
+SQLAlchemy database, ...), created on first use and reference counted. Providers nobody
+holds are closed once they have been idle for REGISTRY_IDLE_SECONDS, and the least
+recently used idle ones are closed early to keep open connections within
+REGISTRY_MAX_OPEN. Providers that are not persistent (MEMORY without a snapshot) are
+never closed: closing them would discard the tenant's users. Streamlit-free: `auth(tenant=...)` holds a `TenantLease` in session
+state, which releases the tenant when the session goes away.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+from os import environ as osenv
+from typing import Callable, Dict
+
+from .provider.sqlite.settings import SQLITE_SETTINGS
+from .provider.connection import CircuitBreaker
+from authlib.common.metrics import METRICS, provider_label
+from authlib.common.write_behind import release_buffers
+
+REGISTRY_MAX_OPEN = int(osenv.get('REGISTRY_MAX_OPEN', '64'))
+REGISTRY_IDLE_SECONDS = float(osenv.get('REGISTRY_IDLE_SECONDS', '600'))
+TENANT_ALLOW_DB_CREATE = osenv.get('TENANT_ALLOW_DB_CREATE', 'False').lower() == 'true'
+TENANT_SQLITE_DB = osenv.get('TENANT_SQLITE_DB', '{tenant}.db')
+TENANT_MEMORY_SNAPSHOT = osenv.get('TENANT_MEMORY_SNAPSHOT', '')
+TENANT_SQLALCHEMY_URL = osenv.get('TENANT_SQLALCHEMY_URL', f"sqlite:///{os.path.join(SQLITE_SETTINGS.DB_PATH, '{tenant}.db')}")
+
+_TENANT_NAME = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def default_provider(storage: str, allow_db_create: bool = False, if_table_exists: str = 'ignore'):
+    """Streamlit-free counterpart of `StorageFactory.get_provider` (the single default store, uncached)."""
+    if storage == 'SQLITE':
+        from .provider.sqlite.implementation import SQLiteProvider
+        return SQLiteProvider(allow_db_create=allow_db_create, if_table_exists=if_table_exists)
+    if storage == 'SQLITE_SHARDED':
+        from .provider.sqlite.sharded import ShardedSQLiteProvider
+        return ShardedSQLiteProvider(allow_db_create=allow_db_create, if_table_exists=if_table_exists)
+    if storage == 'MEMORY':
+        from .provider.memory.implementation import MemoryProvider
+        return MemoryProvider(if_table_exists=if_table_exists)
+    if storage == 'SQLALCHEMY':
+        from .provider.sqla.implementation import SQLAlchemyProvider
+        return SQLAlchemyProvider(allow_db_create=allow_db_create, if_table_exists=if_table_exists)
+    if storage == 'AIRTABLE':
+        from .provider.airtable.implementation import AirtableProvider
+        return AirtableProvider()
+    if storage == 'REMOTE':
+        from .provider.remote.implementation import RemoteProvider
+        return RemoteProvider()
+    raise ValueError(storage)
+
+
+def _per_tenant(setting: str, template: str, tenant: str) -> str:
+    """`template` with `{tenant}` filled in; without the placeholder every tenant would share one database."""
+    if '{tenant}' not in template:
+        raise ValueError(f'{setting} `{template}` must contain `{{tenant}}` (tenants would share one database)')
+    return template.format(tenant=tenant)
+
+
+def tenant_provider(tenant: str, storage: str):
+    """Default provider factory: per-tenant database files, URLs or Airtable bases (see the TENANT_* settings)."""
+    if storage == 'SQLITE':
+        from .provider.sqlite.implementation import SQLiteProvider
+        return SQLiteProvider(allow_db_create=TENANT_ALLOW_DB_CREATE, db=_per_tenant('TENANT_SQLITE_DB', TENANT_SQLITE_DB, tenant))
+    if storage == 'SQLITE_SHARDED':
+        from .provider.sqlite.sharded import ShardedSQLiteProvider
+        return ShardedSQLiteProvider(allow_db_create=TENANT_ALLOW_DB_CREATE, db=_per_tenant('TENANT_SQLITE_DB', TENANT_SQLITE_DB, tenant))
+    if storage == 'MEMORY':
+        from .provider.memory.implementation import MemoryProvider
+        snapshot_path = _per_tenant('TENANT_MEMORY_SNAPSHOT', TENANT_MEMORY_SNAPSHOT, tenant) if TENANT_MEMORY_SNAPSHOT else ''
+        return MemoryProvider(snapshot_path=snapshot_path)
+    if storage == 'SQLALCHEMY':
+        from .provider.sqla.implementation import SQLAlchemyProvider
+        return SQLAlchemyProvider(allow_db_create=TENANT_ALLOW_DB_CREATE,
+                                  url=_per_tenant('TENANT_SQLALCHEMY_URL', TENANT_SQLALCHEMY_URL, tenant))
+    if storage == 'AIRTABLE':
+        base_id = osenv.get(f'AIRTABLE_BASE_KEY_{tenant.upper()}')
+        if not base_id:
+            raise ValueError(f'No Airtable base for tenant `{tenant}` (set AIRTABLE_BASE_KEY_{tenant.upper()})')
+        from .provider.airtable.implementation import AirtableProvider
+        return AirtableProvider(base_id=base_id)
+    if storage == 'REMOTE':
+        from .provider.remote.implementation import RemoteProvider
+        return RemoteProvider(tenant=tenant)
+    raise ValueError(storage)
+
+
+def _persistent(provider) -> bool:
+    """False for providers whose data lives only in the provider object (e.g. MEMORY without a snapshot)."""
+    return getattr(provider, 'persistent', True)
+
+
+def _connections(provider) -> int:
+    """Open connections a provider counts for against REGISTRY_MAX_OPEN."""
+    return len(getattr(provider, 'shards', ())) or 1
+
+
+class _Entry:
+    __slots__ = ('provider', 'refs', 'idle_since')
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.refs = 0
+        self.idle_since = time.monotonic()
+
+
+class TenantLease:
+    """Holds one reference to a tenant's provider until it is released or garbage collected."""
+
+    __slots__ = ('key', 'provider', '_finalizer', '__weakref__')
+
+    def __init__(self, registry: 'ProviderRegistry', key: tuple, provider):
+        self.key = key
+        self.provider = provider
+        self._finalizer = weakref.finalize(self, registry.release, *key)
+
+    def release(self) -> None:
+        self._finalizer()
+
+
+class ProviderRegistry:
+    """
+    Providers keyed by (tenant, storage).
+
+    Args:
+        factory: `(tenant, storage) -> provider`; `register` overrides it per tenant.
+        max_open: Soft cap on open connections; idle providers are closed (LRU first) to stay within it.
+        idle_seconds: Close providers nobody has held for this long.
+    """
+
+    def __init__(self, factory: Callable[[str, str], object] = tenant_provider,
+                 max_open: int = REGISTRY_MAX_OPEN, idle_seconds: float = REGISTRY_IDLE_SECONDS):
+        self.factory = factory
+        self.max_open = max_open
+        self.idle_seconds = idle_seconds
+        self._factories: Dict[str, Callable[[str, str], object]] = {}
+        self._entries: Dict[tuple, _Entry] = {}
+        self._breakers: Dict[tuple, CircuitBreaker] = {}
+        self._lock = threading.RLock()
+
+    def register(self, tenant: str, factory: Callable[[str, str], object]) -> None:
+        """Use `factory(tenant, storage)` to create this tenant's provider (e.g. a different base or URL)."""
+        self._factories[self._check(tenant)] = factory
+
+    @staticmethod
+    def _check(tenant: str) -> str:
+        if not isinstance(tenant, str) or not _TENANT_NAME.match(tenant):
+            raise ValueError(f'Invalid tenant name `{tenant}` (letters, digits, - and _ only)')
+        return tenant
+
+    def acquire(self, tenant: str, storage: str):
+        """The tenant's provider, created on first use. Pair with `release` (or use `lease`)."""
+        key = (self._check(tenant), storage)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                breaker = self._breakers.setdefault(key, CircuitBreaker(failure_threshold=1, label=f'registry:{tenant}'))
+                breaker.acquire()  # fails fast while this tenant's store keeps failing to open
+                factory = self._factories.get(tenant, self.factory)
+                try:
+                    provider = factory(tenant, storage)
+                except Exception:
+                    breaker.failure()
+                    METRICS.inc('registry.open', provider=storage, outcome='error')
+                    raise
+                breaker.success()
+                entry = self._entries[key] = _Entry(provider)
+                METRICS.inc('registry.open', provider=provider_label(provider))
+            entry.refs += 1
+            self._evict()
+            return entry.provider
+
+    def release(self, tenant: str, storage: str) -> None:
+        with self._lock:
+            entry = self._entries.get((tenant, storage))
+            if entry is None or entry.refs == 0:
+                return
+            entry.refs -= 1
+            if entry.refs == 0:
+                entry.idle_since = time.monotonic()
+            self._evict()
+
+    def lease(self, tenant: str, storage: str) -> TenantLease:
+        """Acquire the tenant's provider for as long as the returned lease is alive."""
+        provider = self.acquire(tenant, storage)
+        return TenantLease(self, (tenant, storage), provider)
+
+    def get(self, tenant: str, storage: str):
+        """The tenant's open provider, or None (does not take a reference)."""
+        entry = self._entries.get((tenant, storage))
+        return entry.provider if entry is not None else None
+
+    def open_connections(self) -> int:
+        """Connections held by open providers (a sharded provider counts once per shard)."""
+        return sum(_connections(entry.provider) for entry in self._entries.values())
+
+    def _evict(self) -> None:
+        # Idle providers, least recently released first: close the expired ones, then more until under the cap.
+        # Non-persistent providers stay open (closing one would lose its data), though they count against the cap.
+        now = time.monotonic()
+        open_connections = self.open_connections()
+        idle = sorted((entry.idle_since, key) for key, entry in self._entries.items()
+                      if entry.refs == 0 and _persistent(entry.provider))
+        for idle_since, key in idle:
+            if now - idle_since < self.idle_seconds and open_connections <= self.max_open:
+                break
+            open_connections -= _connections(self._entries[key].provider)
+            self._close(key, reason='idle' if now - idle_since >= self.idle_seconds else 'cap')
+        if open_connections > self.max_open:
+            METRICS.inc('registry.over_cap')
+
+    def evict_idle(self) -> None:
+        """Close providers that have been idle too long (also done on every acquire and release)."""
+        with self._lock:
+            self._evict()
+
+    def _close(self, key: tuple, reason: str) -> None:
+        entry = self._entries.pop(key)
+        try:
+            release_buffers(entry.provider)
+            entry.provider.close_database()
+        except Exception as ex:
+            logging.warning(f'Closing provider for tenant `{key[0]}` failed: {str(ex)}')
+        METRICS.inc('registry.close', provider=provider_label(entry.provider), outcome=reason)
+
+    def close_all(self) -> None:
+        with self._lock:
+            for key in list(self._entries):
+                self._close(key, reason='shutdown')
+
+    def stats(self) -> list:
+        """One dict per open provider: tenant, storage, refs, idle seconds."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {'tenant': tenant, 'storage': storage, 'refs': entry.refs,
+                 'idle_s': round(now - entry.idle_since, 1) if entry.refs == 0 else 0.0}
+                for (tenant, storage), entry in self._entries.items()
+            ]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+REGISTRY = ProviderRegistry()
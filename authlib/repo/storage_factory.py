@@ -3,6 +3,9 @@ import streamlit as st
 import sqlite3
 
 from .provider.sqlite.settings import SQLITE_SETTINGS
+
+STORAGE_PROVIDERS = ['SQLITE', 'AIRTABLE', 'SQLITE_SHARDED', 'MEMORY', 'SQLALCHEMY', 'REMOTE']
+
 def _sqlite_hash_func(allow_db_create=False, if_table_exists: Literal['ignore', 'recreate'] = 'ignore'):
     path = SQLITE_SETTINGS.DB_PATH
     db = SQLITE_SETTINGS.DB
@@ -20,6 +23,34 @@ class StorageFactory():
         print(f'_sqlite_provider(allow_db_create={allow_db_create}, if_table_exists={if_table_exists})')
         from .provider.sqlite.implementation import SQLiteProvider
         provider = SQLiteProvider(allow_db_create=allow_db_create, if_table_exists=if_table_exists)
+        from .provider.sqlite.backup import schedule_backups
+        schedule_backups(provider)  # no-op unless BACKUP_INTERVAL_SECONDS is set
+        return provider
+
+    @staticmethod
+    @st.cache_resource
+    def _sqlite_sharded_provider(allow_db_create=False, if_table_exists: Literal['ignore', 'recreate'] = 'ignore'):
+        print(f'_sqlite_sharded_provider(allow_db_create={allow_db_create}, if_table_exists={if_table_exists}, shards={SQLITE_SETTINGS.SHARDS})')
+        from .provider.sqlite.sharded import ShardedSQLiteProvider
+        provider = ShardedSQLiteProvider(allow_db_create=allow_db_create, if_table_exists=if_table_exists)
+        from .provider.sqlite.backup import schedule_backups
+        schedule_backups(provider)  # no-op unless BACKUP_INTERVAL_SECONDS is set
+        return provider
+
+    @staticmethod
+    @st.cache_resource
+    def _memory_provider(if_table_exists: Literal['ignore', 'recreate'] = 'ignore'):
+        print(f'_memory_provider(if_table_exists={if_table_exists})')
+        from .provider.memory.implementation import MemoryProvider
+        provider = MemoryProvider(if_table_exists=if_table_exists)
+        return provider
+
+    @staticmethod
+    @st.cache_resource
+    def _sqlalchemy_provider(allow_db_create=False, if_table_exists: Literal['ignore', 'recreate'] = 'ignore'):
+        print(f'_sqlalchemy_provider(allow_db_create={allow_db_create}, if_table_exists={if_table_exists})')
+        from .provider.sqla.implementation import SQLAlchemyProvider
+        provider = SQLAlchemyProvider(allow_db_create=allow_db_create, if_table_exists=if_table_exists)
         return provider
 
     @staticmethod
@@ -30,13 +61,29 @@ class StorageFactory():
         provider = AirtableProvider()
         return provider
 
+    @staticmethod
+    @st.cache_resource
+    def _remote_provider():
+        print('_remote_provider()')
+        from .provider.remote.implementation import RemoteProvider
+        provider = RemoteProvider()
+        return provider
+
     def get_provider(self, storage, allow_db_create=False, if_table_exists: Literal['ignore', 'recreate'] = 'ignore'):
-        assert(storage in ['SQLITE', 'AIRTABLE'])
+        assert(storage in STORAGE_PROVIDERS)
 
         if storage == 'SQLITE':
             provider = StorageFactory._sqlite_provider(allow_db_create=allow_db_create, if_table_exists=if_table_exists)
+        elif storage == 'SQLITE_SHARDED':
+            provider = StorageFactory._sqlite_sharded_provider(allow_db_create=allow_db_create, if_table_exists=if_table_exists)
+        elif storage == 'MEMORY':
+            provider = StorageFactory._memory_provider(if_table_exists=if_table_exists)
+        elif storage == 'SQLALCHEMY':
+            provider = StorageFactory._sqlalchemy_provider(allow_db_create=allow_db_create, if_table_exists=if_table_exists)
         elif storage == 'AIRTABLE':
             provider = StorageFactory._airtable_provider()
+        elif storage == 'REMOTE':
+            provider = StorageFactory._remote_provider()
         else:
             raise ValueError(storage)
 
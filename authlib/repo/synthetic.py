@@ -0,0 +1,278 @@
+"""
+Synthetic users, sessions and pending sign-ups for scale tests.
+
+`generate(store, users=N, seed=S)` fills any storage provider with `user<i>@example.com`
+users, a share of them holding active or expired session tokens, plus pending sign-ups
+with mixed expiries. Every value is derived from (seed, row number), so the same seed and
+`now` give the same dataset whatever the chunk size or worker count. Passwords are
+`password_for(i, seed, distinct_passwords)` (so tests can log in as any user): users share
+`distinct_passwords` passwords, each encrypted once with the app's cipher (ENC_PASSWORD/
+ENC_NONCE) on `workers` processes; 0 gives (and encrypts) one per user.
+
+Rows are built in chunks of `chunk_size` on the worker processes, a few chunks ahead of
+this process, which writes each through `upsert_many`, the provider's bulk path (one
+transaction per chunk on SQLite). Streamlit-free; also a command line tool:
+
+    python -m authlib.repo.synthetic --users 1000000 --seed 42 --storage SQLITE --allow-db-create
+"""
+
+import argparse
+import base64
+import datetime
+import hashlib
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from os import environ as osenv
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from .. import const
+from ..common.permissions import join_roles
+from .provider.base_provider import StorageProvider
+
+ENC_PASSWORD = osenv.get('ENC_PASSWORD')
+ENC_NONCE = osenv.get('ENC_NONCE')
+STORAGE = osenv.get('STORAGE', 'SQLITE')
+
+USERS_TABLE = 'USERS'
+PENDING_USERS_TABLE = 'PENDING_USERS'
+
+
+def username_for(i: int) -> str:
+    return f'user{i:07d}@example.com'
+
+
+def password_for(i: int, seed: int, distinct_passwords: int = 0) -> str:
+    """Plain-text password of user (or pending sign-up) `i`."""
+    return f'pw-{seed}-{i % distinct_passwords if distinct_passwords else i}'
+
+
+def _digest(seed: int, kind: str, i: int) -> bytes:
+    return hashlib.blake2b(f'{seed}:{kind}:{i}'.encode(), digest_size=24).digest()
+
+
+def _encrypt_chunk(enc_password: str, enc_nonce: str, passwords: List[str]) -> List[str]:
+    from ..common.crypto import aes256cbcExtended
+    cipher = aes256cbcExtended(enc_password, enc_nonce)
+    return [cipher.encrypt(password) for password in passwords]
+
+
+def encrypt_passwords(passwords: List[str], workers: int = None, enc_password: str = None, enc_nonce: str = None) -> List[str]:
+    """Encrypt `passwords` with the app cipher, split across `workers` processes (default: one per CPU)."""
+    enc_password = enc_password or ENC_PASSWORD
+    enc_nonce = enc_nonce if enc_nonce is not None else ENC_NONCE
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(passwords) < 10000:
+        return _encrypt_chunk(enc_password, enc_nonce, passwords)
+    size = -(-len(passwords) // workers)
+    chunks = [passwords[i:i + size] for i in range(0, len(passwords), size)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(_encrypt_chunk, [enc_password] * len(chunks), [enc_nonce] * len(chunks), chunks)
+        return [encrypted for chunk in results for encrypted in chunk]
+
+
+class _Passwords:
+    """Encrypted password of row `i`: a pool of `distinct` ciphertexts, or (distinct == 0) one per row from `offset`."""
+
+    __slots__ = ('encrypted', 'distinct', 'offset')
+
+    def __init__(self, encrypted: List[str], distinct: int, offset: int = 0):
+        self.encrypted = encrypted
+        self.distinct = distinct
+        self.offset = offset
+
+    def __getitem__(self, i: int) -> str:
+        return self.encrypted[i % self.distinct] if self.distinct else self.encrypted[i - self.offset]
+
+    def window(self, start: int, stop: int) -> '_Passwords':
+        """The passwords rows start..stop need (what a worker process is sent)."""
+        return self if self.distinct else _Passwords(self.encrypted[start - self.offset:stop - self.offset], 0, start)
+
+
+class _Clock:
+    """ISO timestamps `seconds` from `now`; rows use whole minutes/hours/days, so each is formatted once."""
+
+    def __init__(self, now: datetime.datetime):
+        self.now = now
+        self._cache: Dict[int, str] = {}
+
+    def at(self, seconds: int) -> str:
+        value = self._cache.get(seconds)
+        if value is None:
+            value = self._cache[seconds] = (self.now + datetime.timedelta(seconds=seconds)).isoformat()
+        return value
+
+
+def _user_rows(start: int, stop: int, seed: int, now: datetime.datetime, passwords: _Passwords,
+               active_sessions: float, expired_sessions: float, su_every: int, roles: Sequence[str]) -> List[dict]:
+    clock = _Clock(now)
+    with_session = active_sessions + expired_sessions
+    rows = []
+    for i in range(start, stop):
+        digest = _digest(seed, 'user', i)
+        age_days = 1 + int.from_bytes(digest[:2], 'big') % 730
+        logins = digest[2] % 50
+        share = int.from_bytes(digest[3:5], 'big') / 65536
+        token = expires_at = None
+        if share < with_session:
+            token = base64.urlsafe_b64encode(digest).decode()
+            hours = 1 + int.from_bytes(digest[5:7], 'big') % (24 * 30)
+            expires_at = clock.at(3600 * (hours if share < active_sessions else -hours))
+        created_at = clock.at(-86400 * age_days)
+        rows.append({
+            const.USERNAME: username_for(i),
+            const.PASSWORD: passwords[i],
+            const.SU: 1 if su_every and i % su_every == 0 else 0,
+            const.ROLES: roles[i % len(roles)] if roles else None,
+            const.AUTH_TOKEN: token,
+            const.EXPIRES_AT: expires_at,
+            const.LOGINS_COUNT: logins,
+            const.LAST_LOGIN: clock.at(86400 * min(digest[7] % 30 - age_days, 0)) if logins else None,
+            const.CREATED_AT: created_at,
+            const.UPDATED_AT: created_at,
+        })
+    return rows
+
+
+def _pending_rows(start: int, stop: int, seed: int, now: datetime.datetime, passwords: _Passwords,
+                  expired_pending: float) -> List[dict]:
+    clock = _Clock(now)
+    rows = []
+    for i in range(start, stop):
+        digest = _digest(seed, 'pending', i)
+        minutes = 1 + int.from_bytes(digest[:2], 'big') % (24 * 60)
+        expired = int.from_bytes(digest[2:4], 'big') / 65536 < expired_pending
+        rows.append({
+            const.USERNAME: f'pending{i:07d}@example.com',
+            const.PASSWORD: passwords[i],
+            const.VALIDATION_PIN: f'{int.from_bytes(digest[4:8], "big") % 1000000:06d}',
+            const.IS_VALIDATED: 0,
+            const.EXPIRES_AT: clock.at(60 * (-minutes if expired else minutes)),
+            'pin_attempts': digest[8] % 3,
+        })
+    return rows
+
+
+def _chunks(build, count: int, chunk_size: int, passwords: _Passwords, args: tuple, pool, ahead_max: int) -> Iterator[List[dict]]:
+    """Row chunks in order, built here or (with a pool) a few chunks ahead of the writer on worker processes."""
+    ranges = [(start, min(start + chunk_size, count)) for start in range(0, count, chunk_size)]
+    if pool is None:
+        for start, stop in ranges:
+            yield build(start, stop, args[0], args[1], passwords, *args[2:])
+        return
+    ahead = deque()
+    for start, stop in ranges:
+        ahead.append(pool.submit(build, start, stop, args[0], args[1], passwords.window(start, stop), *args[2:]))
+        if len(ahead) > ahead_max:
+            yield ahead.popleft().result()
+    while ahead:
+        yield ahead.popleft().result()
+
+
+def _write(store, table: str, chunks: Iterator[List[dict]], tag_tokens: bool = False) -> int:
+    written = 0
+    for rows in chunks:
+        if tag_tokens:
+            for row in rows:
+                if row[const.AUTH_TOKEN]:
+                    row[const.AUTH_TOKEN] = store.tag_session_token(row[const.USERNAME], row[const.AUTH_TOKEN])
+        store.upsert_many({'table': table, 'rows': rows})
+        written += len(rows)
+    return written
+
+
+def generate(store, users: int = 1000, seed: int = 0, pending: int = 0, active_sessions: float = 0.2,
+             expired_sessions: float = 0.1, expired_pending: float = 0.5, su_every: int = 0,
+             roles: Sequence[str] = (), distinct_passwords: int = 1024, workers: Optional[int] = None,
+             chunk_size: int = 50000, now: Optional[datetime.datetime] = None) -> Dict[str, float]:
+    """
+    Fill `store` with a deterministic synthetic dataset.
+
+    Args:
+        users: Users `user0000000@example.com` ... (password `password_for(i, seed, distinct_passwords)`).
+        seed: Same seed (and `now`), same dataset.
+        pending: Pending sign-ups `pending0000000@example.com` ...
+        active_sessions / expired_sessions: Share of users holding a session token that expires later / expired.
+        expired_pending: Share of pending sign-ups whose PIN has expired.
+        su_every: Make every `su_every`-th user a superuser (0: none).
+        roles: Role names handed out round robin (empty: no roles).
+        distinct_passwords: Distinct passwords (each encrypted once); 0 encrypts one per user.
+        workers: Processes encrypting passwords and building rows while this one writes (default: one per CPU).
+        chunk_size: Rows per `upsert_many` call.
+        now: Reference time for expiries (default: now).
+
+    Returns counts written and the seconds taken.
+    """
+    assert ENC_PASSWORD, 'ENC_PASSWORD must be set (passwords are encrypted with the app cipher)'
+    now = now or datetime.datetime.now()
+    workers = workers or os.cpu_count() or 1
+    count = max(users, pending)
+    distinct = distinct_passwords if 0 < distinct_passwords < count else 0
+
+    started = time.perf_counter()
+    passwords = _Passwords(
+        encrypt_passwords([password_for(i, seed) for i in range(distinct or count)], workers), distinct)
+    encrypted_at = time.perf_counter()
+
+    # Providers that route by token (sharded SQLite) tag tokens here, where the provider lives
+    tag_tokens = type(store).tag_session_token is not StorageProvider.tag_session_token
+    roles = tuple(join_roles([role]) for role in roles)
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 and users + pending > chunk_size else None
+    try:
+        written_users = _write(store, USERS_TABLE, _chunks(
+            _user_rows, users, chunk_size, passwords,
+            (seed, now, active_sessions, expired_sessions, su_every, roles), pool, 2 * workers), tag_tokens)
+        written_pending = _write(store, PENDING_USERS_TABLE, _chunks(
+            _pending_rows, pending, chunk_size, passwords, (seed, now, expired_pending), pool, 2 * workers))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    finished = time.perf_counter()
+    return {
+        'users': written_users,
+        'pending': written_pending,
+        'distinct_passwords': distinct or count,
+        'encrypt_seconds': round(encrypted_at - started, 3),
+        'write_seconds': round(finished - encrypted_at, 3),
+        'seconds': round(finished - started, 3),
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Fill an auth store with synthetic users, sessions and pending sign-ups')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--pending', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--active-sessions', type=float, default=0.2, help='share of users with a live session token')
+    parser.add_argument('--expired-sessions', type=float, default=0.1, help='share of users with an expired session token')
+    parser.add_argument('--expired-pending', type=float, default=0.5, help='share of pending sign-ups already expired')
+    parser.add_argument('--su-every', type=int, default=0, help='every N-th user is a superuser')
+    parser.add_argument('--roles', default='', help='comma-separated roles handed out round robin')
+    parser.add_argument('--distinct-passwords', type=int, default=1024, help='0 encrypts one password per user')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    parser.add_argument('--now', type=datetime.datetime.fromisoformat, default=None, help='ISO reference time (for reproducible expiries)')
+    parser.add_argument('--storage', default=STORAGE)
+    parser.add_argument('--allow-db-create', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    from .registry import default_provider
+    store = default_provider(args.storage, allow_db_create=args.allow_db_create)
+    try:
+        result = generate(
+            store, users=args.users, seed=args.seed, pending=args.pending, active_sessions=args.active_sessions,
+            expired_sessions=args.expired_sessions, expired_pending=args.expired_pending, su_every=args.su_every,
+            roles=[r for r in args.roles.split(',') if r.strip()], distinct_passwords=args.distinct_passwords,
+            workers=args.workers, chunk_size=args.chunk_size, now=args.now,
+        )
+    finally:
+        store.close_database()
+    print(' '.join(f'{key}={value}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Import-time benchmark for st_auth_simple.
+
+Each scenario is imported in a fresh interpreter (cold start) several times. The
+best import wall time is compared against its budget and the peak RSS of the
+child process is reported. The slowest modules from
+`-X importtime` are listed for the first scenario that exceeds its budget.
+
+Usage:
+    python benchmarks/bench_import.py [--runs 5] [--budget-scale 1.0]
+
+Exits non-zero if any scenario exceeds its budget.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, import statement, import budget in ms)
+SCENARIOS = [
+    ('package', 'import st_auth_simple', 25),
+    ('authlib', 'import authlib', 25),
+    ('providers', 'import authlib.repo.provider.sqlite.implementation', 50),
+    ('auth_api', 'from st_auth_simple import auth', 1500),  # includes Streamlit itself
+]
+
+CHILD = '''
+import time, resource, json, sys
+t0 = time.perf_counter()
+{stmt}
+elapsed = (time.perf_counter() - t0) * 1000
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+mods = sorted(m for m in sys.modules if m.split('.')[0] in ('sendgrid', 'Crypto', 'pyairtable', 'streamlit'))
+print(json.dumps({{'ms': elapsed, 'rss_kb': rss, 'heavy': sorted({{m.split('.')[0] for m in mods}})}}))
+'''
+
+
+def _run(stmt: str, extra_args=()) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    return subprocess.run(
+        [sys.executable, *extra_args, '-c', CHILD.format(stmt=stmt)],
+        capture_output=True, text=True, cwd=ROOT, env=env, check=True,
+    )
+
+
+def _slowest_modules(stmt: str, top: int = 10):
+    stderr = _run(stmt, ('-X', 'importtime')).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, module = line.partition(':')[2].split('|')
+        rows.append((int(cumulative_us), int(self_us), module.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-scale', type=float, default=float(os.environ.get('IMPORT_BUDGET_SCALE', '1.0')),
+                        help='multiply all budgets, e.g. 2.0 on slow CI machines')
+    args = parser.parse_args()
+
+    over_budget = []
+    for name, stmt, budget_ms in SCENARIOS:
+        results = [json.loads(_run(stmt).stdout) for _ in range(args.runs)]
+        best = min(r['ms'] for r in results)
+        budget = budget_ms * args.budget_scale
+        status = 'ok' if best <= budget else 'OVER BUDGET'
+        print(f'{name:<10} {stmt:<55} best={best:8.1f}ms budget={budget:7.1f}ms '
+              f'rss={results[0]["rss_kb"] / 1024:6.1f}MB heavy={",".join(results[0]["heavy"]) or "-"}  {status}')
+        if best > budget:
+            over_budget.append((name, stmt))
+
+    if over_budget:
+        name, stmt = over_budget[0]
+        print(f'\nSlowest imports for `{stmt}` (cumulative us, self us, module):')
+        for cumulative_us, self_us, module in _slowest_modules(stmt):
+            print(f'  {cumulative_us:>9} {self_us:>9}  {module}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,7 @@ setup(
     ],
     extras_require={
         "airtable": ["pyairtable>=3.3.0"],
+        "sqlalchemy": ["SQLAlchemy>=2.0"],
         "dev": [
             "pytest>=7.0",
             "pytest-cov>=4.0",
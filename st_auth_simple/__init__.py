@@ -21,16 +21,27 @@ Example:
     ...     st.header("Admin Only")
     ...
     >>> admin_panel()
+
+The public API is resolved from `authlib.auth` on first access, so importing this
+package is cheap and doesn't start Streamlit until `auth()` and friends are used.
 """
 
-from authlib.auth import (
-    auth,
-    authenticated,
-    logout,
-    requires_auth,
-    admin,
-    override_env_storage_provider,
-)
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from authlib.auth import (  # noqa: F401
+        auth,
+        authenticated,
+        logout,
+        requires_auth,
+        requires_role,
+        requires_permission,
+        has_role,
+        has_permission,
+        define_roles,
+        admin,
+        override_env_storage_provider,
+    )
 
 __version__ = "1.0.0"
 __author__ = "Arvindra Sehmi"
@@ -41,6 +52,24 @@ __all__ = [
     "authenticated",
     "logout",
     "requires_auth",
+    "requires_role",
+    "requires_permission",
+    "has_role",
+    "has_permission",
+    "define_roles",
     "admin",
     "override_env_storage_provider",
 ]
+
+
+def __getattr__(name):
+    if name in __all__:
+        from authlib import auth as _auth
+        value = getattr(_auth, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,12 @@
+"""
+Headless admin command line (no Streamlit): `python -m st_auth_simple.admin --help`.
+
+See `authlib.auth_cli` for the commands.
+"""
+
+import sys
+
+from authlib.auth_cli import main
+
+if __name__ == '__main__':
+    sys.exit(main())
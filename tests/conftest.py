@@ -0,0 +1,39 @@
+import os
+import tempfile
+
+# Settings are read from the environment when authlib is imported, so point the file-backed
+# providers at a scratch directory before any test module imports it
+os.environ.setdefault('ENC_PASSWORD', 'test-password')
+os.environ['SQLITE_DB_PATH'] = tempfile.mkdtemp(prefix='st-auth-tests-')
+
+import pytest
+
+# Providers that run without external services
+LOCAL_STORAGES = ('SQLITE', 'SQLITE_SHARDED', 'MEMORY', 'SQLALCHEMY')
+
+
+def make_provider(storage: str, tmp_path):
+    """A fresh provider of kind `storage` whose files live under `tmp_path`."""
+    if storage == 'SQLITE':
+        from authlib.repo.provider.sqlite.implementation import SQLiteProvider
+        return SQLiteProvider(allow_db_create=True, db='auth.db', db_path=str(tmp_path))
+    if storage == 'SQLITE_SHARDED':
+        from authlib.repo.provider.sqlite.sharded import ShardedSQLiteProvider
+        return ShardedSQLiteProvider(allow_db_create=True, db=f'{tmp_path.name}.db')
+    if storage == 'MEMORY':
+        from authlib.repo.provider.memory.implementation import MemoryProvider
+        return MemoryProvider(snapshot_path='')
+    if storage == 'SQLALCHEMY':
+        from authlib.repo.provider.sqla.implementation import SQLAlchemyProvider
+        return SQLAlchemyProvider(allow_db_create=True, url=f"sqlite:///{tmp_path / 'auth.db'}")
+    raise ValueError(storage)
+
+
+@pytest.fixture(params=LOCAL_STORAGES)
+def store(request, tmp_path):
+    provider = make_provider(request.param, tmp_path)
+    yield provider
+    # Write-behind buffers are keyed by id(store); drop this one's before the id can be reused
+    from authlib.common.write_behind import release_buffers
+    release_buffers(provider)
+    provider.close_database()
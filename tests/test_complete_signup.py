@@ -0,0 +1,89 @@
+"""`complete_signup` outcomes on every provider that runs locally."""
+
+import datetime
+import threading
+
+PIN = '123456'
+
+
+def _pending(store, username, expires_in=datetime.timedelta(minutes=5), pin_attempts=0):
+    store.upsert({'table': 'PENDING_USERS', 'data': {
+        'username': username, 'password': 'encrypted', 'validation_pin': PIN, 'is_validated': 0,
+        'expires_at': (datetime.datetime.now() + expires_in).isoformat(), 'pin_attempts': pin_attempts,
+    }})
+
+
+def _complete(store, username, pin=PIN, max_attempts=5):
+    return store.complete_signup({
+        'table': 'PENDING_USERS', 'users_table': 'USERS', 'username': username, 'pin': pin,
+        'max_attempts': max_attempts, 'data': {'su': 0, 'logins_count': 0},
+    })
+
+
+def _rows(store, table, username):
+    return store.query({'table': table, 'fields': '*', 'conds': f'username="{username}"'})
+
+
+def test_ok_moves_pending_user(store):
+    _pending(store, 'a@x.com')
+    result = _complete(store, 'a@x.com')
+    assert result['outcome'] == 'ok'
+    assert result['user']['username'] == 'a@x.com'
+    assert result['user']['password'] == 'encrypted'
+    assert [row['username'] for row in _rows(store, 'USERS', 'a@x.com')] == ['a@x.com']
+    assert _rows(store, 'PENDING_USERS', 'a@x.com') == []
+
+
+def test_mismatch_counts_an_attempt(store):
+    _pending(store, 'a@x.com')
+    assert _complete(store, 'a@x.com', pin='000000')['outcome'] == 'mismatch'
+    assert _rows(store, 'PENDING_USERS', 'a@x.com')[0]['pin_attempts'] == 1
+    assert _rows(store, 'USERS', 'a@x.com') == []
+
+
+def test_expired_is_reported_and_removed(store):
+    _pending(store, 'a@x.com', expires_in=-datetime.timedelta(minutes=5))
+    result = _complete(store, 'a@x.com')
+    assert result['outcome'] == 'expired'
+    assert result['user'] is None
+    assert _rows(store, 'PENDING_USERS', 'a@x.com') == []
+    assert _rows(store, 'USERS', 'a@x.com') == []
+
+
+def test_too_many_attempts(store):
+    _pending(store, 'a@x.com', pin_attempts=5)
+    assert _complete(store, 'a@x.com')['outcome'] == 'attempts'
+    assert _rows(store, 'USERS', 'a@x.com') == []
+
+
+def test_repeated_completion(store):
+    _pending(store, 'a@x.com')
+    assert _complete(store, 'a@x.com')['outcome'] == 'ok'
+    assert _complete(store, 'a@x.com')['outcome'] == 'missing'
+    # A new sign-up for a registered name is refused and leaves the user alone
+    _pending(store, 'a@x.com')
+    assert _complete(store, 'a@x.com')['outcome'] == 'registered'
+    assert len(_rows(store, 'USERS', 'a@x.com')) == 1
+
+
+def test_concurrent_completion_creates_one_user(store):
+    _pending(store, 'a@x.com')
+    barrier = threading.Barrier(2)
+    outcomes = []
+
+    def complete():
+        barrier.wait()
+        outcomes.append(_complete(store, 'a@x.com')['outcome'])
+
+    threads = [threading.Thread(target=complete) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The loser finds the pending row gone, or (SQLAlchemy on SQLite, which has no FOR UPDATE) the user row taken
+    winner, loser = sorted(outcomes, key=lambda outcome: outcome != 'ok')
+    assert winner == 'ok'
+    assert loser in ('missing', 'registered')
+    assert len(_rows(store, 'USERS', 'a@x.com')) == 1
+    assert _rows(store, 'PENDING_USERS', 'a@x.com') == []
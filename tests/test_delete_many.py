@@ -0,0 +1,36 @@
+"""`delete_many` reports the rows it removed, and `auth_cli delete` only counts and audits those."""
+
+from types import SimpleNamespace
+
+from authlib import auth_cli
+
+
+def _seed(store, *usernames):
+    store.upsert_many({'rows': [{'username': name, 'password': 'p', 'su': 0} for name in usernames]})
+
+
+def _names(store):
+    return sorted(row['username'] for row in store.query({'fields': 'username'}))
+
+
+def test_returns_rows_deleted(store):
+    _seed(store, 'a@x.com', 'b@x.com', 'c@x.com')
+    assert store.delete_many({'usernames': ['a@x.com', 'nobody@x.com', 'c@x.com']}) == 2
+    assert store.delete_many({'usernames': ['a@x.com']}) == 0
+    assert store.delete_many({'usernames': []}) == 0
+    assert _names(store) == ['b@x.com']
+
+
+def test_cli_delete_reports_and_audits_only_existing_users(store, monkeypatch, capsys):
+    _seed(store, 'a@x.com', 'b@x.com')
+    audited = []
+    monkeypatch.setattr(auth_cli, 'audit', lambda event, **fields: audited.append((event, fields['username'])))
+
+    status = auth_cli.cmd_delete(store, SimpleNamespace(usernames=['a@x.com', 'ghost@x.com', 'a@x.com', 'x"y']))
+
+    out, err = capsys.readouterr()
+    assert status == 1
+    assert out.strip() == 'Deleted 1 user(s)'
+    assert 'ghost@x.com' in err and 'x"y' in err
+    assert audited == [('admin.delete_user', 'a@x.com')]
+    assert _names(store) == ['b@x.com']
@@ -0,0 +1,43 @@
+"""`iterate` honours 'sort' and 'page_size' on every local provider."""
+
+import pytest
+
+USERS = [('carol', 2), ('alice', 5), ('erin', None), ('bob', 2), ('dave', 9)]  # (username, logins_count)
+
+
+@pytest.fixture
+def users(store):
+    store.upsert_many({'rows': [
+        {'username': name, 'password': 'p', 'su': 0, 'logins_count': count} for name, count in USERS
+    ]})
+    return store
+
+
+def _names(rows):
+    return [row['username'] for row in rows]
+
+
+@pytest.mark.parametrize('sort, expected', [
+    (['username'], ['alice', 'bob', 'carol', 'dave', 'erin']),
+    (['-username'], ['erin', 'dave', 'carol', 'bob', 'alice']),
+    (['logins_count', 'username'], ['erin', 'bob', 'carol', 'alice', 'dave']),
+    (['-logins_count', '-username'], ['dave', 'alice', 'carol', 'bob', 'erin']),
+    (['-logins_count', 'username'], ['dave', 'alice', 'bob', 'carol', 'erin']),
+])
+def test_sort(users, sort, expected):
+    assert _names(users.iterate({'fields': 'username, logins_count', 'sort': sort})) == expected
+
+
+@pytest.mark.parametrize('page_size', [1, 2, 100])
+def test_page_size(users, page_size):
+    rows = users.iterate({'fields': 'username', 'sort': ['username'], 'page_size': page_size})
+    assert _names(rows) == sorted(name for name, _ in USERS)
+
+
+def test_conds(users):
+    assert _names(users.iterate({'fields': 'username', 'conds': 'logins_count=2', 'sort': ['-username']})) == ['carol', 'bob']
+
+
+def test_invalid_sort_field(users):
+    with pytest.raises(ValueError):
+        list(users.iterate({'fields': 'username', 'sort': ['username; DROP TABLE USERS']}))
@@ -0,0 +1,52 @@
+"""Latency quantiles estimated from the histogram buckets."""
+
+import math
+
+import pytest
+
+from authlib.common.metrics import LATENCY_BUCKETS, MetricsRegistry, format_ms
+
+
+@pytest.fixture
+def metrics():
+    return MetricsRegistry()
+
+
+def _quantiles(metrics, op='op'):
+    row = next(row for row in metrics.snapshot() if row['op'] == op)
+    return row['p50_ms'], row['p95_ms'], row['p99_ms']
+
+
+def test_quantiles_are_bucket_upper_bounds(metrics):
+    for _ in range(90):
+        metrics.observe('op', 0.0007)
+    for _ in range(10):
+        metrics.observe('op', 0.2)
+    assert _quantiles(metrics) == (1.0, 250.0, 250.0)
+
+
+def test_quantiles_past_the_largest_bucket_are_inf(metrics):
+    for _ in range(90):
+        metrics.observe('op', 0.0007)
+    for _ in range(10):
+        metrics.observe('op', LATENCY_BUCKETS[-1] * 3)
+    p50, p95, p99 = _quantiles(metrics)
+    assert p50 == 1.0
+    assert math.isinf(p95) and math.isinf(p99)
+
+
+def test_overflow_still_reaches_prometheus(metrics):
+    metrics.observe('op', LATENCY_BUCKETS[-1] * 3)
+    exposition = metrics.render_prometheus()
+    assert f'le="{LATENCY_BUCKETS[-1]}"}} 0' in exposition
+    assert 'le="+Inf"} 1' in exposition
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, ''),
+    (2.5, '2.5'),
+    (10000.0, '10000'),
+    (float('inf'), '> 10000'),
+])
+def test_format_ms(value, expected):
+    assert format_ms(value) == expected
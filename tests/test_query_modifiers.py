@@ -0,0 +1,40 @@
+"""`modifier` handling (ORDER BY / LIMIT) in provider queries."""
+
+import pytest
+
+from conftest import make_provider
+
+
+@pytest.fixture
+def sqla(tmp_path):
+    provider = make_provider('SQLALCHEMY', tmp_path)
+    provider.upsert_many({'rows': [
+        {'username': name, 'password': 'p', 'su': 0, 'logins_count': count}
+        for name, count in (('carol', 2), ('alice', 5), ('bob', 2), ('dave', 9))
+    ]})
+    yield provider
+    provider.close_database()
+
+
+def _names(rows):
+    return [row['username'] for row in rows]
+
+
+@pytest.mark.parametrize('modifier, expected', [
+    ('ORDER BY username', ['alice', 'bob', 'carol', 'dave']),
+    ('ORDER BY username DESC', ['dave', 'carol', 'bob', 'alice']),
+    ('order by logins_count desc, username asc', ['dave', 'alice', 'bob', 'carol']),
+    ('ORDER BY username LIMIT 2', ['alice', 'bob']),
+])
+def test_sqla_applies_order_by(sqla, modifier, expected):
+    assert _names(sqla.query({'fields': 'username, logins_count', 'modifier': modifier})) == expected
+
+
+def test_sqla_limit(sqla):
+    assert len(sqla.query({'fields': 'username', 'modifier': 'LIMIT 3'})) == 3
+
+
+@pytest.mark.parametrize('modifier', ['LIMIT 1 OFFSET 2', 'GROUP BY su', 'ORDER BY lower(username)'])
+def test_sqla_rejects_unsupported_modifiers(sqla, modifier):
+    with pytest.raises(ValueError):
+        sqla.query({'fields': 'username', 'modifier': modifier})
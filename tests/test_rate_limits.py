@@ -0,0 +1,98 @@
+"""Client addresses behind TRUSTED_PROXY_COUNT proxies, and sliding-window limiter expiry."""
+
+from types import SimpleNamespace
+
+import pytest
+
+from authlib import auth
+from authlib.common.rate_limiter import SlidingWindowLimiter, SQLiteSlidingWindowLimiter
+
+SOCKET = '10.0.0.9'
+
+
+@pytest.mark.parametrize('proxies, headers, expected', [
+    # No trusted proxy: forwarded headers are whatever the client sent
+    (0, {'X-Forwarded-For': '1.1.1.1'}, SOCKET),
+    (0, {'X-Real-Ip': '1.1.1.1'}, SOCKET),
+    (1, {}, SOCKET),
+    # One proxy appends the address it received from; anything left of it is client-supplied
+    (1, {'X-Forwarded-For': '1.1.1.1'}, '1.1.1.1'),
+    (1, {'X-Forwarded-For': 'spoofed, 1.1.1.1'}, '1.1.1.1'),
+    (1, {'X-Forwarded-For': ' 9.9.9.9 , 1.1.1.1 '}, '1.1.1.1'),
+    (2, {'X-Forwarded-For': 'spoofed, 1.1.1.1, 2.2.2.2'}, '1.1.1.1'),
+    (2, {'X-Forwarded-For': '1.1.1.1, 2.2.2.2'}, '1.1.1.1'),
+    # Shorter than the proxy count: the chain doesn't reach the client, so use the socket
+    (2, {'X-Forwarded-For': '2.2.2.2'}, SOCKET),
+    (3, {'X-Forwarded-For': '1.1.1.1, 2.2.2.2'}, SOCKET),
+    # X-Real-Ip only: trusted from a single proxy, which overwrites it
+    (1, {'X-Real-Ip': ' 1.1.1.1 '}, '1.1.1.1'),
+    (2, {'X-Real-Ip': '1.1.1.1'}, SOCKET),
+    (1, {'X-Forwarded-For': '3.3.3.3', 'X-Real-Ip': '1.1.1.1'}, '3.3.3.3'),
+])
+def test_client_address(monkeypatch, proxies, headers, expected):
+    monkeypatch.setattr(auth, 'TRUSTED_PROXY_COUNT', proxies)
+    monkeypatch.setattr(auth, 'st', SimpleNamespace(context=SimpleNamespace(headers=headers, ip_address=SOCKET)))
+    assert auth._client_address() == expected
+
+
+@pytest.mark.parametrize('ip_address', [None, ''])
+def test_client_address_without_socket_address(monkeypatch, ip_address):
+    monkeypatch.setattr(auth, 'TRUSTED_PROXY_COUNT', 0)
+    monkeypatch.setattr(auth, 'st', SimpleNamespace(context=SimpleNamespace(headers={}, ip_address=ip_address)))
+    assert auth._client_address() == 'unknown'
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def limiter(request, tmp_path):
+    # 3 events per 60 s; the third blocks for 10 s, doubling per strike up to 25 s
+    options = dict(limit=3, window_seconds=60, backoff_seconds=10, backoff_max_seconds=25)
+    if request.param == 'sqlite':
+        limiter = SQLiteSlidingWindowLimiter(str(tmp_path / 'rate.db'), **options)
+        yield limiter
+        limiter.con.close()
+    else:
+        yield SlidingWindowLimiter(**options)
+
+
+def test_window_slides(limiter):
+    assert limiter.hit('k', now=0) == 0
+    assert limiter.hit('k', now=20) == 0
+    assert limiter.retry_after('k', now=30) == 0
+    # The first event leaves the window at 60 s
+    assert limiter.retry_after('k', now=59) == 0
+    assert limiter.hit('k', now=61) == 0
+    assert limiter.retry_after('k', now=61) == 0
+
+
+def test_limit_blocks_with_backoff_then_expires(limiter):
+    limiter.hit('k', now=0)
+    limiter.hit('k', now=1)
+    assert limiter.hit('k', now=2) == 10
+    assert limiter.retry_after('k', now=5) == 7
+    assert limiter.retry_after('other', now=5) == 0
+    # Past the block, still 3 events in the window: wait for the oldest to leave it
+    assert limiter.retry_after('k', now=12) == pytest.approx(48)
+    assert limiter.retry_after('k', now=61) == 0
+
+
+def test_strikes_double_the_backoff_up_to_the_cap(limiter):
+    for now in (0, 1, 2):
+        limiter.hit('k', now=now)
+    assert limiter.hit('k', now=12) == 20
+    assert limiter.hit('k', now=32) == 25
+
+
+def test_quiet_window_forgives_strikes(limiter):
+    for now in (0, 1, 2):
+        limiter.hit('k', now=now)
+    assert limiter.retry_after('k', now=200) == 0
+    limiter.hit('k', now=200)
+    limiter.hit('k', now=201)
+    assert limiter.hit('k', now=202) == 10
+
+
+def test_reset(limiter):
+    for now in (0, 1, 2):
+        limiter.hit('k', now=now)
+    limiter.reset('k')
+    assert limiter.retry_after('k', now=3) == 0
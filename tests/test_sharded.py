@@ -0,0 +1,96 @@
+"""Routing, token tags and fan-out in the sharded SQLite provider."""
+
+import zlib
+
+import pytest
+
+from authlib import const
+from authlib.auth_session import AuthSession
+from authlib.repo.provider.sqlite.sharded import ShardedSQLiteProvider
+
+USERS = [(f'user{i:02d}@x.com', i % 3, i % 2) for i in range(24)]  # (username, logins_count, su)
+
+
+@pytest.fixture
+def sharded(tmp_path):
+    provider = ShardedSQLiteProvider(allow_db_create=True, shards=4, db=f'{tmp_path.name}.db')
+    provider.upsert_many({'rows': [
+        {'username': name, 'password': 'p', 'logins_count': count, 'su': su} for name, count, su in USERS
+    ]})
+    yield provider
+    provider.close_database()
+
+
+def _names(rows):
+    return [row['username'] for row in rows]
+
+
+def test_rows_land_in_their_crc32_shard(sharded):
+    for name, _, _ in USERS:
+        shard = zlib.crc32(name.encode('utf-8')) % 4
+        assert sharded.shard_for_username(name) == shard
+        assert _names(sharded.shards[shard].query({'fields': 'username', 'conds': f'username="{name}"'})) == [name]
+    # Every shard is used, and each row is stored once
+    counts = [len(shard.query({'fields': 'username'})) for shard in sharded.shards]
+    assert all(counts) and sum(counts) == len(USERS)
+
+
+def test_session_tokens_carry_their_shard(sharded):
+    user = {const.USERNAME: 'user05@x.com'}
+    token = AuthSession.create_session(sharded, user)
+    prefix, _, raw = token.partition('.')
+    assert int(prefix) == sharded.shard_for_username('user05@x.com')
+    assert raw and '.' not in raw
+    assert sharded._route({'conds': f'auth_token="{token}"'}) == int(prefix)
+    assert AuthSession.validate_session(sharded, token)[const.USERNAME] == 'user05@x.com'
+
+
+def test_untagged_tokens_fan_out(sharded):
+    sharded.update({'data': {'username': 'user07@x.com', 'auth_token': 'legacy-token'}})
+    assert sharded._route({'conds': 'auth_token="legacy-token"'}) is None
+    assert _names(sharded.query({'fields': 'username', 'conds': 'auth_token="legacy-token"'})) == ['user07@x.com']
+
+
+def test_fan_out_delete(sharded):
+    sharded.delete({'conds': 'su=1'})
+    remaining = sharded.query({'fields': 'username, su'})
+    assert _names(remaining) == sorted(name for name, _, su in USERS if not su)
+    assert all(shard.query({'fields': 'username', 'conds': 'su=1'}) == [] for shard in sharded.shards)
+
+
+def test_fan_out_delete_many(sharded):
+    doomed = [name for name, _, _ in USERS[:10]]
+    sharded.delete_many({'usernames': doomed})
+    assert _names(sharded.query({'fields': 'username'})) == [name for name, _, _ in USERS[10:]]
+
+
+def test_fan_out_query_merges_by_username(sharded):
+    assert _names(sharded.query({'fields': 'username'})) == sorted(name for name, _, _ in USERS)
+    assert _names(sharded.query({'fields': 'username', 'modifier': 'LIMIT 5'})) == sorted(name for name, _, _ in USERS)[:5]
+
+
+@pytest.mark.parametrize('modifier', [
+    'ORDER BY username DESC',
+    'ORDER BY logins_count DESC, username',
+    'ORDER BY su, logins_count DESC, username DESC LIMIT 7',
+])
+def test_fan_out_query_merges_in_the_requested_order(sharded, modifier):
+    # The same query on one unsharded copy of the data is the reference
+    single = ShardedSQLiteProvider(allow_db_create=True, shards=1, db=f'{sharded.db_name.split("[")[0]}_single.db')
+    try:
+        single.upsert_many({'rows': [
+            {'username': name, 'password': 'p', 'logins_count': count, 'su': su} for name, count, su in USERS
+        ]})
+        context = {'fields': 'username, logins_count, su', 'modifier': modifier}
+        assert [dict(row) for row in sharded.query(context)] == [dict(row) for row in single.shards[0].query(context)]
+    finally:
+        single.close_database()
+
+
+@pytest.mark.parametrize('context', [
+    {'fields': 'username', 'modifier': 'ORDER BY logins_count'},  # merge column not selected
+    {'fields': 'username', 'modifier': 'LIMIT 2 OFFSET 2'},
+])
+def test_fan_out_query_rejects_what_it_cannot_merge(sharded, context):
+    with pytest.raises(ValueError):
+        sharded.query(context)
@@ -0,0 +1,196 @@
+"""Write-behind buffering: the buffer on its own, then session renewals and login counts through a store."""
+
+import datetime
+import threading
+
+import pytest
+
+from authlib import const
+from authlib.auth_session import AuthSession
+from authlib.common.write_behind import WriteBehindBuffer, buffer_for, flush_all, release_buffers
+
+
+class _Recorder:
+    """A flush_fn that records its calls and can be told to fail."""
+
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+        self.flushed = threading.Event()
+
+    def __call__(self, rows, increments):
+        if self.fail:
+            raise RuntimeError('store unavailable')
+        self.calls.append((sorted(rows, key=lambda row: row['username']), increments))
+        self.flushed.set()
+
+
+@pytest.fixture
+def recorder():
+    return _Recorder()
+
+
+@pytest.fixture
+def buffer(recorder):
+    # An interval long enough that the flusher thread never runs during a test
+    buffer = WriteBehindBuffer(recorder, interval_seconds=3600, label='test')
+    yield buffer
+    buffer.close()
+
+
+def test_changes_and_increments_coalesce_per_key(buffer, recorder):
+    buffer.put('a', {'last_login': '1'}, increments={'logins_count': 1})
+    buffer.put('a', {'last_login': '2'}, increments={'logins_count': 1})
+    buffer.put('b', {'expires_at': 'x'})
+    assert len(buffer) == 2
+    assert buffer.pending('a') == {'last_login': '2'}
+    assert buffer.pending('c') is None
+
+    assert buffer.flush() == 2
+    assert recorder.calls == [(
+        [{'username': 'a', 'last_login': '2'}, {'username': 'b', 'expires_at': 'x'}],
+        {'a': {'logins_count': 2}},
+    )]
+    assert len(buffer) == 0
+    assert buffer.flush() == 0
+
+
+def test_failed_flush_is_retried_under_newer_changes(buffer, recorder):
+    buffer.put('a', {'expires_at': 'old', 'last_login': '1'}, increments={'logins_count': 1})
+    recorder.fail = True
+    assert buffer.flush() == 0
+    buffer.put('a', {'expires_at': 'new'}, increments={'logins_count': 1})
+
+    recorder.fail = False
+    assert buffer.flush() == 1
+    assert recorder.calls == [(
+        [{'username': 'a', 'expires_at': 'new', 'last_login': '1'}],
+        {'a': {'logins_count': 2}},
+    )]
+
+
+def test_discard(buffer, recorder):
+    buffer.put('a', {'expires_at': 'x', 'last_login': '1'}, increments={'logins_count': 1})
+    buffer.put('b', {'expires_at': 'y'}, increments={'logins_count': 1})
+    buffer.discard('a', ['expires_at'])
+    buffer.discard('b')
+    buffer.flush()
+    assert recorder.calls == [([{'username': 'a', 'last_login': '1'}], {'a': {'logins_count': 1}})]
+
+
+def test_flusher_thread_runs_on_interval(recorder):
+    buffer = WriteBehindBuffer(recorder, interval_seconds=0.05, label='test')
+    try:
+        buffer.put('a', {'expires_at': 'x'})
+        assert recorder.flushed.wait(5)
+        assert recorder.calls == [([{'username': 'a', 'expires_at': 'x'}], {})]
+    finally:
+        buffer.close()
+
+
+def test_max_pending_wakes_the_flusher(recorder):
+    buffer = WriteBehindBuffer(recorder, interval_seconds=3600, max_pending=2, label='test')
+    try:
+        buffer.put('a', {'expires_at': 'x'})
+        buffer.put('b', {'expires_at': 'y'})
+        assert recorder.flushed.wait(5)
+    finally:
+        buffer.close()
+
+
+def test_close_and_flush_all_write_what_is_left(recorder):
+    # flush_all is the atexit hook
+    buffer = WriteBehindBuffer(recorder, interval_seconds=3600, label='test')
+    buffer.put('a', {'expires_at': 'x'})
+    assert flush_all() >= 1
+    buffer.put('b', {'expires_at': 'y'})
+    buffer.close()
+    assert [rows for rows, _ in recorder.calls] == [[{'username': 'a', 'expires_at': 'x'}], [{'username': 'b', 'expires_at': 'y'}]]
+
+
+# ------------------------------------------------------------------------------
+# Through a store
+
+def _user(store, username='a@x.com') -> dict:
+    store.upsert({'data': {'username': username, 'password': 'encrypted', 'su': 0, 'logins_count': 0}})
+    user = {const.USERNAME: username}
+    assert AuthSession.create_session(store, user, expires_in_days=1)  # well inside the renewal window
+    return user
+
+
+def _row(store, username='a@x.com'):
+    return store.query({'fields': '*', 'conds': f'username="{username}"'})[0]
+
+
+def test_renewal_is_buffered_until_flush(store):
+    user = _user(store)
+    stored_expiry = _row(store)[const.EXPIRES_AT]
+
+    renewed = AuthSession.renew_session(store, user)
+    assert renewed is not None
+    assert _row(store)[const.EXPIRES_AT] == stored_expiry
+
+    # A validation before the flush sees the buffered expiry
+    assert AuthSession.validate_session(store, user[const.AUTH_TOKEN])[const.EXPIRES_AT] == renewed.isoformat()
+
+    assert buffer_for(store).flush() == 1
+    assert _row(store)[const.EXPIRES_AT] == renewed.isoformat()
+
+
+def test_clear_session_discards_a_buffered_renewal(store):
+    user = _user(store)
+    AuthSession.renew_session(store, user)
+    assert AuthSession.clear_session(store, user[const.USERNAME])
+
+    buffer_for(store).flush()
+    row = _row(store)
+    assert row[const.AUTH_TOKEN] is None
+    assert row[const.EXPIRES_AT] is None
+
+
+def test_create_session_discards_a_buffered_renewal(store):
+    user = _user(store)
+    AuthSession.renew_session(store, user)
+    AuthSession.create_session(store, user, expires_in_days=2)
+    new_expiry = _row(store)[const.EXPIRES_AT]
+
+    buffer_for(store).flush()
+    assert _row(store)[const.EXPIRES_AT] == new_expiry
+
+
+def test_release_buffers_flushes_and_forgets(store):
+    user = _user(store)
+    renewed = AuthSession.renew_session(store, user)
+    buffer = buffer_for(store)
+    assert release_buffers(store) == 1
+    assert _row(store)[const.EXPIRES_AT] == renewed.isoformat()
+    assert buffer_for(store) is not buffer
+
+
+def test_logins_are_counted_through_the_buffer(store):
+    user = _user(store)
+    AuthSession.record_login(store, user)
+    AuthSession.record_login(store, user)
+    assert _row(store)[const.LOGINS_COUNT] == 0
+    assert buffer_for(store).pending(user[const.USERNAME]).keys() == {const.LAST_LOGIN}
+
+    assert buffer_for(store).flush() == 1
+    row = _row(store)
+    assert row[const.LOGINS_COUNT] == 2
+    assert row[const.LAST_LOGIN]
+
+    AuthSession.record_login(store, user)
+    buffer_for(store).flush()
+    assert _row(store)[const.LOGINS_COUNT] == 3
+
+
+def test_logout_keeps_a_buffered_login(store):
+    user = _user(store)
+    AuthSession.record_login(store, user)
+    AuthSession.renew_session(store, user)
+    assert AuthSession.clear_session(store, user[const.USERNAME])
+
+    buffer_for(store).flush()
+    row = _row(store)
+    assert row[const.EXPIRES_AT] is None
+    assert row[const.LOGINS_COUNT] == 1